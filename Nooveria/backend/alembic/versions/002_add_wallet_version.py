@@ -0,0 +1,23 @@
+"""Add wallet balance version
+
+Revision ID: 002_add_wallet_version
+Revises: 001_add_world_chats
+Create Date: 2026-10-16 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '002_add_wallet_version'
+down_revision = '001_add_world_chats'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('wallets', sa.Column('version', sa.BigInteger(), nullable=False, server_default='0'))
+
+
+def downgrade():
+    op.drop_column('wallets', 'version')
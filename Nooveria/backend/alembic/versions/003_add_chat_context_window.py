@@ -0,0 +1,27 @@
+"""Add chat summary and message token counts
+
+Revision ID: 003_add_chat_context_window
+Revises: 002_add_wallet_version
+Create Date: 2026-10-16 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '003_add_chat_context_window'
+down_revision = '002_add_wallet_version'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('chats', sa.Column('summary', sa.Text(), nullable=True))
+    op.add_column('chats', sa.Column('summary_message_count', sa.Integer(), nullable=False, server_default='0'))
+    op.add_column('chat_messages', sa.Column('token_count', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('chat_messages', 'token_count')
+    op.drop_column('chats', 'summary_message_count')
+    op.drop_column('chats', 'summary')
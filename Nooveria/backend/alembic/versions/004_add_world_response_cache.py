@@ -0,0 +1,23 @@
+"""Add per-world response cache switch
+
+Revision ID: 004_add_world_response_cache
+Revises: 003_add_chat_context_window
+Create Date: 2026-10-16 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '004_add_world_response_cache'
+down_revision = '003_add_chat_context_window'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('worlds', sa.Column('response_cache_enabled', sa.Boolean(), nullable=False, server_default=sa.false()))
+
+
+def downgrade():
+    op.drop_column('worlds', 'response_cache_enabled')
@@ -0,0 +1,43 @@
+"""Add chat history pagination indexes
+
+Revision ID: 005_add_message_history_indexes
+Revises: 004_add_world_response_cache
+Create Date: 2026-10-16 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '005_add_message_history_indexes'
+down_revision = '004_add_world_response_cache'
+branch_labels = None
+depends_on = None
+
+# Built CONCURRENTLY so the message tables stay writable meanwhile, and IF NOT
+# EXISTS because Base.metadata.create_all already builds them on fresh databases
+INDEXES = [
+    ('ix_chat_messages_history', 'chat_messages', 'chat_id, created_at DESC, role, id DESC'),
+    ('ix_world_chat_messages_history', 'world_chat_messages', 'world_chat_id, created_at DESC, role, id DESC'),
+]
+
+# A concurrent build that failed leaves an invalid index behind
+INVALID_INDEX = """
+SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+WHERE c.relname = :name AND NOT i.indisvalid
+"""
+
+
+def upgrade():
+    with op.get_context().autocommit_block():
+        bind = op.get_bind()
+        for name, table, columns in INDEXES:
+            if bind.execute(sa.text(INVALID_INDEX), {'name': name}).first():
+                op.execute(f'DROP INDEX CONCURRENTLY {name}')
+            op.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} ({columns})')
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, _, _ in reversed(INDEXES):
+            op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
@@ -0,0 +1,73 @@
+"""Add chat list metadata
+
+Revision ID: 006_add_chat_list_metadata
+Revises: 005_add_message_history_indexes
+Create Date: 2026-10-16 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '006_add_chat_list_metadata'
+down_revision = '005_add_message_history_indexes'
+branch_labels = None
+depends_on = None
+
+# Same ordering and preview as services/chat_list (whitespace collapsed, 100 characters).
+# Chats in primary-key order, 5000 per batch, each batch committed on its own so
+# the chat rows are not all locked at once; each chat's subqueries read the 005
+# history index.
+BACKFILL_BATCH = """
+WITH batch AS (SELECT id FROM {chats} WHERE id > :after ORDER BY id LIMIT 5000)
+UPDATE {chats} c SET
+    message_count = (SELECT count(*) FROM {messages} m WHERE m.{fk} = c.id),
+    last_message_at = (SELECT max(m.created_at) FROM {messages} m WHERE m.{fk} = c.id),
+    last_message_preview = (
+        SELECT left(btrim(regexp_replace(m.content, '\\s+', ' ', 'g')), 100) FROM {messages} m
+        WHERE m.{fk} = c.id
+        ORDER BY m.created_at DESC, m.role ASC, m.id DESC
+        LIMIT 1
+    )
+FROM batch WHERE c.id = batch.id
+RETURNING c.id
+"""
+
+TABLES = [('chats', 'chat_messages', 'chat_id'), ('world_chats', 'world_chat_messages', 'world_chat_id')]
+
+# Built CONCURRENTLY (IF NOT EXISTS: create_all builds them on fresh databases)
+INDEXES = [
+    ('ix_chats_user_updated', 'chats', 'user_id, updated_at DESC, id DESC'),
+    ('ix_world_chats_user_world_updated', 'world_chats', 'user_id, world_id, updated_at DESC, id DESC'),
+]
+
+
+def upgrade():
+    for table, timezone in (('chats', False), ('world_chats', True)):
+        op.add_column(table, sa.Column('message_count', sa.Integer(), nullable=False, server_default='0'))
+        op.add_column(table, sa.Column('last_message_at', sa.DateTime(timezone=timezone), nullable=True))
+        op.add_column(table, sa.Column('last_message_preview', sa.String(length=200), nullable=True))
+
+    with op.get_context().autocommit_block():
+        bind = op.get_bind()
+        for chats, messages, fk in TABLES:
+            after = '00000000-0000-0000-0000-000000000000'
+            while True:
+                ids = bind.execute(
+                    sa.text(BACKFILL_BATCH.format(chats=chats, messages=messages, fk=fk)), {'after': after}
+                ).scalars().all()
+                if not ids:
+                    break
+                after = str(max(ids))
+        for name, table, columns in INDEXES:
+            op.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} ({columns})')
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, _, _ in reversed(INDEXES):
+            op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+    for table in ('world_chats', 'chats'):
+        op.drop_column(table, 'last_message_preview')
+        op.drop_column(table, 'last_message_at')
+        op.drop_column(table, 'message_count')
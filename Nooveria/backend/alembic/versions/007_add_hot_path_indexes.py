@@ -0,0 +1,47 @@
+"""Add indexes for the hot-path lookups
+
+Revision ID: 007_add_hot_path_indexes
+Revises: 006_add_chat_list_metadata
+Create Date: 2026-10-16 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '007_add_hot_path_indexes'
+down_revision = '006_add_chat_list_metadata'
+branch_labels = None
+depends_on = None
+
+# Built CONCURRENTLY so the tables stay writable meanwhile, and IF NOT EXISTS
+# because Base.metadata.create_all already builds them on fresh databases.
+# chats.user_id, chat_messages.chat_id and world_chats(user_id, world_id) are
+# covered by the leading columns of the 005/006 indexes.
+INDEXES = [
+    ('ix_wallets_user_type', 'wallets', 'user_id, type'),
+    ('ix_wallet_events_user_created', 'wallet_events', 'user_id, created_at'),
+    ('ix_transactions_created_at', 'transactions', 'created_at'),
+    ('ix_usage_records_user_requested', 'usage_records', 'user_id, request_timestamp'),
+]
+
+# A concurrent build that failed leaves an invalid index behind
+INVALID_INDEX = """
+SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+WHERE c.relname = :name AND NOT i.indisvalid
+"""
+
+
+def upgrade():
+    with op.get_context().autocommit_block():
+        bind = op.get_bind()
+        for name, table, columns in INDEXES:
+            if bind.execute(sa.text(INVALID_INDEX), {'name': name}).first():
+                op.execute(f'DROP INDEX CONCURRENTLY {name}')
+            op.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} ({columns})')
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, _, _ in reversed(INDEXES):
+            op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
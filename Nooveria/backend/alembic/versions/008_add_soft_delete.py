@@ -0,0 +1,48 @@
+"""Add soft delete for chats, world chats and worlds
+
+Revision ID: 008_add_soft_delete
+Revises: 007_add_hot_path_indexes
+Create Date: 2026-10-16 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '008_add_soft_delete'
+down_revision = '007_add_hot_path_indexes'
+branch_labels = None
+depends_on = None
+
+# Built CONCURRENTLY like 007 (IF NOT EXISTS: create_all builds them on fresh databases).
+# The partial indexes hold only deleted rows, for the purge; the world_id ones
+# find a deleted world's chats and pins.
+INDEXES = [
+    ('ix_chats_deleted', 'chats', 'deleted_at', 'deleted_at IS NOT NULL'),
+    ('ix_world_chats_deleted', 'world_chats', 'deleted_at', 'deleted_at IS NOT NULL'),
+    ('ix_world_chats_world', 'world_chats', 'world_id', None),
+    ('ix_user_worlds_world', 'user_worlds', 'world_id', None),
+]
+
+
+def upgrade():
+    op.add_column('chats', sa.Column('deleted_at', sa.DateTime(), nullable=True))
+    op.add_column('world_chats', sa.Column('deleted_at', sa.DateTime(timezone=True), nullable=True))
+    op.add_column('worlds', sa.Column('deleted_at', sa.DateTime(timezone=True), nullable=True))
+
+    with op.get_context().autocommit_block():
+        for name, table, columns, where in INDEXES:
+            op.execute(
+                f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} ({columns})'
+                + (f' WHERE {where}' if where else '')
+            )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, _, _, _ in reversed(INDEXES):
+            op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+
+    op.drop_column('worlds', 'deleted_at')
+    op.drop_column('world_chats', 'deleted_at')
+    op.drop_column('chats', 'deleted_at')
@@ -0,0 +1,83 @@
+"""Add full-text search over chat messages
+
+Revision ID: 009_add_message_search
+Revises: 008_add_soft_delete
+Create Date: 2026-10-16 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = '009_add_message_search'
+down_revision = '008_add_soft_delete'
+branch_labels = None
+depends_on = None
+
+TABLES = ['chat_messages', 'world_chat_messages']
+
+# Same configuration and trigger as app/models/search
+SEARCH_CONFIG = """
+DO $$ BEGIN
+    IF to_regconfig('ru_en') IS NULL THEN
+        CREATE TEXT SEARCH CONFIGURATION ru_en (COPY = pg_catalog.russian);
+        ALTER TEXT SEARCH CONFIGURATION ru_en
+            ALTER MAPPING FOR asciiword, asciihword, hword_asciipart WITH english_stem;
+        ALTER TEXT SEARCH CONFIGURATION ru_en
+            ALTER MAPPING FOR word, hword, hword_part WITH russian_stem;
+    END IF;
+END $$
+"""
+
+SEARCH_TRIGGER_FUNCTION = """
+CREATE OR REPLACE FUNCTION message_search_vector() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector := to_tsvector('ru_en', coalesce(NEW.content, ''));
+    RETURN NEW;
+END $$ LANGUAGE plpgsql
+"""
+
+# Existing rows in primary-key order, 5000 per batch, each batch committed on
+# its own so writes aren't blocked meanwhile (rows written since are set by the trigger)
+BACKFILL_BATCH = """
+WITH batch AS (SELECT id FROM {table} WHERE id > :after ORDER BY id LIMIT 5000)
+UPDATE {table} m SET search_vector = to_tsvector('ru_en', coalesce(m.content, ''))
+FROM batch WHERE m.id = batch.id
+RETURNING m.id
+"""
+
+
+def upgrade():
+    op.execute(SEARCH_CONFIG)
+    op.execute(SEARCH_TRIGGER_FUNCTION)
+    for table in TABLES:
+        op.add_column(table, sa.Column('search_vector', postgresql.TSVECTOR(), nullable=True))
+        # New and edited messages from now on; the backfill below covers the rest
+        op.execute(
+            f'CREATE TRIGGER {table}_search_vector BEFORE INSERT OR UPDATE OF content ON {table} '
+            'FOR EACH ROW EXECUTE FUNCTION message_search_vector()'
+        )
+
+    with op.get_context().autocommit_block():
+        bind = op.get_bind()
+        for table in TABLES:
+            after = '00000000-0000-0000-0000-000000000000'
+            while True:
+                ids = bind.execute(sa.text(BACKFILL_BATCH.format(table=table)), {'after': after}).scalars().all()
+                if not ids:
+                    break
+                after = str(max(ids))
+            op.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_{table}_search ON {table} USING gin (search_vector)')
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for table in TABLES:
+            op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS ix_{table}_search')
+
+    for table in TABLES:
+        op.execute(f'DROP TRIGGER IF EXISTS {table}_search_vector ON {table}')
+        op.drop_column(table, 'search_vector')
+    op.execute('DROP FUNCTION IF EXISTS message_search_vector()')
+    op.execute('DROP TEXT SEARCH CONFIGURATION IF EXISTS ru_en')
@@ -0,0 +1,40 @@
+"""Add wallet holds
+
+Revision ID: 010_add_wallet_holds
+Revises: 009_add_message_search
+Create Date: 2026-10-16 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = '010_add_wallet_holds'
+down_revision = '009_add_message_search'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('wallet_holds',
+        sa.Column('id', postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column('user_id', postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column('wallet_id', sa.Integer(), nullable=False),
+        sa.Column('source', sa.String(length=20), nullable=False),
+        sa.Column('amount_tokens', sa.Numeric(precision=15, scale=2), nullable=False),
+        sa.Column('status', sa.Enum('active', 'settled', 'released', 'expired', name='holdstatus'), nullable=False),
+        sa.Column('expires_at', sa.DateTime(timezone=True), nullable=False),
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+        sa.ForeignKeyConstraint(['wallet_id'], ['wallets.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+    # The expirer looks up active holds past their expiry
+    op.create_index(op.f('ix_wallet_holds_expires_at'), 'wallet_holds', ['expires_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_wallet_holds_expires_at'), table_name='wallet_holds')
+    op.drop_table('wallet_holds')
+    sa.Enum(name='holdstatus').drop(op.get_bind(), checkfirst=True)
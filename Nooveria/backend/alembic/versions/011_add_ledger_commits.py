@@ -0,0 +1,29 @@
+"""Add ledger commit markers
+
+Revision ID: 011_add_ledger_commits
+Revises: 010_add_wallet_holds
+Create Date: 2026-10-16 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = '011_add_ledger_commits'
+down_revision = '010_add_wallet_holds'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # One row per committed charge whose ledger rows are not written yet (see services/ledger)
+    op.create_table('ledger_commits',
+        sa.Column('entry_id', postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+        sa.PrimaryKeyConstraint('entry_id')
+    )
+
+
+def downgrade():
+    op.drop_table('ledger_commits')
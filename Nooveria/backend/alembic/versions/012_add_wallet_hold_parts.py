@@ -0,0 +1,25 @@
+"""Add wallet hold parts
+
+Revision ID: 012_add_wallet_hold_parts
+Revises: 011_add_ledger_commits
+Create Date: 2026-10-16 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '012_add_wallet_hold_parts'
+down_revision = '011_add_ledger_commits'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The stripes a communal hold was taken from, so it is released back to each of them.
+    # Holds without parts were taken from wallet_id alone.
+    op.add_column('wallet_holds', sa.Column('parts', sa.JSON(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('wallet_holds', 'parts')
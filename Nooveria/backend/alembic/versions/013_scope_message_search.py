@@ -0,0 +1,63 @@
+"""Scope message search to the user
+
+Revision ID: 013_scope_message_search
+Revises: 012_add_wallet_hold_parts
+Create Date: 2026-10-16 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = '013_scope_message_search'
+down_revision = '012_add_wallet_hold_parts'
+branch_labels = None
+depends_on = None
+
+# (messages, chats, chat column)
+TABLES = [
+    ('chat_messages', 'chats', 'chat_id'),
+    ('world_chat_messages', 'world_chats', 'world_chat_id'),
+]
+
+# The owner of each existing message, in primary-key order, 5000 per batch,
+# each batch committed on its own (messages written since carry it already)
+BACKFILL_BATCH = """
+WITH batch AS (SELECT id FROM {table} WHERE id > :after ORDER BY id LIMIT 5000)
+UPDATE {table} m SET user_id = c.user_id
+FROM batch, {chats} c WHERE m.id = batch.id AND c.id = m.{chat_column}
+RETURNING m.id
+"""
+
+
+def upgrade():
+    # GIN over (user_id, search_vector) needs the btree operator classes
+    op.execute('CREATE EXTENSION IF NOT EXISTS btree_gin')
+    for table, _, _ in TABLES:
+        op.add_column(table, sa.Column('user_id', postgresql.UUID(as_uuid=True), nullable=True))
+
+    with op.get_context().autocommit_block():
+        bind = op.get_bind()
+        for table, chats, chat_column in TABLES:
+            after = '00000000-0000-0000-0000-000000000000'
+            while True:
+                ids = bind.execute(
+                    sa.text(BACKFILL_BATCH.format(table=table, chats=chats, chat_column=chat_column)), {'after': after}
+                ).scalars().all()
+                if not ids:
+                    break
+                after = str(max(ids))
+            op.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_{table}_user_search ON {table} USING gin (user_id, search_vector)')
+            # Replaced: a common term matched every user's messages through it
+            op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS ix_{table}_search')
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for table, _, _ in TABLES:
+            op.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_{table}_search ON {table} USING gin (search_vector)')
+            op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS ix_{table}_user_search')
+
+    for table, _, _ in TABLES:
+        op.drop_column(table, 'user_id')
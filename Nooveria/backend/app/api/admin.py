@@ -53,8 +53,10 @@ def get_current_admin_user(request: Request, db: Session = Depends(get_db)):
     
     user = db.query(User).filter(User.id == token_data["sub"]).first()
     if not user or user.role.name != "admin":
-        # Log unauthorized admin access attempt
-        security_manager.log_security_event(
+        # Log unauthorized admin access attempt (sync dependency: hop back to the event loop)
+        from anyio.from_thread import run as run_async
+        run_async(
+            security_manager.log_security_event,
             "unauthorized_admin_access",
             token_data.get("sub", "unknown"),
             {"ip": request.client.host if hasattr(request, 'client') else "unknown"}
@@ -222,6 +224,16 @@ async def get_recent_transactions(current_user: User = Depends(get_current_admin
         log_error("ERROR", f"Failed to get transactions: {str(e)}")
         raise HTTPException(status_code=500, detail="Failed to get transactions")
 
+@router.get("/purge")
+async def get_purge_progress(current_user: User = Depends(get_current_admin_user), db: Session = Depends(get_db)):
+    """Deleted chats/worlds still waiting for the background purge, and what this worker has purged"""
+    try:
+        from app.services.purge import pending_purge, purge_stats
+        return {"pending": pending_purge(db), **purge_stats.stats()}
+    except Exception as e:
+        log_error("ERROR", f"Failed to get purge progress: {str(e)}")
+        raise HTTPException(status_code=500, detail="Failed to get purge progress")
+
 @router.get("/files")
 async def get_project_files(current_user: User = Depends(get_current_admin_user)):
     """Get list of editable project files"""
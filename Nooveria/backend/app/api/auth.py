@@ -1,8 +1,10 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Request
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
 from pydantic import BaseModel
 from typing import Optional
-from app.database import get_db
+from app.database import get_async_db
 from app.models import User, Role, Wallet, WalletType, DeviceFingerprint
 from app.services.auth import (
     verify_password, get_password_hash, create_access_token,
@@ -33,8 +35,8 @@ class LogoutRequest(BaseModel):
     device_fingerprint: str = ""
 
 @router.post("/anon")
-async def create_anonymous_session(request: AnonymousRequest, req: Request, db: Session = Depends(get_db)):
-    check_auth_rate_limit(req, "anon")
+async def create_anonymous_session(request: AnonymousRequest, req: Request, db: AsyncSession = Depends(get_async_db)):
+    await check_auth_rate_limit(req, "anon")
     """Create or retrieve existing anonymous session based on device fingerprint"""
     try:
         # Get device fingerprint data
@@ -45,19 +47,19 @@ async def create_anonymous_session(request: AnonymousRequest, req: Request, db:
         
         try:
             # Try to find existing device across browsers
-            existing_device = device_tracker.find_matching_device(db, fingerprint_data)
+            existing_device = await db.run_sync(device_tracker.find_matching_device, fingerprint_data)
             
             if existing_device and existing_device.bound_user_id:
                 # Return existing user from any browser
-                user = db.query(User).filter(User.id == existing_device.bound_user_id).first()
+                user = await db.scalar(select(User).options(selectinload(User.role)).where(User.id == existing_device.bound_user_id))
                 if user:
                     # If user has email, they're registered - return with proper role
                     role = user.role.name if user.email else "anonymous"
                     access_token = create_access_token(data={"sub": str(user.id), "role": role})
-                    wallet = db.query(Wallet).filter(
+                    wallet = await db.scalar(select(Wallet).where(
                         Wallet.user_id == user.id,
                         Wallet.type == WalletType.personal
-                    ).first()
+                    ))
                     
                     return {
                         "session_token": access_token,
@@ -70,25 +72,25 @@ async def create_anonymous_session(request: AnonymousRequest, req: Request, db:
                     }
             
             # Create new user and device record for new hardware
-            user = create_anonymous_user(db, "temp-hash")
-            device_record = device_tracker.create_device_record(db, fingerprint_data)
+            user = await db.run_sync(create_anonymous_user, "temp-hash")
+            device_record = await db.run_sync(device_tracker.create_device_record, fingerprint_data)
             device_record.bound_user_id = user.id
             
         except Exception as e:
             # Fallback to simple hash method
             fingerprint_hash = hash_device_fingerprint(str(fingerprint_data))
-            existing_device = db.query(DeviceFingerprint).filter(
+            existing_device = await db.scalar(select(DeviceFingerprint).where(
                 DeviceFingerprint.fingerprint_hash == fingerprint_hash
-            ).first()
+            ))
             
             if existing_device and existing_device.bound_user_id:
-                user = db.query(User).filter(User.id == existing_device.bound_user_id).first()
+                user = await db.scalar(select(User).options(selectinload(User.role)).where(User.id == existing_device.bound_user_id))
                 if user:
                     access_token = create_access_token(data={"sub": str(user.id), "role": "anonymous"})
-                    wallet = db.query(Wallet).filter(
+                    wallet = await db.scalar(select(Wallet).where(
                         Wallet.user_id == user.id,
                         Wallet.type == WalletType.personal
-                    ).first()
+                    ))
                     
                     return {
                         "session_token": access_token,
@@ -99,7 +101,7 @@ async def create_anonymous_session(request: AnonymousRequest, req: Request, db:
                     }
             
             # Create new user with fallback method
-            user = create_anonymous_user(db, fingerprint_hash)
+            user = await db.run_sync(create_anonymous_user, fingerprint_hash)
             device_fp = DeviceFingerprint(
                 fingerprint_hash=fingerprint_hash,
                 bound_user_id=user.id,
@@ -108,16 +110,16 @@ async def create_anonymous_session(request: AnonymousRequest, req: Request, db:
             )
             db.add(device_fp)
         
-        db.commit()
+        await db.commit()
         
         # Create access token
         access_token = create_access_token(data={"sub": str(user.id), "role": "anonymous"})
         
         # Get wallet balance
-        wallet = db.query(Wallet).filter(
+        wallet = await db.scalar(select(Wallet).where(
             Wallet.user_id == user.id,
             Wallet.type == WalletType.personal
-        ).first()
+        ))
         
         return {
             "session_token": access_token,
@@ -127,12 +129,12 @@ async def create_anonymous_session(request: AnonymousRequest, req: Request, db:
             "returning_user": False
         }
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.post("/register")
-async def register(request: RegisterRequest, req: Request, db: Session = Depends(get_db)):
-    check_auth_rate_limit(req, "register")
+async def register(request: RegisterRequest, req: Request, db: AsyncSession = Depends(get_async_db)):
+    await check_auth_rate_limit(req, "register")
     """Register new user account and link to existing anonymous session"""
     try:
         # Email validation
@@ -147,7 +149,7 @@ async def register(request: RegisterRequest, req: Request, db: Session = Depends
             raise HTTPException(status_code=400, detail=f"Password requirements: {'; '.join(password_errors)}")
         
         # Check if email exists
-        existing_user = db.query(User).filter(User.email == request.email).first()
+        existing_user = await db.scalar(select(User).where(User.email == request.email))
         if existing_user:
             raise HTTPException(status_code=400, detail="Email already registered")
         
@@ -158,13 +160,13 @@ async def register(request: RegisterRequest, req: Request, db: Session = Depends
             token = auth_header.split(" ")[1]
             payload = verify_token(token)
             if payload:
-                current_user = db.query(User).filter(User.id == payload["sub"]).first()
+                current_user = await db.scalar(select(User).where(User.id == payload["sub"]))
         
         if current_user and current_user.email:
             raise HTTPException(status_code=400, detail="Already registered user")
         
         # Get user role
-        user_role = db.query(Role).filter(Role.name == "user").first()
+        user_role = await db.scalar(select(Role).where(Role.name == "user"))
         if not user_role:
             config = Config.get_role_config("user")
             user_role = Role(
@@ -174,7 +176,7 @@ async def register(request: RegisterRequest, req: Request, db: Session = Depends
                 max_request_tokens=config["max_request_tokens"]
             )
             db.add(user_role)
-            db.flush()
+            await db.flush()
         
         if current_user:
             # Upgrade existing anonymous user
@@ -194,7 +196,7 @@ async def register(request: RegisterRequest, req: Request, db: Session = Depends
                 is_verified=False
             )
             db.add(user)
-            db.flush()
+            await db.flush()
             
             # Create personal wallet for new user
             config = Config.get_role_config("user")
@@ -205,35 +207,35 @@ async def register(request: RegisterRequest, req: Request, db: Session = Depends
             )
             db.add(wallet)
         
-        db.commit()
+        await db.commit()
         
         # Create access token for registered user
         access_token = create_access_token(data={"sub": str(user.id), "role": "user"})
         
         # Get wallet balance
-        wallet = db.query(Wallet).filter(
+        wallet = await db.scalar(select(Wallet).where(
             Wallet.user_id == user.id,
             Wallet.type == WalletType.personal
-        ).first()
+        ))
         
         return {
             "session_token": access_token,
             "user_id": str(user.id),
-            "role": user.role.name,
+            "role": user_role.name,
             "email": user.email,
             "display_name": user.display_name,
             "personal_wallet_balance": float(wallet.balance_tokens) if wallet else 0
         }
     except HTTPException:
-        db.rollback()
+        await db.rollback()
         raise
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail="Registration failed")
 
 @router.post("/login")
-async def login(request: LoginRequest, req: Request, db: Session = Depends(get_db)):
-    check_auth_rate_limit(req, "login")
+async def login(request: LoginRequest, req: Request, db: AsyncSession = Depends(get_async_db)):
+    await check_auth_rate_limit(req, "login")
     """Login with security checks"""
     try:
         # Email validation
@@ -243,7 +245,7 @@ async def login(request: LoginRequest, req: Request, db: Session = Depends(get_d
         request.email = email_result
         
         # Find user
-        user = db.query(User).filter(User.email == request.email).first()
+        user = await db.scalar(select(User).options(selectinload(User.role)).where(User.email == request.email))
         if not user:
             print(f"User not found: {request.email}")
             raise HTTPException(status_code=401, detail="Invalid credentials")
@@ -260,12 +262,12 @@ async def login(request: LoginRequest, req: Request, db: Session = Depends(get_d
             payload = verify_token(token)
             if payload:
                 # Find device linked to anonymous user and relink to registered user
-                device = db.query(DeviceFingerprint).filter(
+                device = await db.scalar(select(DeviceFingerprint).where(
                     DeviceFingerprint.bound_user_id == payload["sub"]
-                ).first()
+                ))
                 if device:
                     device.bound_user_id = user.id
-                    db.commit()
+                    await db.commit()
         
         print(f"Login successful for user: {request.email}, role: {user.role.name}")
         
@@ -273,10 +275,10 @@ async def login(request: LoginRequest, req: Request, db: Session = Depends(get_d
         access_token = create_access_token(data={"sub": str(user.id), "role": user.role.name})
         
         # Get wallet balance
-        wallet = db.query(Wallet).filter(
+        wallet = await db.scalar(select(Wallet).where(
             Wallet.user_id == user.id,
             Wallet.type == WalletType.personal
-        ).first()
+        ))
         
         return {
             "session_token": access_token,
@@ -293,7 +295,7 @@ async def login(request: LoginRequest, req: Request, db: Session = Depends(get_d
         raise HTTPException(status_code=500, detail="Login failed")
 
 @router.post("/logout")
-async def logout(request: LogoutRequest, req: Request, db: Session = Depends(get_db)):
+async def logout(request: LogoutRequest, req: Request, db: AsyncSession = Depends(get_async_db)):
     """Logout and return to anonymous session for same device"""
     try:
         # Get current user from token
@@ -306,21 +308,23 @@ async def logout(request: LogoutRequest, req: Request, db: Session = Depends(get
         if not payload:
             raise HTTPException(status_code=401, detail="Invalid session")
         
-        current_user = db.query(User).filter(User.id == payload["sub"]).first()
+        current_user = await db.scalar(select(User).where(User.id == payload["sub"]))
         if not current_user:
             raise HTTPException(status_code=401, detail="User not found")
         
         # Find device linked to this user
-        device = db.query(DeviceFingerprint).filter(
+        device = await db.scalar(select(DeviceFingerprint).where(
             DeviceFingerprint.bound_user_id == current_user.id
-        ).first()
+        ))
         
         if device:
             # Find existing anonymous user for this device
-            anonymous_users = db.query(User).join(DeviceFingerprint).filter(
-                DeviceFingerprint.fingerprint_hash == device.fingerprint_hash,
-                User.email.is_(None)
-            ).all()
+            anonymous_users = (await db.scalars(
+                select(User).join(User.device_fingerprints).where(
+                    DeviceFingerprint.fingerprint_hash == device.fingerprint_hash,
+                    User.email.is_(None)
+                )
+            )).all()
             
             anonymous_user = None
             for user in anonymous_users:
@@ -330,20 +334,20 @@ async def logout(request: LogoutRequest, req: Request, db: Session = Depends(get
             
             if not anonymous_user:
                 # Create new anonymous user for this device
-                anonymous_user = create_anonymous_user(db, device.fingerprint_hash)
+                anonymous_user = await db.run_sync(create_anonymous_user, device.fingerprint_hash)
             
             # Link device to anonymous user
             device.bound_user_id = anonymous_user.id
-            db.commit()
+            await db.commit()
             
             # Create token for anonymous user
             access_token = create_access_token(data={"sub": str(anonymous_user.id), "role": "anonymous"})
             
             # Get wallet balance
-            wallet = db.query(Wallet).filter(
+            wallet = await db.scalar(select(Wallet).where(
                 Wallet.user_id == anonymous_user.id,
                 Wallet.type == WalletType.personal
-            ).first()
+            ))
             
             return {
                 "session_token": access_token,
@@ -354,15 +358,15 @@ async def logout(request: LogoutRequest, req: Request, db: Session = Depends(get
             }
         else:
             # No device found, create fresh anonymous session
-            anonymous_user = create_anonymous_user(db, "logout-fallback")
-            db.commit()
+            anonymous_user = await db.run_sync(create_anonymous_user, "logout-fallback")
+            await db.commit()
             
             access_token = create_access_token(data={"sub": str(anonymous_user.id), "role": "anonymous"})
             
-            wallet = db.query(Wallet).filter(
+            wallet = await db.scalar(select(Wallet).where(
                 Wallet.user_id == anonymous_user.id,
                 Wallet.type == WalletType.personal
-            ).first()
+            ))
             
             return {
                 "session_token": access_token,
@@ -375,5 +379,5 @@ async def logout(request: LogoutRequest, req: Request, db: Session = Depends(get
     except HTTPException:
         raise
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail="Logout failed")
\ No newline at end of file
@@ -1,11 +1,18 @@
-from fastapi import APIRouter, Depends, HTTPException, Header
+from fastapi import APIRouter, Depends, HTTPException, Header, Request
 from sqlalchemy.orm import Session
 from pydantic import BaseModel
 from typing import List, Dict, Optional
 from app.database import get_db
 from app.services.auth import verify_token
-from app.services.openai_client import chat_completion
-from app.services.wallet import charge_tokens, create_usage_record
+from app.services.response_cache import cached_chat_completion
+from app.services.wallet import reserve_tokens, settle_hold, release_hold, estimate_request_tokens, usage_record_values, after_wallet_change
+from app.services.cache import CacheService
+from app.services.wallet_events import chat_expense_event_values
+from app.services.ledger import record_charge
+from app.services.admission import UpstreamBusy
+from app.services.disconnects import run_unless_disconnected, ClientDisconnected
+from app.services.deadline import DeadlineExceeded
+from app.models import User, Role, World
 
 router = APIRouter()
 
@@ -16,6 +23,7 @@ class ChatMessage(BaseModel):
 class ChatRequest(BaseModel):
     messages: List[ChatMessage]
     prefer_communal: bool = False
+    world_id: Optional[int] = None
 
 def get_current_user(authorization: Optional[str] = Header(None), db: Session = Depends(get_db)):
     """Extract user from JWT token"""
@@ -37,6 +45,7 @@ def get_current_user(authorization: Optional[str] = Header(None), db: Session =
 @router.post("/chat")
 async def chat(
     request: ChatRequest,
+    http_request: Request,
     db: Session = Depends(get_db),
     current_user: str = Depends(get_current_user)
 ):
@@ -44,54 +53,82 @@ async def chat(
     Process chat request through OpenAI proxy.
     CRITICAL: Does not store any chat content, only usage metadata.
     """
+    # Convert messages to OpenAI format
+    openai_messages = [{"role": msg.role, "content": msg.content} for msg in request.messages]
+    
+    role_name = db.query(Role.name).join(User, User.role_id == Role.id).filter(User.id == current_user).scalar()
+    
+    # Worlds opt in to reusing identical first-turn replies (billed at a discount)
+    use_cache = request.world_id is not None and bool(
+        db.query(World.response_cache_enabled).filter(World.id == request.world_id).scalar()
+    )
+    
+    # Reserve tokens before calling upstream; commit so no lock is held during the call
+    try:
+        daily_used = await CacheService.get_daily_usage(current_user) if request.prefer_communal else 0
+        hold = reserve_tokens(
+            db, current_user, estimate_request_tokens(openai_messages), request.prefer_communal,
+            daily_used=daily_used, reject_oversized=True
+        )
+        db.commit()
+        await after_wallet_change(current_user, hold)
+    except Exception as e:
+        db.rollback()
+        if "Insufficient funds" in str(e):
+            raise HTTPException(status_code=402, detail="insufficient_funds")
+        if "Request too large" in str(e):
+            raise HTTPException(status_code=413, detail="request_too_large")
+        if isinstance(e, DeadlineExceeded):
+            raise
+        raise HTTPException(status_code=500, detail=str(e))
+    
     try:
-        # Convert messages to OpenAI format
-        openai_messages = [{"role": msg.role, "content": msg.content} for msg in request.messages]
-        
         # Call OpenAI API
-        response = await chat_completion(openai_messages)
+        # Nothing is billed for a reply the client is no longer waiting for
+        response = await run_unless_disconnected(
+            http_request,
+            cached_chat_completion(openai_messages, enabled=use_cache, user_id=current_user, role_name=role_name)
+        )
+    except Exception as e:
+        released = release_hold(db, hold["hold_id"])
+        db.commit()
+        await after_wallet_change(current_user, released)
+        if isinstance(e, UpstreamBusy):
+            raise HTTPException(status_code=503, detail="upstream_busy", headers={"Retry-After": str(e.retry_after)})
+        if isinstance(e, ClientDisconnected):
+            raise HTTPException(status_code=499, detail="client_closed_request")
+        if isinstance(e, DeadlineExceeded):
+            raise
+        raise HTTPException(status_code=500, detail=f"Chat processing error: {str(e)}")
+    
+    try:
+        # Charge actual usage against the hold
+        charge_result = settle_hold(db, hold["hold_id"], response["usage"]["total_tokens"], defer_transaction=True, daily_used=daily_used)
+        
+        # Transaction, usage record (NO CHAT CONTENT) and expense event go to the ledger
+        events = [chat_expense_event_values(
+            current_user,
+            response["usage"]["total_tokens"],
+            None,
+            charge_result["charged_from"] == "communal"
+        )]
+        record_charge(
+            db,
+            charge_result["transaction"],
+            usage_record_values(current_user, response["usage"]),
+            events
+        )
+        db.commit()
+        await after_wallet_change(current_user, charge_result, events)
+        
+        # Return only the assistant's response and usage metadata
+        return {
+            "message": response["message"],
+            "usage": response["usage"]
+        }
         
-        # Begin atomic transaction for token charging
-        db.begin()
-        try:
-            # Charge tokens
-            charge_result = charge_tokens(
-                db, 
-                current_user, 
-                response["usage"]["total_tokens"],
-                request.prefer_communal
-            )
-            
-            # Create usage record (NO CHAT CONTENT)
-            create_usage_record(
-                db,
-                current_user,
-                response["usage"],
-                charge_result["transaction_id"]
-            )
-            
-            # Create wallet event for chat expense
-            create_chat_expense_event(
-                db,
-                current_user,
-                response["usage"]["total_tokens"],
-                None,
-                useSharedTokens
-            )
-            
-            # Return only the assistant's response and usage metadata
-            return {
-                "message": response["message"],
-                "usage": response["usage"]
-            }
-            
-        except Exception as e:
-            db.rollback()
-            if "Insufficient funds" in str(e):
-                raise HTTPException(status_code=402, detail="insufficient_funds")
-            raise HTTPException(status_code=500, detail=str(e))
-            
-    except HTTPException:
-        raise
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Chat processing error: {str(e)}")
\ No newline at end of file
+        db.rollback()
+        if "Insufficient funds" in str(e):
+            raise HTTPException(status_code=402, detail="insufficient_funds")
+        raise HTTPException(status_code=500, detail=str(e))
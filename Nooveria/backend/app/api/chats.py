@@ -1,10 +1,18 @@
-from fastapi import APIRouter, Depends, HTTPException, Header
+import json
+import uuid
+import asyncio
+from contextlib import aclosing
+from fastapi import APIRouter, Depends, HTTPException, Header, Request
+from fastapi.responses import StreamingResponse, JSONResponse
+from sqlalchemy import select, update, func
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from pydantic import BaseModel
 from typing import List, Optional
-from app.database import get_db
+from app.database import get_async_db
 from app.services.auth import verify_token
 from app.models.chat import Chat, ChatMessage
+from app.services.idempotency import IdempotentRequest, IdempotencyConflict, IdempotencyInProgress
 
 router = APIRouter()
 
@@ -14,6 +22,8 @@ class ChatResponse(BaseModel):
     created_at: str
     updated_at: str
     message_count: int
+    last_message_at: Optional[str] = None
+    last_message_preview: Optional[str] = None
 
 class MessageResponse(BaseModel):
     id: str
@@ -25,10 +35,14 @@ class ChatDetailResponse(BaseModel):
     id: str
     title: str
     messages: List[MessageResponse]
+    # Older messages exist; pass next_before as before= to get them
+    has_more: bool = False
+    next_before: Optional[str] = None
 
 class SendMessageRequest(BaseModel):
     message: str
     prefer_communal: bool = False
+    stream: bool = False
 
 def get_current_user(authorization: Optional[str] = Header(None)):
     if not authorization or not authorization.startswith("Bearer "):
@@ -43,13 +57,17 @@ def get_current_user(authorization: Optional[str] = Header(None)):
 
 @router.get("", response_model=List[ChatResponse])
 async def get_chats(
-    db: Session = Depends(get_db),
+    before: Optional[uuid.UUID] = None,
+    limit: Optional[int] = None,
+    db: AsyncSession = Depends(get_async_db),
     current_user: str = Depends(get_current_user)
 ):
-    """Get all chats for current user"""
+    """Get a page of the current user's chats, most recently active first (before=<last chat id> for the next page)"""
+    from app.services.chat_list import load_chat_page, list_limit
+    
     try:
         print(f"Getting chats for user: {current_user}")
-        chats = db.query(Chat).filter(Chat.user_id == current_user).order_by(Chat.updated_at.desc()).all()
+        chats = await load_chat_page(db, Chat, [Chat.user_id == current_user, Chat.deleted_at.is_(None)], before, list_limit(limit))
         print(f"Found {len(chats)} chats")
         
         return [
@@ -58,17 +76,21 @@ async def get_chats(
                 title=chat.title,
                 created_at=chat.created_at.isoformat(),
                 updated_at=chat.updated_at.isoformat(),
-                message_count=len(chat.messages)
+                message_count=chat.message_count,
+                last_message_at=chat.last_message_at.isoformat() if chat.last_message_at else None,
+                last_message_preview=chat.last_message_preview
             )
             for chat in chats
         ]
     except Exception as e:
         print(f"Error getting chats: {e}")
+        if "Invalid cursor" in str(e):
+            raise HTTPException(status_code=400, detail="invalid_cursor")
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.post("", response_model=ChatResponse)
 async def create_chat(
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: str = Depends(get_current_user)
 ):
     """Create new chat"""
@@ -76,8 +98,8 @@ async def create_chat(
         print(f"Creating chat for user: {current_user}")
         chat = Chat(user_id=current_user, title="New Chat")
         db.add(chat)
-        db.commit()
-        db.refresh(chat)
+        await db.commit()
+        await db.refresh(chat)
         print(f"Created chat with ID: {chat.id}")
         
         return ChatResponse(
@@ -89,20 +111,31 @@ async def create_chat(
         )
     except Exception as e:
         print(f"Error creating chat: {e}")
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/{chat_id}", response_model=ChatDetailResponse)
 async def get_chat(
     chat_id: str,
-    db: Session = Depends(get_db),
+    before: Optional[uuid.UUID] = None,
+    limit: Optional[int] = None,
+    db: AsyncSession = Depends(get_async_db),
     current_user: str = Depends(get_current_user)
 ):
-    """Get chat with messages"""
-    chat = db.query(Chat).filter(Chat.id == chat_id, Chat.user_id == current_user).first()
+    """Get chat with one page of messages: the newest, or those older than message before"""
+    from app.services.message_history import load_message_page, page_limit
+    
+    chat = await db.scalar(select(Chat).where(Chat.id == chat_id, Chat.user_id == current_user, Chat.deleted_at.is_(None)))
     if not chat:
         raise HTTPException(status_code=404, detail="Chat not found")
     
+    try:
+        page, has_more = await load_message_page(db, ChatMessage, ChatMessage.chat_id, chat.id, before, page_limit(limit))
+    except Exception as e:
+        if "Invalid cursor" in str(e):
+            raise HTTPException(status_code=400, detail="invalid_cursor")
+        raise
+    
     messages = [
         MessageResponse(
             id=str(msg.id),
@@ -110,111 +143,336 @@ async def get_chat(
             content=msg.content,
             created_at=msg.created_at.isoformat()
         )
-        for msg in chat.messages
+        for msg in page
     ]
     
     return ChatDetailResponse(
         id=str(chat.id),
         title=chat.title,
-        messages=messages
+        messages=messages,
+        has_more=has_more,
+        next_before=messages[0].id if has_more else None
+    )
+
+def _bill_and_save_reply(db: Session, chat: Chat, current_user: str, request: SendMessageRequest, response: dict, is_first_message: bool, hold_id: str, daily_used: int = 0):
+    """
+    Settle the hold for a finished completion and store the assistant reply
+    (run via run_sync, committed by the caller). Returns the charge result and
+    the wallet event values for after_wallet_change.
+    """
+    from app.services.wallet import settle_hold, usage_record_values
+    from app.services.wallet_events import chat_expense_event_values
+    from app.services.ledger import record_charge
+    from app.services.chat_list import record_messages
+    
+    # Charge actual usage against the hold first (before saving assistant message)
+    charge_result = settle_hold(db, hold_id, response["usage"]["total_tokens"], defer_transaction=True, daily_used=daily_used)
+    
+    # Transaction, usage record (NO CHAT CONTENT) and expense event go to the ledger
+    events = [chat_expense_event_values(
+        current_user,
+        response["usage"]["total_tokens"],
+        str(chat.id),
+        charge_result["charged_from"] == "communal"
+    )]
+    record_charge(
+        db,
+        charge_result["transaction"],
+        usage_record_values(current_user, response["usage"]),
+        events
+    )
+    
+    # Save assistant message
+    assistant_message = ChatMessage(
+        chat_id=chat.id,
+        user_id=chat.user_id,
+        role="assistant",
+        content=response["message"]["content"],
+        token_count=response["usage"]["completion_tokens"]
     )
+    db.add(assistant_message)
+    
+    # Update chat title if first message
+    if is_first_message:
+        chat.title = request.message[:50] + ("..." if len(request.message) > 50 else "")
+    # The user message and the reply
+    record_messages(chat, 2, response["message"]["content"])
+    
+    return charge_result, events
+
+def _sse_event(event: str, data: dict) -> str:
+    """Format one Server-Sent Events frame"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+async def _replay_stream(stored: dict):
+    """A stored reply as the events of a stream"""
+    yield _sse_event("token", {"content": stored["message"]["content"]})
+    yield _sse_event("done", stored)
+
+def _replayed(stored: dict, stream: bool):
+    """The stored reply for a retry of a request that already ran"""
+    headers = {"Idempotent-Replayed": "true"}
+    if stream:
+        return StreamingResponse(_replay_stream(stored), media_type="text/event-stream", headers={**SSE_HEADERS, **headers})
+    return JSONResponse(stored, headers=headers)
+
+async def _begin_idempotent(idempotency: IdempotentRequest) -> Optional[dict]:
+    """Claim the request's Idempotency-Key; the stored reply if it already ran"""
+    try:
+        return await idempotency.begin()
+    except Exception as e:
+        if isinstance(e, IdempotencyConflict):
+            raise HTTPException(status_code=422, detail="idempotency_key_reused")
+        if isinstance(e, IdempotencyInProgress):
+            raise HTTPException(status_code=409, detail="request_in_progress")
+        if "Invalid idempotency key" in str(e):
+            raise HTTPException(status_code=400, detail="invalid_idempotency_key")
+        raise
+
+async def _release_after_failure(db: AsyncSession, current_user: str, hold_id: str):
+    """Roll back the failed request and give the reserved tokens back (even past the deadline)"""
+    from app.services.wallet import release_hold, after_wallet_change
+    from app.services import deadline
+    
+    with deadline.suspended():
+        await db.rollback()
+        try:
+            released = await db.run_sync(release_hold, hold_id)
+            await db.commit()
+            await after_wallet_change(current_user, released)
+        except Exception as e:
+            # The hold expires on its own if it cannot be released now
+            await db.rollback()
+            print(f"Failed to release hold {hold_id}: {e}")
+
+async def _settle_abandoned_stream(chat_id, current_user: str, request: SendMessageRequest, chat_messages: List[dict], streamed: List[str], is_first_message: bool, hold_id: str, daily_used: int):
+    """
+    Bill the prompt and the tokens streamed before the client went away, and
+    keep the partial reply. Runs detached with its own session: the request's
+    task is cancelled and its session is being closed.
+    """
+    from app.database import get_async_db
+    from app.services.wallet import release_hold, after_wallet_change
+    from app.services.tokenizer import count_tokens, count_message_tokens
+    from app.services.disconnects import disconnect_stats
+    
+    content = "".join(streamed)
+    async with aclosing(get_async_db()) as sessions:
+        db = await anext(sessions)
+        try:
+            if not content:
+                released = await db.run_sync(release_hold, hold_id)
+                await db.commit()
+                await after_wallet_change(current_user, released)
+                return
+            
+            chat = await db.get(Chat, chat_id)
+            db.add(ChatMessage(chat_id=chat_id, user_id=chat.user_id, role="user", content=request.message, token_count=count_tokens(request.message)))
+            prompt_tokens = count_message_tokens(chat_messages)
+            completion_tokens = count_tokens(content)
+            response = {
+                "message": {"role": "assistant", "content": content},
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                    "client_disconnected": True
+                }
+            }
+            charge_result, events = await db.run_sync(_bill_and_save_reply, chat, current_user, request, response, is_first_message, hold_id, daily_used)
+            await db.commit()
+            await after_wallet_change(current_user, charge_result, events)
+            disconnect_stats.partial_tokens_billed += prompt_tokens + completion_tokens
+        except Exception as e:
+            # The hold expires on its own if it cannot be settled now
+            await db.rollback()
+            print(f"Failed to settle abandoned stream for hold {hold_id}: {e}")
+
+async def _stream_reply(db: AsyncSession, chat: Chat, current_user: str, role_name: str, request: SendMessageRequest, chat_messages: List[dict], is_first_message: bool, hold_id: str, daily_used: int, idempotency: IdempotentRequest):
+    """Relay upstream tokens as SSE and bill from the final usage chunk"""
+    from app.services.openai_client import chat_completion_stream
+    from app.services.admission import UpstreamBusy
+    from app.services.wallet import after_wallet_change
+    from app.services.disconnects import disconnect_stats, run_detached
+    from app.services import deadline
+    from app.services.deadline import DeadlineExceeded
+    
+    response = None
+    streamed = []
+    try:
+        async for chunk in chat_completion_stream(chat_messages, user_id=current_user, role_name=role_name):
+            if chunk["type"] == "delta":
+                if not streamed:
+                    # The deadline covers the time to first token; a reply in progress runs to the end
+                    deadline.lift()
+                # A long reply outlives IDEMPOTENCY_LOCK_TTL; keep the key held until it is stored
+                await idempotency.refresh()
+                streamed.append(chunk["content"])
+                yield _sse_event("token", {"content": chunk["content"]})
+            else:
+                response = chunk
+        
+        charge_result, events = await db.run_sync(_bill_and_save_reply, chat, current_user, request, response, is_first_message, hold_id, daily_used)
+        await db.commit()
+        await after_wallet_change(current_user, charge_result, events)
+        
+        done = {
+            "message": response["message"],
+            "usage": response["usage"],
+            "wallet_updated": True
+        }
+        await idempotency.finish(done)
+        yield _sse_event("done", done)
+    except (asyncio.CancelledError, GeneratorExit):
+        # Client went away mid-stream (the upstream stream is cancelled with us)
+        if response is None:
+            disconnect_stats.abandoned_streams += 1
+            run_detached(_settle_abandoned_stream(
+                chat.id, current_user, request, chat_messages, streamed, is_first_message, hold_id, daily_used
+            ))
+            # The reply never arrived whole, so a retry runs again
+            run_detached(idempotency.abandon())
+        raise
+    except Exception as e:
+        await _release_after_failure(db, current_user, hold_id)
+        await idempotency.abandon()
+        if "Insufficient funds" in str(e):
+            yield _sse_event("error", {"status": 402, "detail": "insufficient_funds"})
+        elif isinstance(e, UpstreamBusy):
+            yield _sse_event("error", {"status": 503, "detail": "upstream_busy", "retry_after": e.retry_after})
+        elif isinstance(e, DeadlineExceeded):
+            yield _sse_event("error", {"status": 504, "detail": "deadline_exceeded", "stage": e.stage})
+        else:
+            yield _sse_event("error", {"status": 500, "detail": str(e)})
 
 @router.post("/{chat_id}/messages")
 async def send_message(
     chat_id: str,
     request: SendMessageRequest,
-    db: Session = Depends(get_db),
+    http_request: Request,
+    idempotency_key: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_async_db),
     current_user: str = Depends(get_current_user)
 ):
-    """Send message to chat"""
-    chat = db.query(Chat).filter(Chat.id == chat_id, Chat.user_id == current_user).first()
+    """Send message to chat (retries with the same Idempotency-Key get the stored reply)"""
+    chat = await db.scalar(
+        select(Chat).where(Chat.id == chat_id, Chat.user_id == current_user, Chat.deleted_at.is_(None))
+    )
     if not chat:
         raise HTTPException(status_code=404, detail="Chat not found")
     
+    idempotency = IdempotentRequest(idempotency_key, current_user, f"chats/{chat_id}", request.model_dump(exclude={"stream"}))
+    stored = await _begin_idempotent(idempotency)
+    if stored is not None:
+        return _replayed(stored, request.stream)
+    
+    from app.services.wallet import reserve_tokens, estimate_request_tokens, after_wallet_change
+    from app.services.cache import CacheService
+    from app.services.context_window import build_context, context_budget, load_recent_messages, schedule_summary_refresh
+    from app.services.tokenizer import count_tokens
+    from app.services.admission import UpstreamBusy
+    from app.services.disconnects import run_unless_disconnected, ClientDisconnected
+    from app.services.deadline import DeadlineExceeded
+    from app.models import User, Role
+    
+    is_first_message = chat.message_count == 0
+    
+    # Chat context: rolling summary plus the newest turns that fit the role's budget
+    role_name = await db.scalar(select(Role.name).join(User, User.role_id == Role.id).where(User.id == current_user))
+    budget = context_budget(role_name)
+    history = await load_recent_messages(db, chat, budget)
+    chat_messages, needs_summary = build_context(chat, history, request.message, budget)
+    
+    # Reserve tokens before the upstream call; the short transaction is
+    # committed so no wallet row stays locked while we wait for the model
+    try:
+        daily_used = await CacheService.get_daily_usage(current_user) if request.prefer_communal else 0
+        hold = await db.run_sync(
+            reserve_tokens, current_user, estimate_request_tokens(chat_messages), request.prefer_communal,
+            daily_used=daily_used, reject_oversized=True
+        )
+        await db.commit()
+        await after_wallet_change(current_user, hold)
+    except Exception as e:
+        await db.rollback()
+        await idempotency.abandon()
+        if "Insufficient funds" in str(e):
+            raise HTTPException(status_code=402, detail="insufficient_funds")
+        if "Request too large" in str(e):
+            raise HTTPException(status_code=413, detail="request_too_large")
+        if isinstance(e, DeadlineExceeded):
+            raise
+        raise HTTPException(status_code=500, detail=str(e))
+    
+    # Fold turns that fell out of the window into the summary, off the request path
+    if needs_summary:
+        schedule_summary_refresh(chat.id, budget, role_name)
+    
     try:
         # Save user message
         user_message = ChatMessage(
             chat_id=chat_id,
+            user_id=chat.user_id,
             role="user",
-            content=request.message
+            content=request.message,
+            token_count=count_tokens(request.message)
         )
         db.add(user_message)
         
-        # Get chat context
-        chat_messages = [
-            {"role": msg.role, "content": msg.content}
-            for msg in chat.messages
-        ] + [{"role": "user", "content": request.message}]
+        if request.stream:
+            return StreamingResponse(
+                _stream_reply(db, chat, current_user, role_name, request, chat_messages, is_first_message, hold["hold_id"], daily_used, idempotency),
+                media_type="text/event-stream",
+                headers=SSE_HEADERS
+            )
         
         # Call OpenAI API with chat context
         from app.services.openai_client import chat_completion
-        response = await chat_completion(chat_messages)
-        
-        # Charge tokens first (before saving assistant message)
-        from app.services.wallet import charge_tokens, create_usage_record
-        from app.services.wallet_events import create_chat_expense_event
-        charge_result = charge_tokens(
-            db, 
-            current_user, 
-            response["usage"]["total_tokens"],
-            request.prefer_communal
+        response = await run_unless_disconnected(
+            http_request, chat_completion(chat_messages, user_id=current_user, role_name=role_name)
         )
         
-        # Create usage record (NO CHAT CONTENT)
-        create_usage_record(
-            db,
-            current_user,
-            response["usage"],
-            charge_result["transaction_id"]
-        )
-        
-        # Create wallet event for chat expense
-        create_chat_expense_event(
-            db,
-            current_user,
-            response["usage"]["total_tokens"],
-            str(chat_id),
-            request.prefer_communal
-        )
+        charge_result, events = await db.run_sync(_bill_and_save_reply, chat, current_user, request, response, is_first_message, hold["hold_id"], daily_used)
+        await db.commit()
+        await after_wallet_change(current_user, charge_result, events)
         
-        # Save assistant message
-        assistant_message = ChatMessage(
-            chat_id=chat_id,
-            role="assistant",
-            content=response["message"]["content"]
-        )
-        db.add(assistant_message)
-        
-        # Update chat title if first message
-        if len(chat.messages) == 0:
-            chat.title = request.message[:50] + ("..." if len(request.message) > 50 else "")
-        
-        db.commit()
-        
-        return {
+        reply = {
             "message": response["message"],
             "usage": response["usage"],
             "wallet_updated": True
         }
+        await idempotency.finish(reply)
+        return reply
         
     except Exception as e:
-        db.rollback()
+        await _release_after_failure(db, current_user, hold["hold_id"])
+        await idempotency.abandon()
         if "Insufficient funds" in str(e):
             raise HTTPException(status_code=402, detail="insufficient_funds")
+        if isinstance(e, UpstreamBusy):
+            raise HTTPException(status_code=503, detail="upstream_busy", headers={"Retry-After": str(e.retry_after)})
+        if isinstance(e, ClientDisconnected):
+            raise HTTPException(status_code=499, detail="client_closed_request")
+        if isinstance(e, DeadlineExceeded):
+            raise
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.delete("/{chat_id}")
 async def delete_chat(
     chat_id: str,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: str = Depends(get_current_user)
 ):
-    """Delete chat"""
-    chat = db.query(Chat).filter(Chat.id == chat_id, Chat.user_id == current_user).first()
-    if not chat:
+    """Delete chat (hidden at once; its messages are purged in the background, see services/purge)"""
+    result = await db.execute(
+        update(Chat)
+        .where(Chat.id == chat_id, Chat.user_id == current_user, Chat.deleted_at.is_(None))
+        .values(deleted_at=func.current_timestamp())
+    )
+    if not result.rowcount:
         raise HTTPException(status_code=404, detail="Chat not found")
-    
-    db.delete(chat)
-    db.commit()
+    await db.commit()
     
     return {"success": True}
\ No newline at end of file
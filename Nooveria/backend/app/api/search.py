@@ -0,0 +1,43 @@
+from fastapi import APIRouter, Depends, HTTPException, Header
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Optional
+from app.database import get_async_db
+from app.services.auth import verify_token
+from app.services.search import search_messages, search_limit
+
+router = APIRouter()
+
+def get_current_user(authorization: Optional[str] = Header(None)):
+    if not authorization or not authorization.startswith("Bearer "):
+        raise HTTPException(status_code=401, detail="Missing token")
+    
+    token = authorization.split(" ")[1]
+    payload = verify_token(token)
+    if not payload:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    
+    return payload["sub"]
+
+@router.get("")
+async def search(
+    q: str,
+    before: Optional[str] = None,
+    limit: Optional[int] = None,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: str = Depends(get_current_user)
+):
+    """Search the user's chat and world chat messages: best matches first, snippets with <mark>ed terms (before=next_before for the next page)"""
+    try:
+        results, next_before = await search_messages(db, current_user, q, before, search_limit(limit))
+    except Exception as e:
+        if "Invalid search query" in str(e):
+            raise HTTPException(status_code=400, detail="invalid_search_query")
+        if "Invalid cursor" in str(e):
+            raise HTTPException(status_code=400, detail="invalid_cursor")
+        raise
+    
+    return {
+        "results": results,
+        "has_more": next_before is not None,
+        "next_before": next_before
+    }
@@ -29,7 +29,7 @@ async def change_password(
         client_ip = req.client.host if req else "unknown"
         
         # Rate limiting
-        allowed, wait_time = security_manager.check_rate_limit(
+        allowed, wait_time = await security_manager.check_rate_limit(
             f"{current_user.id}:{client_ip}", "password_change"
         )
         if not allowed:
@@ -40,7 +40,7 @@ async def change_password(
         
         # Verify current password
         if not security_manager.verify_password(request.current_password, current_user.password_hash):
-            security_manager.log_security_event(
+            await security_manager.log_security_event(
                 "password_change_failed_verification",
                 str(current_user.id),
                 {"ip": client_ip}
@@ -57,7 +57,7 @@ async def change_password(
         db.commit()
         
         # Log successful password change
-        security_manager.log_security_event(
+        await security_manager.log_security_event(
             "password_changed",
             str(current_user.id),
             {"ip": client_ip}
@@ -68,7 +68,7 @@ async def change_password(
     except HTTPException:
         raise
     except Exception as e:
-        security_manager.log_security_event(
+        await security_manager.log_security_event(
             "password_change_error",
             str(current_user.id),
             {"ip": client_ip, "error": str(e)}
@@ -82,16 +82,15 @@ async def get_security_events(
 ) -> SecurityEventResponse:
     """Get recent security events (admin only)"""
     try:
-        if not security_manager.redis:
-            return SecurityEventResponse(events=[], total_count=0)
-        
         # Get events from today
         from datetime import datetime
         today = datetime.utcnow().strftime('%Y-%m-%d')
         key = f"security_events:{today}"
         
-        events = security_manager.redis.lrange(key, 0, limit - 1)
-        total_count = security_manager.redis.llen(key)
+        async with security_manager.redis.pipeline(transaction=False) as pipe:
+            pipe.lrange(key, 0, limit - 1)
+            pipe.llen(key)
+            events, total_count = await pipe.execute()
         
         # Parse events
         parsed_events = []
@@ -122,10 +121,10 @@ async def unlock_account(
         client_ip = req.client.host if req else "unknown"
         
         # Clear failed login attempts and unlock account
-        security_manager.clear_failed_logins(email)
+        await security_manager.clear_failed_logins(email)
         
         # Log admin action
-        security_manager.log_security_event(
+        await security_manager.log_security_event(
             "account_unlocked_by_admin",
             str(current_user.id),
             {"target_email": email, "ip": client_ip}
@@ -143,7 +142,7 @@ async def get_account_status(
 ):
     """Get account security status (admin only)"""
     try:
-        is_locked, unlock_time = security_manager.is_account_locked(email)
+        is_locked, unlock_time = await security_manager.is_account_locked(email)
         
         status = {
             "email": email,
@@ -151,11 +150,8 @@ async def get_account_status(
             "unlock_time": unlock_time.isoformat() if unlock_time else None
         }
         
-        if security_manager.redis:
-            # Get failed login count
-            failed_key = f"failed_login:{email}"
-            failed_attempts = security_manager.redis.get(failed_key) or 0
-            status["failed_attempts"] = int(failed_attempts)
+        # Get failed login count
+        status["failed_attempts"] = await security_manager.failed_login_count(email)
         
         return status
         
@@ -1,10 +1,13 @@
+import re
 from fastapi import APIRouter, Depends, HTTPException, Header
-from sqlalchemy.orm import Session
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from pydantic import BaseModel
 from typing import Optional
-from app.database import get_db
+from app.database import get_async_db
 from app.services.auth import verify_token
-from app.services.wallet import get_user_wallets
+from app.services.wallet import get_user_wallets_cached
 
 router = APIRouter()
 
@@ -35,12 +38,12 @@ def get_current_user(authorization: Optional[str] = Header(None)):
 
 @router.get("")
 async def get_wallets(
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: str = Depends(get_current_user)
 ):
     """Get user's wallet balances and daily communal remaining"""
     try:
-        wallets = get_user_wallets(db, current_user)
+        wallets = await get_user_wallets_cached(db, current_user)
         
         # TODO: Calculate daily_communal_remaining based on usage records
         wallets["daily_communal_remaining"] = 15000  # Placeholder
@@ -49,10 +52,30 @@ async def get_wallets(
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.get("/stream")
+async def stream_wallet(
+    current_user: str = Depends(get_current_user),
+    last_event_id: Optional[str] = Header(None)
+):
+    """
+    Server-Sent Events with balance_changed and wallet_event notifications.
+    Reconnect with the Last-Event-ID header to receive what was missed.
+    """
+    from app.services.wallet_push import stream_wallet_updates
+    
+    if last_event_id and not re.fullmatch(r"\d+-\d+", last_event_id):
+        last_event_id = None
+    
+    return StreamingResponse(
+        stream_wallet_updates(current_user, last_event_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @router.post("/transfer")
 async def transfer_tokens(
     request: TransferRequest,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: str = Depends(get_current_user)
 ):
     """Transfer tokens between users (MVP stub)"""
@@ -61,16 +84,15 @@ async def transfer_tokens(
 
 @router.get("/communal")
 async def get_communal_wallet(
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: str = Depends(get_current_user)
 ):
     """Get communal wallet balance"""
     try:
-        from app.models import Wallet, WalletType
-        communal_wallet = db.query(Wallet).filter(Wallet.type == WalletType.communal).first()
+        from app.services.communal_wallet import get_communal_balance_cached
         
         return {
-            "balance": float(communal_wallet.balance_tokens) if communal_wallet else 0,
+            "balance": await get_communal_balance_cached(db),
             "available": True
         }
     except Exception as e:
@@ -79,7 +101,7 @@ async def get_communal_wallet(
 @router.post("/topup")
 async def topup_wallet(
     request: TopupRequest,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: str = Depends(get_current_user)
 ):
     """Topup wallet (MVP stub - manual/admin only)"""
@@ -88,16 +110,18 @@ async def topup_wallet(
 
 @router.get("/events")
 async def get_wallet_events(
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: str = Depends(get_current_user),
     limit: int = 50
 ):
     """Get wallet events history"""
     from app.models import WalletEvent
     
-    events = db.query(WalletEvent).filter(
-        WalletEvent.user_id == current_user
-    ).order_by(WalletEvent.created_at.desc()).limit(limit).all()
+    events = (await db.scalars(
+        select(WalletEvent).where(
+            WalletEvent.user_id == current_user
+        ).order_by(WalletEvent.created_at.desc()).limit(limit)
+    )).all()
     
     return [
         {
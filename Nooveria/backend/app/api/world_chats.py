@@ -1,12 +1,21 @@
+import uuid
 from fastapi import APIRouter, Depends, HTTPException, Header
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from pydantic import BaseModel
 from typing import List, Optional
-from app.database import get_db
+from app.database import get_async_db
 from app.services.auth import verify_token
 from app.models import World, WorldChat, WorldChatMessage
-from app.services.wallet import charge_tokens, create_usage_record
-from app.services.wallet_events import create_world_chat_expense_event
+from app.services.wallet import charge_tokens, usage_record_values, after_wallet_change, check_request_size, estimate_request_tokens
+from app.services.tokenizer import count_tokens, count_message_tokens
+from app.services.cache import CacheService
+from app.services.wallet_events import world_chat_expense_event_values
+from app.services.ledger import record_charge
+from app.services.deadline import DeadlineExceeded
+from app.services.message_history import load_message_page, page_limit
+from app.services.chat_list import record_messages
+from app.services.world_chat import delete_world_chats
 
 router = APIRouter()
 
@@ -28,19 +37,24 @@ def get_current_user(authorization: Optional[str] = Header(None)):
 @router.get("/world-chats/{world_id}")
 async def get_world_chat(
     world_id: int,
-    db: Session = Depends(get_db),
+    before: Optional[uuid.UUID] = None,
+    limit: Optional[int] = None,
+    db: AsyncSession = Depends(get_async_db),
     current_user: str = Depends(get_current_user)
 ):
-    """Get or create world chat for user"""
-    world = db.query(World).filter(World.id == world_id).first()
+    """Get or create world chat for user, with one page of messages (newest, or older than message before)"""
+    world = await db.scalar(select(World).where(World.id == world_id, World.deleted_at.is_(None)))
     if not world:
         raise HTTPException(status_code=404, detail="World not found")
     
     # Get existing chat
-    world_chat = db.query(WorldChat).filter(
-        WorldChat.user_id == current_user,
-        WorldChat.world_id == world_id
-    ).first()
+    world_chat = await db.scalar(
+        select(WorldChat).where(
+            WorldChat.user_id == current_user,
+            WorldChat.world_id == world_id,
+            WorldChat.deleted_at.is_(None)
+        )
+    )
     
     if not world_chat:
         # Create new chat
@@ -48,11 +62,20 @@ async def get_world_chat(
             user_id=current_user,
             world_id=world_id,
             openai_thread_id=f"thread_{current_user}_{world_id}",
-            title=f"{world.name} Chat"
+            title=f"{world.name} Chat",
+            messages=[]
         )
         db.add(world_chat)
-        db.commit()
-        db.refresh(world_chat)
+        await db.commit()
+    
+    try:
+        page, has_more = await load_message_page(
+            db, WorldChatMessage, WorldChatMessage.world_chat_id, world_chat.id, before, page_limit(limit)
+        )
+    except Exception as e:
+        if "Invalid cursor" in str(e):
+            raise HTTPException(status_code=400, detail="invalid_cursor")
+        raise
     
     messages = [
         {
@@ -61,47 +84,58 @@ async def get_world_chat(
             "content": msg.content,
             "created_at": msg.created_at.isoformat()
         }
-        for msg in world_chat.messages
+        for msg in page
     ]
     
     return {
         "id": str(world_chat.id),
         "title": world_chat.title,
-        "messages": messages
+        "messages": messages,
+        "has_more": has_more,
+        "next_before": messages[0]["id"] if has_more else None
     }
 
 @router.post("/world-chats/{world_id}/message")
 async def send_world_chat_message(
     world_id: int,
     request: WorldChatRequest,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: str = Depends(get_current_user)
 ):
     """Send message to world chat"""
-    world = db.query(World).filter(World.id == world_id).first()
+    world = await db.scalar(select(World).where(World.id == world_id, World.deleted_at.is_(None)))
     if not world:
         raise HTTPException(status_code=404, detail="World not found")
     
     # Get or create chat
-    world_chat = db.query(WorldChat).filter(
-        WorldChat.user_id == current_user,
-        WorldChat.world_id == world_id
-    ).first()
+    world_chat = await db.scalar(
+        select(WorldChat).where(
+            WorldChat.user_id == current_user,
+            WorldChat.world_id == world_id,
+            WorldChat.deleted_at.is_(None)
+        )
+    )
     
     if not world_chat:
         world_chat = WorldChat(
             user_id=current_user,
             world_id=world_id,
             openai_thread_id=f"thread_{current_user}_{world_id}",
-            title=f"{world.name} Chat"
+            title=f"{world.name} Chat",
+            messages=[]
         )
         db.add(world_chat)
-        db.flush()
+        await db.flush()
     
     try:
+        # Reject oversized messages before anything is generated or charged
+        prompt_messages = [{"role": "user", "content": request.message}]
+        await db.run_sync(check_request_size, current_user, estimate_request_tokens(prompt_messages))
+        
         # Save user message
         user_message = WorldChatMessage(
             world_chat_id=world_chat.id,
+            user_id=world_chat.user_id,
             role="user",
             content=request.message
         )
@@ -113,43 +147,51 @@ async def send_world_chat_message(
         # Save assistant message
         assistant_message = WorldChatMessage(
             world_chat_id=world_chat.id,
+            user_id=world_chat.user_id,
             role="assistant",
             content=response_text
         )
         db.add(assistant_message)
         
         # Update title if first message
-        if len(world_chat.messages) == 0:
+        if not world_chat.message_count:
             world_chat.title = request.message[:50] + ("..." if len(request.message) > 50 else "")
+        record_messages(world_chat, 2, response_text)
         
-        # Charge tokens
-        estimated_tokens = 50
-        charge_result = charge_tokens(
-            db, 
+        # Charge the counted prompt and reply tokens
+        prompt_tokens = count_message_tokens(prompt_messages)
+        completion_tokens = count_tokens(response_text)
+        estimated_tokens = prompt_tokens + completion_tokens
+        daily_used = await CacheService.get_daily_usage(current_user) if request.prefer_communal else 0
+        charge_result = await db.run_sync(
+            charge_tokens,
             current_user, 
             estimated_tokens,
-            request.prefer_communal
+            request.prefer_communal,
+            defer_transaction=True,
+            daily_used=daily_used
         )
         
-        # Create usage record
-        create_usage_record(
-            db,
-            current_user,
-            {"total_tokens": estimated_tokens, "prompt_tokens": 25, "completion_tokens": 25},
-            charge_result["transaction_id"]
-        )
-        
-        # Create wallet event
-        create_world_chat_expense_event(
-            db,
+        # Transaction, usage record and wallet event go to the ledger
+        events = [world_chat_expense_event_values(
             current_user,
             estimated_tokens,
             world_id,
             world.name,
-            request.prefer_communal
+            charge_result["charged_from"] == "communal"
+        )]
+        await db.run_sync(
+            record_charge,
+            charge_result["transaction"],
+            usage_record_values(
+                current_user,
+                {"total_tokens": estimated_tokens, "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens}
+            ),
+            events
         )
         
-        db.commit()
+        await db.commit()
+        await after_wallet_change(current_user, charge_result, events)
         print(f"World chat message sent successfully, tokens charged: {estimated_tokens}")
         
         return {
@@ -162,25 +204,23 @@ async def send_world_chat_message(
         }
         
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         if "Insufficient funds" in str(e):
             raise HTTPException(status_code=402, detail="insufficient_funds")
+        if "Request too large" in str(e):
+            raise HTTPException(status_code=413, detail="request_too_large")
+        if isinstance(e, DeadlineExceeded):
+            raise
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.delete("/world-chats/{world_id}")
 async def delete_world_chat(
     world_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: str = Depends(get_current_user)
 ):
-    """Delete world chat"""
-    world_chat = db.query(WorldChat).filter(
-        WorldChat.user_id == current_user,
-        WorldChat.world_id == world_id
-    ).first()
-    
-    if world_chat:
-        db.delete(world_chat)
-        db.commit()
+    """Delete world chat (hidden at once; its messages are purged in the background)"""
+    await db.run_sync(delete_world_chats, WorldChat.user_id == current_user, WorldChat.world_id == world_id)
+    await db.commit()
     
     return {"message": "World chat deleted"}
\ No newline at end of file
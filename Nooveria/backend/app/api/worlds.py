@@ -1,19 +1,30 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Request
-from sqlalchemy.orm import Session
-from typing import List
+from fastapi import APIRouter, Depends, HTTPException, status, Request, Header
+from fastapi.responses import JSONResponse
+from sqlalchemy import select, update, func
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+from typing import List, Optional
 from pydantic import BaseModel
 
-from app.database import get_db
+from app.database import get_async_db
 from app.models import World, UserWorld, User, WorldChat, WorldChatMessage
 from app.services.auth import verify_token
-from app.services.world_chat import send_world_message, delete_all_world_chats
+from app.services.world_chat import send_world_message, delete_world_chats
+from app.services.deadline import DeadlineExceeded
+from app.services.idempotency import IdempotentRequest, IdempotencyConflict, IdempotencyInProgress
+from app.services.message_history import load_message_page, page_limit
+from app.services.chat_list import load_chat_page, list_limit
 import time
-from app.services.wallet import charge_tokens, create_usage_record
-from app.services.wallet_events import create_world_chat_expense_event
+import uuid
+from app.services.wallet import charge_tokens, usage_record_values, after_wallet_change, check_request_size, estimate_request_tokens
+from app.services.tokenizer import count_tokens, count_message_tokens
+from app.services.cache import CacheService
+from app.services.wallet_events import world_chat_expense_event_values
+from app.services.ledger import record_charge
 
 router = APIRouter()
 
-def get_current_user(request: Request, db: Session = Depends(get_db)) -> User:
+async def get_current_user(request: Request, db: AsyncSession = Depends(get_async_db)) -> User:
     auth_header = request.headers.get("Authorization")
     if not auth_header or not auth_header.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Not authenticated")
@@ -23,7 +34,7 @@ def get_current_user(request: Request, db: Session = Depends(get_db)) -> User:
     if not payload:
         raise HTTPException(status_code=401, detail="Invalid token")
     
-    user = db.query(User).filter(User.id == payload["sub"]).first()
+    user = await db.scalar(select(User).options(selectinload(User.role)).where(User.id == payload["sub"]))
     if not user:
         raise HTTPException(status_code=401, detail="User not found")
     
@@ -34,6 +45,7 @@ class WorldCreate(BaseModel):
     description: str
     assistant_id: str
     image_url: str = None
+    response_cache_enabled: bool = False
 
 class WorldResponse(BaseModel):
     id: int
@@ -43,6 +55,7 @@ class WorldResponse(BaseModel):
     image_url: str = None
     tokens_spent: int = 0
     is_active: bool
+    response_cache_enabled: bool = False
 
 class UserWorldResponse(BaseModel):
     id: int
@@ -52,7 +65,7 @@ class UserWorldResponse(BaseModel):
 @router.post("/worlds", response_model=WorldResponse)
 async def create_world(
     world_data: WorldCreate,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_user)
 ):
     try:
@@ -63,23 +76,26 @@ async def create_world(
             name=world_data.name,
             description=world_data.description,
             assistant_id=world_data.assistant_id,
-            image_url=world_data.image_url
+            image_url=world_data.image_url,
+            response_cache_enabled=world_data.response_cache_enabled
         )
         db.add(world)
-        db.commit()
-        db.refresh(world)
+        await db.commit()
+        await db.refresh(world)
         return world
     except HTTPException:
         raise
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         print(f"Error creating world: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/worlds", response_model=List[WorldResponse])
-async def get_worlds(db: Session = Depends(get_db)):
+async def get_worlds(db: AsyncSession = Depends(get_async_db)):
     try:
-        worlds = db.query(World).filter(World.is_active == True).order_by(World.tokens_spent.desc()).all()
+        worlds = (await db.scalars(
+            select(World).where(World.is_active == True, World.deleted_at.is_(None)).order_by(World.tokens_spent.desc())
+        )).all()
         return worlds
     except Exception as e:
         print(f"Error getting worlds: {e}")
@@ -87,25 +103,28 @@ async def get_worlds(db: Session = Depends(get_db)):
 
 @router.get("/user-worlds", response_model=List[UserWorldResponse])
 async def get_user_worlds(
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_user)
 ):
-    user_worlds = db.query(UserWorld).filter(
-        UserWorld.user_id == current_user.id,
-        UserWorld.is_pinned == True
-    ).all()
+    user_worlds = (await db.scalars(
+        select(UserWorld).join(UserWorld.world).options(selectinload(UserWorld.world)).where(
+            UserWorld.user_id == current_user.id,
+            UserWorld.is_pinned == True,
+            World.deleted_at.is_(None)
+        )
+    )).all()
     return user_worlds
 
 @router.post("/worlds/{world_id}/pin")
 async def pin_world(
     world_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_user)
 ):
-    existing = db.query(UserWorld).filter(
+    existing = await db.scalar(select(UserWorld).where(
         UserWorld.user_id == current_user.id,
         UserWorld.world_id == world_id
-    ).first()
+    ))
     
     if existing:
         existing.is_pinned = True
@@ -117,65 +136,59 @@ async def pin_world(
         )
         db.add(user_world)
     
-    db.commit()
+    await db.commit()
     return {"message": "World pinned"}
 
 @router.delete("/worlds/{world_id}/unpin")
 async def unpin_world(
     world_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_user)
 ):
-    user_world = db.query(UserWorld).filter(
+    user_world = await db.scalar(select(UserWorld).where(
         UserWorld.user_id == current_user.id,
         UserWorld.world_id == world_id
-    ).first()
+    ))
     
     if user_world:
         user_world.is_pinned = False
         
         # Delete world chat when unpinning
-        world_chat = db.query(WorldChat).filter(
+        world_chat = await db.scalar(select(WorldChat).where(
             WorldChat.user_id == current_user.id,
-            WorldChat.world_id == world_id
-        ).first()
+            WorldChat.world_id == world_id,
+            WorldChat.deleted_at.is_(None)
+        ))
         
         if world_chat:
-            from app.services.world_chat import delete_world_chat
-            delete_world_chat(db, world_chat)
+            await db.run_sync(delete_world_chats, WorldChat.id == world_chat.id)
         
-        db.commit()
+        await db.commit()
     
     return {"message": "World unpinned"}
 
 @router.delete("/worlds/{world_id}")
 async def delete_world(
     world_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_user)
 ):
     try:
         if current_user.role.name != "admin":
             raise HTTPException(status_code=403, detail="Admin access required")
         
-        world = db.query(World).filter(World.id == world_id).first()
-        if not world:
+        # Hidden at once; its chats, their messages and the pins are purged in the background (services/purge)
+        result = await db.execute(
+            update(World).where(World.id == world_id, World.deleted_at.is_(None)).values(deleted_at=func.now())
+        )
+        if not result.rowcount:
             raise HTTPException(status_code=404, detail="World not found")
-        
-        # Delete all world chats first
-        delete_all_world_chats(db, world_id)
-        
-        # Delete user_worlds manually
-        db.query(UserWorld).filter(UserWorld.world_id == world_id).delete()
-        
-        # Delete world
-        db.delete(world)
-        db.commit()
+        await db.commit()
         return {"message": "World deleted"}
     except HTTPException:
         raise
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         print(f"Error deleting world: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -183,37 +196,50 @@ class WorldChatMessageRequest(BaseModel):
     message: str
     prefer_communal: bool = False
 
+async def _world_chat_page(db: AsyncSession, user_id, world_id: int, before: Optional[uuid.UUID], limit: Optional[int]) -> list:
+    """A page of the user's chats in the world, most recently active first - one index scan, no message loading"""
+    try:
+        return await load_chat_page(
+            db, WorldChat, [WorldChat.user_id == user_id, WorldChat.world_id == world_id, WorldChat.deleted_at.is_(None)],
+            before, list_limit(limit)
+        )
+    except Exception as e:
+        if "Invalid cursor" in str(e):
+            raise HTTPException(status_code=400, detail="invalid_cursor")
+        raise
+
+def _world_chat_summary(chat: WorldChat) -> dict:
+    return {
+        "id": str(chat.id),
+        "title": chat.title,
+        "created_at": chat.created_at.isoformat(),
+        "updated_at": chat.updated_at.isoformat(),
+        "message_count": chat.message_count,
+        "last_message_at": chat.last_message_at.isoformat() if chat.last_message_at else None,
+        "last_message_preview": chat.last_message_preview
+    }
+
 @router.get("/worlds/{world_id}/chats")
 async def get_world_conversations(
     world_id: int,
-    db: Session = Depends(get_db),
+    before: Optional[uuid.UUID] = None,
+    limit: Optional[int] = None,
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_user)
 ):
-    """Get all conversations for a world"""
-    world_chats = db.query(WorldChat).filter(
-        WorldChat.user_id == current_user.id,
-        WorldChat.world_id == world_id
-    ).order_by(WorldChat.updated_at.desc()).all()
+    """Get a page of conversations for a world (before=<last chat id> for the next page)"""
+    chats = await _world_chat_page(db, current_user.id, world_id, before, limit)
     
-    return [
-        {
-            "id": str(chat.id),
-            "title": chat.title,
-            "created_at": chat.created_at.isoformat(),
-            "updated_at": chat.updated_at.isoformat(),
-            "message_count": len(chat.messages)
-        }
-        for chat in world_chats
-    ]
+    return [_world_chat_summary(chat) for chat in chats]
 
 @router.post("/worlds/{world_id}/chats")
 async def create_world_conversation(
     world_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_user)
 ):
     """Create new world conversation"""
-    world = db.query(World).filter(World.id == world_id).first()
+    world = await db.scalar(select(World).where(World.id == world_id, World.deleted_at.is_(None)))
     if not world:
         raise HTTPException(status_code=404, detail="World not found")
     
@@ -224,8 +250,8 @@ async def create_world_conversation(
         title=f"New {world.name} Chat"
     )
     db.add(world_chat)
-    db.commit()
-    db.refresh(world_chat)
+    await db.commit()
+    await db.refresh(world_chat)
     
     return {
         "id": str(world_chat.id),
@@ -240,50 +266,91 @@ async def send_world_message_to_conversation(
     world_id: int,
     chat_id: str,
     message_data: WorldChatMessageRequest,
-    db: Session = Depends(get_db),
+    idempotency_key: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_user)
 ):
-    world_chat = db.query(WorldChat).filter(
-        WorldChat.id == chat_id,
-        WorldChat.user_id == current_user.id,
-        WorldChat.world_id == world_id
-    ).first()
+    """Send a message (retries with the same Idempotency-Key get the stored reply)"""
+    world_chat = await db.scalar(
+        select(WorldChat).join(WorldChat.world).where(
+            WorldChat.id == chat_id,
+            WorldChat.user_id == current_user.id,
+            WorldChat.world_id == world_id,
+            WorldChat.deleted_at.is_(None),
+            World.deleted_at.is_(None)
+        )
+    )
     
     if not world_chat:
         raise HTTPException(status_code=404, detail="Conversation not found")
     
+    idempotency = IdempotentRequest(
+        idempotency_key, str(current_user.id), f"worlds/{world_id}/chats/{chat_id}", message_data.model_dump()
+    )
+    try:
+        stored = await idempotency.begin()
+    except Exception as e:
+        if isinstance(e, IdempotencyConflict):
+            raise HTTPException(status_code=422, detail="idempotency_key_reused")
+        if isinstance(e, IdempotencyInProgress):
+            raise HTTPException(status_code=409, detail="request_in_progress")
+        if "Invalid idempotency key" in str(e):
+            raise HTTPException(status_code=400, detail="invalid_idempotency_key")
+        raise
+    if stored is not None:
+        return JSONResponse(stored, headers={"Idempotent-Replayed": "true"})
+    
     try:
-        response = send_world_message(db, world_chat, message_data.message)
+        # Reject oversized messages before anything is generated or charged
+        prompt_messages = [{"role": "user", "content": message_data.message}]
+        await db.run_sync(check_request_size, str(current_user.id), estimate_request_tokens(prompt_messages))
         
-        estimated_tokens = len(message_data.message) // 4 + len(response["response"]) // 4
-        charge_result = charge_tokens(
-            db, 
+        response = await db.run_sync(send_world_message, world_chat, message_data.message)
+        
+        prompt_tokens = count_message_tokens(prompt_messages)
+        completion_tokens = count_tokens(response["response"])
+        estimated_tokens = prompt_tokens + completion_tokens
+        daily_used = await CacheService.get_daily_usage(str(current_user.id)) if message_data.prefer_communal else 0
+        charge_result = await db.run_sync(
+            charge_tokens,
             str(current_user.id), 
             estimated_tokens,
-            message_data.prefer_communal
+            message_data.prefer_communal,
+            defer_transaction=True,
+            daily_used=daily_used
         )
         
-        create_usage_record(
-            db,
-            str(current_user.id),
-            {"total_tokens": estimated_tokens, "prompt_tokens": len(message_data.message) // 4, "completion_tokens": len(response["response"]) // 4},
-            charge_result["transaction_id"]
-        )
-        
-        create_world_chat_expense_event(
-            db,
+        events = [world_chat_expense_event_values(
             str(current_user.id),
             estimated_tokens,
             world_id,
-            response["world_name"]
+            response["world_name"],
+            charge_result["charged_from"] == "communal"
+        )]
+        await db.run_sync(
+            record_charge,
+            charge_result["transaction"],
+            usage_record_values(
+                str(current_user.id),
+                {"total_tokens": estimated_tokens, "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens}
+            ),
+            events
         )
+        await db.commit()
+        await after_wallet_change(str(current_user.id), charge_result, events)
         
+        await idempotency.finish(response)
         return response
         
     except Exception as e:
-        db.rollback()
+        await db.rollback()
+        await idempotency.abandon()
         if "Insufficient funds" in str(e):
             raise HTTPException(status_code=402, detail="insufficient_funds")
+        if "Request too large" in str(e):
+            raise HTTPException(status_code=413, detail="request_too_large")
+        if isinstance(e, DeadlineExceeded):
+            raise
         raise HTTPException(status_code=500, detail=f"Chat failed: {str(e)}")
 
 class WorldChatResponse(BaseModel):
@@ -292,6 +359,8 @@ class WorldChatResponse(BaseModel):
     created_at: str
     updated_at: str
     message_count: int
+    last_message_at: Optional[str] = None
+    last_message_preview: Optional[str] = None
 
 class WorldChatMessageResponse(BaseModel):
     id: str
@@ -303,47 +372,55 @@ class WorldChatDetailResponse(BaseModel):
     id: str
     title: str
     messages: List[WorldChatMessageResponse]
+    # Older messages exist; pass next_before as before= to get them
+    has_more: bool = False
+    next_before: Optional[str] = None
 
 @router.get("/worlds/{world_id}/chats", response_model=List[WorldChatResponse])
 async def get_world_chats(
     world_id: int,
-    db: Session = Depends(get_db),
+    before: Optional[uuid.UUID] = None,
+    limit: Optional[int] = None,
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_user)
 ):
-    """Get all chats for current user in specific world"""
-    world_chats = db.query(WorldChat).filter(
-        WorldChat.user_id == current_user.id,
-        WorldChat.world_id == world_id
-    ).order_by(WorldChat.updated_at.desc()).all()
+    """Get a page of chats for current user in specific world"""
+    chats = await _world_chat_page(db, current_user.id, world_id, before, limit)
     
-    return [
-        WorldChatResponse(
-            id=str(chat.id),
-            title=chat.title,
-            created_at=chat.created_at.isoformat(),
-            updated_at=chat.updated_at.isoformat(),
-            message_count=len(chat.messages)
-        )
-        for chat in world_chats
-    ]
+    return [WorldChatResponse(**_world_chat_summary(chat)) for chat in chats]
 
 @router.get("/worlds/{world_id}/chats/{chat_id}", response_model=WorldChatDetailResponse)
 async def get_world_chat(
     world_id: int,
     chat_id: str,
-    db: Session = Depends(get_db),
+    before: Optional[uuid.UUID] = None,
+    limit: Optional[int] = None,
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_user)
 ):
-    """Get specific world chat with messages"""
-    world_chat = db.query(WorldChat).filter(
-        WorldChat.id == chat_id,
-        WorldChat.user_id == current_user.id,
-        WorldChat.world_id == world_id
-    ).first()
+    """Get specific world chat with one page of messages: the newest, or those older than message before"""
+    world_chat = await db.scalar(
+        select(WorldChat).join(WorldChat.world).where(
+            WorldChat.id == chat_id,
+            WorldChat.user_id == current_user.id,
+            WorldChat.world_id == world_id,
+            WorldChat.deleted_at.is_(None),
+            World.deleted_at.is_(None)
+        )
+    )
     
     if not world_chat:
         raise HTTPException(status_code=404, detail="World chat not found")
     
+    try:
+        page, has_more = await load_message_page(
+            db, WorldChatMessage, WorldChatMessage.world_chat_id, world_chat.id, before, page_limit(limit)
+        )
+    except Exception as e:
+        if "Invalid cursor" in str(e):
+            raise HTTPException(status_code=400, detail="invalid_cursor")
+        raise
+    
     messages = [
         WorldChatMessageResponse(
             id=str(msg.id),
@@ -351,31 +428,33 @@ async def get_world_chat(
             content=msg.content,
             created_at=msg.created_at.isoformat()
         )
-        for msg in world_chat.messages
+        for msg in page
     ]
     
     return WorldChatDetailResponse(
         id=str(world_chat.id),
         title=world_chat.title,
-        messages=messages
+        messages=messages,
+        has_more=has_more,
+        next_before=messages[0].id if has_more else None
     )
 
 @router.delete("/worlds/{world_id}/chat")
 async def delete_user_world_chat(
     world_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_user)
 ):
     """Delete user's world chat (when unpinning from sidebar)"""
-    world_chat = db.query(WorldChat).filter(
+    world_chat = await db.scalar(select(WorldChat).where(
         WorldChat.user_id == current_user.id,
-        WorldChat.world_id == world_id
-    ).first()
+        WorldChat.world_id == world_id,
+        WorldChat.deleted_at.is_(None)
+    ))
     
     if world_chat:
-        from app.services.world_chat import delete_world_chat
-        delete_world_chat(db, world_chat)
-        db.commit()
+        await db.run_sync(delete_world_chats, WorldChat.id == world_chat.id)
+        await db.commit()
     
     return {"message": "World chat deleted"}
 
@@ -383,40 +462,36 @@ async def delete_user_world_chat(
 async def delete_world_chat_endpoint(
     world_id: int,
     chat_id: str,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_user)
 ):
     """Delete specific world chat"""
-    world_chat = db.query(WorldChat).filter(
+    deleted = await db.run_sync(
+        delete_world_chats,
         WorldChat.id == chat_id,
         WorldChat.user_id == current_user.id,
         WorldChat.world_id == world_id
-    ).first()
+    )
     
-    if not world_chat:
+    if not deleted:
         raise HTTPException(status_code=404, detail="World chat not found")
     
-    from app.services.world_chat import delete_world_chat
-    delete_world_chat(db, world_chat)
-    db.commit()
+    await db.commit()
     
     return {"message": "World chat deleted"}
 
 @router.delete("/worlds/{world_id}/chats")
 async def delete_all_user_world_chats(
     world_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_user)
 ):
-    """Delete all chats for current user in specific world"""
-    world_chats = db.query(WorldChat).filter(
+    """Delete all chats for current user in specific world (one UPDATE; the rows are purged in the background)"""
+    deleted = await db.run_sync(
+        delete_world_chats,
         WorldChat.user_id == current_user.id,
         WorldChat.world_id == world_id
-    ).all()
-    
-    from app.services.world_chat import delete_world_chat
-    for world_chat in world_chats:
-        delete_world_chat(db, world_chat)
+    )
     
-    db.commit()
-    return {"message": f"Deleted {len(world_chats)} world chats"}
\ No newline at end of file
+    await db.commit()
+    return {"message": f"Deleted {deleted} world chats"}
\ No newline at end of file
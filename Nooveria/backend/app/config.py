@@ -40,22 +40,137 @@ class Config:
     TOKEN_PRICE_PER_1K = safe_float.__func__(os.getenv("TOKEN_PRICE_PER_1K", "0.003"), 0.003)
     OPENAI_COST_PER_1K = safe_float.__func__(os.getenv("OPENAI_COST_PER_1K", "0.002"), 0.002)
     
+    # Communal wallet striping (spreads communal withdrawals over several rows)
+    COMMUNAL_WALLET_STRIPES = safe_int.__func__(os.getenv("COMMUNAL_WALLET_STRIPES", "8"), 8)
+    COMMUNAL_REBALANCE_INTERVAL = safe_int.__func__(os.getenv("COMMUNAL_REBALANCE_INTERVAL", "60"), 60)
+    
+    # Pre-authorisation holds (reserve before the upstream call, settle after)
+    HOLD_TTL_SECONDS = safe_int.__func__(os.getenv("HOLD_TTL_SECONDS", "120"), 120)
+    HOLD_COMPLETION_TOKENS = safe_int.__func__(os.getenv("HOLD_COMPLETION_TOKENS", "500"), 500)
+    HOLD_EXPIRY_INTERVAL = safe_int.__func__(os.getenv("HOLD_EXPIRY_INTERVAL", "30"), 30)
+    
+    # Write-behind ledger (Transaction/UsageRecord/WalletEvent rows batched behind a WAL file)
+    LEDGER_WRITE_BEHIND = os.getenv("LEDGER_WRITE_BEHIND", "true").lower() == "true"
+    # Must outlive the container: a volume of its own (see docker-compose.yml)
+    LEDGER_WAL_DIR = os.path.abspath(os.getenv("LEDGER_WAL_DIR", "/var/lib/nooveria/ledger_wal"))
+    LEDGER_FLUSH_INTERVAL = safe_float.__func__(os.getenv("LEDGER_FLUSH_INTERVAL", "0.5"), 0.5)
+    LEDGER_BATCH_SIZE = safe_int.__func__(os.getenv("LEDGER_BATCH_SIZE", "200"), 200)
+    
+    # Shared async Redis pool (cache, rate limiting, security events)
+    REDIS_MAX_CONNECTIONS = safe_int.__func__(os.getenv("REDIS_MAX_CONNECTIONS", "50"), 50)
+    REDIS_POOL_TIMEOUT = safe_float.__func__(os.getenv("REDIS_POOL_TIMEOUT", "5"), 5.0)
+    REDIS_SOCKET_TIMEOUT = safe_float.__func__(os.getenv("REDIS_SOCKET_TIMEOUT", "2"), 2.0)
+    
+    # In-process wallet cache in front of Redis (invalidated over pub/sub)
+    WALLET_LOCAL_CACHE_SIZE = safe_int.__func__(os.getenv("WALLET_LOCAL_CACHE_SIZE", "10000"), 10000)
+    WALLET_LOCAL_CACHE_TTL = safe_float.__func__(os.getenv("WALLET_LOCAL_CACHE_TTL", "30"), 30.0)
+    COMMUNAL_LOCAL_CACHE_TTL = safe_float.__func__(os.getenv("COMMUNAL_LOCAL_CACHE_TTL", "5"), 5.0)
+    
+    # Wallet push stream (GET /api/wallets/stream)
+    WALLET_PUSH_HEARTBEAT = safe_float.__func__(os.getenv("WALLET_PUSH_HEARTBEAT", "15"), 15.0)
+    WALLET_PUSH_REPLAY = safe_int.__func__(os.getenv("WALLET_PUSH_REPLAY", "100"), 100)
+    WALLET_PUSH_TTL = safe_int.__func__(os.getenv("WALLET_PUSH_TTL", "3600"), 3600)
+    WALLET_PUSH_QUEUE_SIZE = safe_int.__func__(os.getenv("WALLET_PUSH_QUEUE_SIZE", "100"), 100)
+    WALLET_PUSH_RETRY_MS = safe_int.__func__(os.getenv("WALLET_PUSH_RETRY_MS", "3000"), 3000)
+    
+    # Chat context window (older turns are folded into a rolling summary)
+    CHAT_SUMMARY_MIN_TOKENS = safe_int.__func__(os.getenv("CHAT_SUMMARY_MIN_TOKENS", "300"), 300)
+    CHAT_SUMMARY_CHUNK_TOKENS = safe_int.__func__(os.getenv("CHAT_SUMMARY_CHUNK_TOKENS", "3000"), 3000)
+    CHAT_CONTEXT_PAGE_SIZE = safe_int.__func__(os.getenv("CHAT_CONTEXT_PAGE_SIZE", "20"), 20)
+    
+    # Exact-match cache for upstream completions (opt-in per world)
+    RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() == "true"
+    RESPONSE_CACHE_TTL = safe_int.__func__(os.getenv("RESPONSE_CACHE_TTL", "86400"), 86400)
+    RESPONSE_CACHE_LOCAL_SIZE = safe_int.__func__(os.getenv("RESPONSE_CACHE_LOCAL_SIZE", "1000"), 1000)
+    RESPONSE_CACHE_LOCAL_TTL = safe_float.__func__(os.getenv("RESPONSE_CACHE_LOCAL_TTL", "600"), 600.0)
+    RESPONSE_CACHE_BILLING_RATIO = safe_float.__func__(os.getenv("RESPONSE_CACHE_BILLING_RATIO", "0.5"), 0.5)
+    RESPONSE_COALESCE_LOCK_TTL = safe_int.__func__(os.getenv("RESPONSE_COALESCE_LOCK_TTL", "30"), 30)
+    RESPONSE_COALESCE_POLL_INTERVAL = safe_float.__func__(os.getenv("RESPONSE_COALESCE_POLL_INTERVAL", "0.1"), 0.1)
+    
+    # Upstream admission (per worker): concurrency caps and how long a request may queue
+    UPSTREAM_MAX_CONCURRENCY = safe_int.__func__(os.getenv("UPSTREAM_MAX_CONCURRENCY", "50"), 50)
+    UPSTREAM_PER_USER_INFLIGHT = safe_int.__func__(os.getenv("UPSTREAM_PER_USER_INFLIGHT", "2"), 2)
+    UPSTREAM_QUEUE_DEADLINE = safe_float.__func__(os.getenv("UPSTREAM_QUEUE_DEADLINE", "10"), 10.0)
+    
+    # Upstream routing over OPENAI_API_KEYS / OPENAI_BASE_URLS: retries, breakers, backoff
+    UPSTREAM_MAX_ATTEMPTS = safe_int.__func__(os.getenv("UPSTREAM_MAX_ATTEMPTS", "3"), 3)
+    UPSTREAM_BREAKER_THRESHOLD = safe_int.__func__(os.getenv("UPSTREAM_BREAKER_THRESHOLD", "5"), 5)
+    UPSTREAM_BREAKER_COOLDOWN = safe_float.__func__(os.getenv("UPSTREAM_BREAKER_COOLDOWN", "30"), 30.0)
+    UPSTREAM_BREAKER_MAX_COOLDOWN = safe_float.__func__(os.getenv("UPSTREAM_BREAKER_MAX_COOLDOWN", "300"), 300.0)
+    UPSTREAM_BACKOFF_BASE = safe_float.__func__(os.getenv("UPSTREAM_BACKOFF_BASE", "0.5"), 0.5)
+    UPSTREAM_BACKOFF_MAX = safe_float.__func__(os.getenv("UPSTREAM_BACKOFF_MAX", "10"), 10.0)
+    UPSTREAM_RETRY_JITTER = safe_float.__func__(os.getenv("UPSTREAM_RETRY_JITTER", "0.2"), 0.2)
+    
+    # Hedged upstream calls (second attempt once a call is slower than the recent percentile)
+    UPSTREAM_HEDGING = os.getenv("UPSTREAM_HEDGING", "false").lower() == "true"
+    UPSTREAM_HEDGE_PERCENTILE = safe_float.__func__(os.getenv("UPSTREAM_HEDGE_PERCENTILE", "95"), 95.0)
+    UPSTREAM_HEDGE_MIN_DELAY = safe_float.__func__(os.getenv("UPSTREAM_HEDGE_MIN_DELAY", "0.5"), 0.5)
+    UPSTREAM_HEDGE_MIN_SAMPLES = safe_int.__func__(os.getenv("UPSTREAM_HEDGE_MIN_SAMPLES", "20"), 20)
+    UPSTREAM_HEDGE_WINDOW = safe_int.__func__(os.getenv("UPSTREAM_HEDGE_WINDOW", "200"), 200)
+    UPSTREAM_HEDGE_BUDGET = safe_float.__func__(os.getenv("UPSTREAM_HEDGE_BUDGET", "0.05"), 0.05)
+    UPSTREAM_HEDGE_BURST = safe_int.__func__(os.getenv("UPSTREAM_HEDGE_BURST", "5"), 5)
+    
+    # How often a waiting non-streaming request checks whether its client is still there
+    DISCONNECT_POLL_INTERVAL = safe_float.__func__(os.getenv("DISCONNECT_POLL_INTERVAL", "0.5"), 0.5)
+    
+    # Request deadlines (seconds); chat routes wait on the LLM and get longer
+    REQUEST_DEADLINE = safe_float.__func__(os.getenv("REQUEST_DEADLINE", "10"), 10.0)
+    CHAT_REQUEST_DEADLINE = safe_float.__func__(os.getenv("CHAT_REQUEST_DEADLINE", "60"), 60.0)
+    DEADLINE_MIN_STAGE = safe_float.__func__(os.getenv("DEADLINE_MIN_STAGE", "0.05"), 0.05)
+    # An upstream call isn't started with less than this left; each attempt times out after UPSTREAM_TIMEOUT
+    UPSTREAM_MIN_BUDGET = safe_float.__func__(os.getenv("UPSTREAM_MIN_BUDGET", "1.0"), 1.0)
+    UPSTREAM_TIMEOUT = safe_float.__func__(os.getenv("UPSTREAM_TIMEOUT", "30"), 30.0)
+    
+    # Idempotency-Key for chat messages: how long replies are kept for retries,
+    # how long a request may hold its key (covers a full stream) and how often duplicates poll
+    IDEMPOTENCY_TTL = safe_int.__func__(os.getenv("IDEMPOTENCY_TTL", "86400"), 86400)
+    IDEMPOTENCY_LOCK_TTL = safe_int.__func__(os.getenv("IDEMPOTENCY_LOCK_TTL", "300"), 300)
+    IDEMPOTENCY_POLL_INTERVAL = safe_float.__func__(os.getenv("IDEMPOTENCY_POLL_INTERVAL", "0.1"), 0.1)
+    
+    # Chat history pages (messages per request by default / at most)
+    MESSAGE_PAGE_SIZE = safe_int.__func__(os.getenv("MESSAGE_PAGE_SIZE", "50"), 50)
+    MESSAGE_PAGE_MAX = safe_int.__func__(os.getenv("MESSAGE_PAGE_MAX", "200"), 200)
+    # Chat list pages, and the length of the last-message preview shown in them
+    CHAT_LIST_PAGE_SIZE = safe_int.__func__(os.getenv("CHAT_LIST_PAGE_SIZE", "50"), 50)
+    CHAT_LIST_PAGE_MAX = safe_int.__func__(os.getenv("CHAT_LIST_PAGE_MAX", "200"), 200)
+    CHAT_PREVIEW_LENGTH = safe_int.__func__(os.getenv("CHAT_PREVIEW_LENGTH", "100"), 100)
+    
+    # Message search results per request by default / at most, and the longest query accepted
+    SEARCH_PAGE_SIZE = safe_int.__func__(os.getenv("SEARCH_PAGE_SIZE", "20"), 20)
+    SEARCH_PAGE_MAX = safe_int.__func__(os.getenv("SEARCH_PAGE_MAX", "50"), 50)
+    SEARCH_QUERY_MAX_LENGTH = safe_int.__func__(os.getenv("SEARCH_QUERY_MAX_LENGTH", "200"), 200)
+    
+    # Purge of soft-deleted chats and worlds (rows per DELETE, pause between batches, idle poll)
+    PURGE_BATCH_SIZE = safe_int.__func__(os.getenv("PURGE_BATCH_SIZE", "1000"), 1000)
+    PURGE_BATCH_PAUSE = safe_float.__func__(os.getenv("PURGE_BATCH_PAUSE", "0.05"), 0.05)
+    PURGE_INTERVAL = safe_int.__func__(os.getenv("PURGE_INTERVAL", "10"), 10)
+    
+    # Token counting (tiktoken encoding, memoised counts)
+    TOKENIZER_ENCODING = os.getenv("TOKENIZER_ENCODING", "cl100k_base")
+    TOKENIZER_CACHE_SIZE = safe_int.__func__(os.getenv("TOKENIZER_CACHE_SIZE", "10000"), 10000)
+    
     # Role Configurations
     ROLE_CONFIGS = {
         "anonymous": {
             "daily_communal_limit_tokens": safe_int.__func__(os.getenv("ANON_DAILY_LIMIT", "5000"), 5000),
             "max_request_tokens": safe_int.__func__(os.getenv("ANON_MAX_REQUEST", "2000"), 2000),
-            "default_balance": safe_int.__func__(os.getenv("ANON_DEFAULT_BALANCE", "50000"), 50000)
+            "default_balance": safe_int.__func__(os.getenv("ANON_DEFAULT_BALANCE", "50000"), 50000),
+            "context_window_tokens": safe_int.__func__(os.getenv("ANON_CONTEXT_WINDOW", "1000"), 1000),
+            "upstream_weight": safe_int.__func__(os.getenv("ANON_UPSTREAM_WEIGHT", "1"), 1)
         },
         "user": {
             "daily_communal_limit_tokens": safe_int.__func__(os.getenv("USER_DAILY_LIMIT", "20000"), 20000),
             "max_request_tokens": safe_int.__func__(os.getenv("USER_MAX_REQUEST", "4000"), 4000),
-            "default_balance": safe_int.__func__(os.getenv("USER_DEFAULT_BALANCE", "50000"), 50000)
+            "default_balance": safe_int.__func__(os.getenv("USER_DEFAULT_BALANCE", "50000"), 50000),
+            "context_window_tokens": safe_int.__func__(os.getenv("USER_CONTEXT_WINDOW", "3000"), 3000),
+            "upstream_weight": safe_int.__func__(os.getenv("USER_UPSTREAM_WEIGHT", "2"), 2)
         },
         "admin": {
             "daily_communal_limit_tokens": safe_int.__func__(os.getenv("ADMIN_DAILY_LIMIT", "100000"), 100000),
             "max_request_tokens": safe_int.__func__(os.getenv("ADMIN_MAX_REQUEST", "8000"), 8000),
-            "default_balance": safe_int.__func__(os.getenv("ADMIN_DEFAULT_BALANCE", "100000"), 100000)
+            "default_balance": safe_int.__func__(os.getenv("ADMIN_DEFAULT_BALANCE", "100000"), 100000),
+            "context_window_tokens": safe_int.__func__(os.getenv("ADMIN_CONTEXT_WINDOW", "6000"), 6000),
+            "upstream_weight": safe_int.__func__(os.getenv("ADMIN_UPSTREAM_WEIGHT", "4"), 4)
         }
     }
     
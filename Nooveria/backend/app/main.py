@@ -1,10 +1,12 @@
 import os
+import asyncio
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from app.api import auth, chat, wallets, admin, devices, config, developer, security
 from app.api import worlds
 from app.api import chats
 from app.api import world_chats
+from app.api import search
 try:
     from app.api import device_linking
 except ImportError as e:
@@ -12,6 +14,8 @@ except ImportError as e:
     device_linking = None
 from app.database import engine
 from app.models import Base
+from app.middleware.deadline import DeadlineMiddleware, deadline_exceeded_handler
+from app.services.deadline import DeadlineExceeded
 
 app = FastAPI(title="OrthodoxGPT API", version="1.0.0")
 
@@ -28,6 +32,10 @@ app.add_middleware(
     allow_headers=["*"],  # Allow all headers
 )
 
+# Per-route request deadline; a request that runs out answers 504 naming the stage
+app.add_middleware(DeadlineMiddleware)
+app.add_exception_handler(DeadlineExceeded, deadline_exceeded_handler)
+
 app.include_router(auth.router, prefix="/api/auth", tags=["auth"])
 app.include_router(chat.router, prefix="/api", tags=["chat"])
 app.include_router(wallets.router, prefix="/api/wallets", tags=["wallets"])
@@ -38,6 +46,7 @@ app.include_router(security.router, prefix="/api/security", tags=["security"])
 app.include_router(chats.router, prefix="/api/chats", tags=["chats"])
 app.include_router(worlds.router, prefix="/api", tags=["worlds"])
 app.include_router(world_chats.router, prefix="/api", tags=["world-chats"])
+app.include_router(search.router, prefix="/api/search", tags=["search"])
 if device_linking:
     app.include_router(device_linking.router, prefix="/api/device", tags=["device"])
 # Hidden developer endpoints (not in docs)
@@ -47,15 +56,53 @@ app.include_router(developer.router, prefix="/api/dev", tags=["developer"], incl
 async def startup():
     Base.metadata.create_all(bind=engine)
     
-    # Initialize rate limiter with Redis
+    # Split the communal wallet into stripes and keep them balanced
+    try:
+        from app.database import SessionLocal
+        from app.services.communal_wallet import ensure_communal_stripes, run_communal_rebalancer
+        db = SessionLocal()
+        try:
+            ensure_communal_stripes(db)
+        finally:
+            db.close()
+        app.state.communal_rebalancer = asyncio.create_task(run_communal_rebalancer())
+    except Exception as e:
+        print(f"Communal wallet striping failed: {e}")
+    
+    # Release pre-authorisation holds left behind by crashed requests
+    from app.services.wallet import run_hold_expirer
+    app.state.hold_expirer = asyncio.create_task(run_hold_expirer())
+    
+    # Remove deleted chats and worlds in bounded batches
+    from app.services.purge import run_purge_worker
+    app.state.purge_worker = asyncio.create_task(run_purge_worker())
+    
+    # Batch ledger rows behind a WAL (replays entries left by crashed workers)
+    from app.config import Config
+    if Config.LEDGER_WRITE_BEHIND:
+        from app.services.ledger import ledger_writer
+        ledger_writer.start()
+    
+    # One async Redis pool for cache, rate limiting and security events
+    from app.services.redis_client import redis_manager
     try:
-        import redis
-        from app.middleware.rate_limit import rate_limiter
-        redis_url = os.getenv("REDIS_URL", "redis://localhost:6379")
-        rate_limiter.redis = redis.from_url(redis_url, decode_responses=True)
+        await redis_manager.get_redis().ping()
     except Exception as e:
         print(f"Redis connection failed, using in-memory rate limiting: {e}")
     
+    # Drop in-process wallet cache entries invalidated by other workers
+    from app.services.cache import run_wallet_invalidation_listener
+    app.state.wallet_invalidation_listener = asyncio.create_task(run_wallet_invalidation_listener())
+    
+    # Fan wallet notifications out to the /api/wallets/stream connections of this worker
+    from app.services.wallet_push import run_wallet_push_listener
+    app.state.wallet_push_listener = asyncio.create_task(run_wallet_push_listener())
+    
+    # Load the tokenizer vocabulary now rather than on the first chat request
+    from starlette.concurrency import run_in_threadpool
+    from app.services.tokenizer import token_counter
+    await run_in_threadpool(token_counter.load)
+    
     # License validation on startup
     from app.services.license_check import LicenseValidator
     license_info = LicenseValidator.validate_deployment()
@@ -68,8 +115,24 @@ async def startup():
 @app.on_event("shutdown")
 async def shutdown():
     # Clean up resources
+    for task_name in ("communal_rebalancer", "hold_expirer", "purge_worker", "wallet_invalidation_listener", "wallet_push_listener"):
+        task = getattr(app.state, task_name, None)
+        if task:
+            task.cancel()
+    
+    from app.services.ledger import ledger_writer
+    if ledger_writer.running:
+        await ledger_writer.stop()
+    
     from app.services.openai_client import close_http_client
     await close_http_client()
+    
+    from app.database import async_engine
+    if async_engine is not None:
+        await async_engine.dispose()
+    
+    from app.services.redis_client import redis_manager
+    await redis_manager.close()
 
 @app.get("/")
 async def root():
@@ -78,8 +141,28 @@ async def root():
 @app.get("/health")
 async def health_check():
     from datetime import datetime
+    from app.services.redis_client import redis_manager
+    from app.services.cache import CacheService
+    from app.services.wallet_push import wallet_push_hub
+    from app.services import response_cache
+    from app.services.admission import upstream_scheduler
+    from app.services.openai_client import upstream_stats
+    from app.services.disconnects import disconnect_stats
+    from app.services.deadline import deadline_stats
+    from app.services.idempotency import idempotency_stats
+    from app.services.purge import purge_stats
     return {
         "status": "healthy",
         "timestamp": datetime.utcnow().isoformat(),
-        "version": "1.0.0"
+        "version": "1.0.0",
+        "redis_pool": redis_manager.stats(),
+        "wallet_cache": CacheService.stats(),
+        "wallet_streams": wallet_push_hub.stats(),
+        "response_cache": response_cache.stats(),
+        "upstream_admission": upstream_scheduler.stats(),
+        "upstream_endpoints": upstream_stats(),
+        "client_disconnects": disconnect_stats.stats(),
+        "deadlines": deadline_stats.stats(),
+        "idempotency": idempotency_stats.stats(),
+        "purge": purge_stats.stats()
     }
\ No newline at end of file
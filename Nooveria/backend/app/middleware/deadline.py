@@ -0,0 +1,41 @@
+import re
+from fastapi.responses import JSONResponse
+from app.config import Config
+from app.services import deadline
+from app.services.deadline import DeadlineExceeded
+
+# (method, path, seconds): the first match sets the request deadline, None
+# means no deadline. Everything else gets REQUEST_DEADLINE.
+ROUTE_DEADLINES = [
+    ("GET", re.compile(r"^/api/wallets/stream$"), None),  # long-lived SSE
+    ("POST", re.compile(r"^/api/chat$"), Config.CHAT_REQUEST_DEADLINE),
+    ("POST", re.compile(r"^/api/chats/[^/]+/messages$"), Config.CHAT_REQUEST_DEADLINE),
+    ("POST", re.compile(r"^/api/world-chats/[^/]+/message$"), Config.CHAT_REQUEST_DEADLINE),
+    ("POST", re.compile(r"^/api/worlds/[^/]+/chats/[^/]+/messages$"), Config.CHAT_REQUEST_DEADLINE),
+]
+
+def route_deadline(method: str, path: str):
+    for route_method, pattern, seconds in ROUTE_DEADLINES:
+        if method == route_method and pattern.match(path):
+            return seconds
+    return Config.REQUEST_DEADLINE
+
+class DeadlineMiddleware:
+    """Sets the request deadline (plain ASGI, so it also covers streamed bodies)"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        token = deadline.start(route_deadline(scope["method"], scope["path"]))
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            deadline.reset(token)
+
+async def deadline_exceeded_handler(request, exc: DeadlineExceeded):
+    return JSONResponse(status_code=504, content={"detail": "deadline_exceeded", "stage": exc.stage})
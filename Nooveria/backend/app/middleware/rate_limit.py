@@ -1,35 +1,36 @@
 import time
-import redis
+import redis.asyncio as redis
 from fastapi import HTTPException, Request
 from typing import Optional
+from redis.exceptions import RedisError
+from app.services.redis_client import get_redis
 
 class RateLimiter:
     """Rate limiting middleware for auth endpoints"""
     
     def __init__(self, redis_client: Optional[redis.Redis] = None):
-        self.redis = redis_client
+        self.redis = redis_client  # defaults to the shared async client
         self.fallback_store = {}  # In-memory fallback
     
-    def check_rate_limit(self, key: str, limit: int, window: int) -> bool:
+    async def check_rate_limit(self, key: str, limit: int, window: int) -> bool:
         """Check if request is within rate limit"""
         current_time = int(time.time())
         window_start = current_time - window
         
-        if self.redis:
-            try:
-                # Use Redis for distributed rate limiting
-                pipe = self.redis.pipeline()
+        try:
+            # Use Redis for distributed rate limiting
+            async with (self.redis or get_redis()).pipeline() as pipe:
                 pipe.zremrangebyscore(key, 0, window_start)
                 pipe.zcard(key)
                 pipe.zadd(key, {str(current_time): current_time})
                 pipe.expire(key, window)
-                results = pipe.execute()
-                
-                current_requests = results[1]
-                return current_requests < limit
-            except:
-                # Fallback to in-memory
-                pass
+                results = await pipe.execute()
+            
+            current_requests = results[1]
+            return current_requests < limit
+        except (RedisError, OSError):
+            # Fallback to in-memory; cancellation and deadline errors propagate
+            pass
         
         # In-memory fallback
         if key not in self.fallback_store:
@@ -63,7 +64,7 @@ class RateLimiter:
 # Global rate limiter instance
 rate_limiter = RateLimiter()
 
-def check_auth_rate_limit(request: Request, endpoint: str):
+async def check_auth_rate_limit(request: Request, endpoint: str):
     """Check rate limit for auth endpoints"""
     limits = {
         "register": (5, 3600),  # 5 registrations per hour
@@ -77,7 +78,7 @@ def check_auth_rate_limit(request: Request, endpoint: str):
     limit, window = limits[endpoint]
     key = rate_limiter.get_client_key(request, endpoint)
     
-    if not rate_limiter.check_rate_limit(key, limit, window):
+    if not await rate_limiter.check_rate_limit(key, limit, window):
         raise HTTPException(
             status_code=429,
             detail=f"Rate limit exceeded for {endpoint}. Try again later."
@@ -1,6 +1,6 @@
 from app.database import Base
 from .user import User, Role, Session
-from .wallet import Wallet, Transaction, TokenTransfer, UsageRecord, WalletType, TransactionType, TransferStatus
+from .wallet import Wallet, Transaction, TokenTransfer, UsageRecord, WalletHold, LedgerCommit, WalletType, TransactionType, TransferStatus, HoldStatus
 from .device import DeviceFingerprint
 from .admin import AdminLog
 from .chat import Chat, ChatMessage
@@ -10,7 +10,7 @@ from .wallet_event import WalletEvent, WalletEventType
 
 __all__ = [
     "Base", "User", "Role", "Session", "Wallet", "Transaction", 
-    "TokenTransfer", "UsageRecord", "DeviceFingerprint", "AdminLog",
-    "WalletType", "TransactionType", "TransferStatus", "Chat", "ChatMessage",
+    "TokenTransfer", "UsageRecord", "WalletHold", "LedgerCommit", "DeviceFingerprint", "AdminLog",
+    "WalletType", "TransactionType", "TransferStatus", "HoldStatus", "Chat", "ChatMessage",
     "World", "UserWorld", "WorldChat", "WorldChatMessage", "WalletEvent", "WalletEventType"
 ]
\ No newline at end of file
@@ -1,8 +1,9 @@
-from sqlalchemy import Column, String, DateTime, Text, ForeignKey, Integer
+from sqlalchemy import Column, String, DateTime, Text, ForeignKey, Integer, Index
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from app.database import Base
+from app.models.search import search_vector_column, maintain_search_vector
 import uuid
 
 class Chat(Base):
@@ -11,21 +12,54 @@ class Chat(Base):
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     user_id = Column(UUID(as_uuid=True), ForeignKey("users.id"), nullable=False)
     title = Column(String(255), nullable=False, default="New Chat")
+    # Rolling summary of the oldest summary_message_count messages (see services/context_window)
+    summary = Column(Text, nullable=True)
+    summary_message_count = Column(Integer, nullable=False, default=0, server_default="0")
+    # Chat list metadata, kept up to date by the write path (see services/chat_list)
+    message_count = Column(Integer, nullable=False, default=0, server_default="0")
+    last_message_at = Column(DateTime, nullable=True)
+    last_message_preview = Column(String(200), nullable=True)
     created_at = Column(DateTime, server_default=func.current_timestamp())
     updated_at = Column(DateTime, server_default=func.current_timestamp(), onupdate=func.current_timestamp())
+    # Set on delete; the rows are removed later by services/purge
+    deleted_at = Column(DateTime, nullable=True)
     
     # Relationships
     user = relationship("User", back_populates="chats")
-    messages = relationship("ChatMessage", back_populates="chat", cascade="all, delete-orphan")
+    # A user message and its reply share a timestamp; role desc puts "user" first
+    messages = relationship(
+        "ChatMessage", back_populates="chat", cascade="all, delete-orphan",
+        order_by="[ChatMessage.created_at, ChatMessage.role.desc()]"
+    )
 
 class ChatMessage(Base):
     __tablename__ = "chat_messages"
     
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     chat_id = Column(UUID(as_uuid=True), ForeignKey("chats.id"), nullable=False)
+    # The chat's owner, copied on write so search stays within one user's rows
+    user_id = Column(UUID(as_uuid=True), nullable=True)
     role = Column(String(20), nullable=False)  # 'user' or 'assistant'
     content = Column(Text, nullable=False)
+    token_count = Column(Integer, nullable=True)  # set when written; NULL for older rows
     created_at = Column(DateTime, server_default=func.current_timestamp())
+    search_vector = search_vector_column()  # set by a trigger (see models/search)
     
     # Relationships
-    chat = relationship("Chat", back_populates="messages")
\ No newline at end of file
+    chat = relationship("Chat", back_populates="messages")
+
+# Chat list pages, most recently active first
+Index("ix_chats_user_updated", Chat.user_id, Chat.updated_at.desc(), Chat.id.desc())
+
+# Deleted chats awaiting the purge
+Index("ix_chats_deleted", Chat.deleted_at, postgresql_where=Chat.deleted_at.isnot(None))
+
+# History pages, newest first (see services/message_history)
+Index(
+    "ix_chat_messages_history",
+    ChatMessage.chat_id, ChatMessage.created_at.desc(), ChatMessage.role, ChatMessage.id.desc()
+)
+
+# Full-text search, per user (btree_gin; see services/search)
+Index("ix_chat_messages_user_search", ChatMessage.user_id, ChatMessage.search_vector, postgresql_using="gin")
+maintain_search_vector(ChatMessage.__table__)
@@ -0,0 +1,41 @@
+from sqlalchemy import DDL, Column, event
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.orm import deferred
+
+# Full-text search over chat history (see services/search). Messages carry a
+# tsvector kept up to date on write by a trigger, and a GIN index on
+# (user_id, search_vector) - btree_gin - so a common term is looked up among
+# one user's messages rather than everyone's.
+# ru_en is the russian configuration with Latin words explicitly stemmed as
+# English: content is mostly Russian with English terms mixed in.
+SEARCH_CONFIG = "ru_en"
+
+_search_config = DDL(f"""
+CREATE EXTENSION IF NOT EXISTS btree_gin;
+DO $$ BEGIN
+    IF to_regconfig('{SEARCH_CONFIG}') IS NULL THEN
+        CREATE TEXT SEARCH CONFIGURATION {SEARCH_CONFIG} (COPY = pg_catalog.russian);
+        ALTER TEXT SEARCH CONFIGURATION {SEARCH_CONFIG}
+            ALTER MAPPING FOR asciiword, asciihword, hword_asciipart WITH english_stem;
+        ALTER TEXT SEARCH CONFIGURATION {SEARCH_CONFIG}
+            ALTER MAPPING FOR word, hword, hword_part WITH russian_stem;
+    END IF;
+END $$;
+CREATE OR REPLACE FUNCTION message_search_vector() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector := to_tsvector('{SEARCH_CONFIG}', coalesce(NEW.content, ''));
+    RETURN NEW;
+END $$ LANGUAGE plpgsql;
+""")
+
+def search_vector_column() -> Column:
+    # Deferred: only the search reads it, and it is as large as the content
+    return deferred(Column("search_vector", TSVECTOR, nullable=True))
+
+def maintain_search_vector(table):
+    """Create the configuration and the update trigger along with table (create_all)"""
+    event.listen(table, "before_create", _search_config.execute_if(dialect="postgresql"))
+    event.listen(table, "after_create", DDL(
+        f"CREATE TRIGGER {table.name}_search_vector BEFORE INSERT OR UPDATE OF content ON {table.name} "
+        "FOR EACH ROW EXECUTE FUNCTION message_search_vector()"
+    ).execute_if(dialect="postgresql"))
@@ -1,5 +1,5 @@
 import uuid
-from sqlalchemy import Column, String, Integer, ForeignKey, DateTime, Numeric, JSON, Enum
+from sqlalchemy import Column, String, Integer, BigInteger, ForeignKey, DateTime, Numeric, JSON, Enum, Index
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
@@ -22,6 +22,12 @@ class TransferStatus(enum.Enum):
     completed = "completed"
     rejected = "rejected"
 
+class HoldStatus(enum.Enum):
+    active = "active"
+    settled = "settled"
+    released = "released"
+    expired = "expired"
+
 class Wallet(Base):
     __tablename__ = "wallets"
     
@@ -29,6 +35,8 @@ class Wallet(Base):
     user_id = Column(UUID(as_uuid=True), ForeignKey("users.id"), nullable=True)
     type = Column(Enum(WalletType), nullable=False)
     balance_tokens = Column(Numeric(precision=15, scale=2), default=0)
+    # Bumped by every balance UPDATE; orders cache writes of the balance
+    version = Column(BigInteger, nullable=False, default=0, server_default="0")
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     
     user = relationship("User", back_populates="wallets")
@@ -68,4 +76,32 @@ class UsageRecord(Base):
     completion_tokens = Column(Integer, nullable=False)
     total_tokens = Column(Integer, nullable=False)
     openai_response_meta = Column(JSON, nullable=True)
-    transaction_id = Column(Integer, ForeignKey("transactions.id"), nullable=True)
\ No newline at end of file
+    transaction_id = Column(Integer, ForeignKey("transactions.id"), nullable=True)
+
+class WalletHold(Base):
+    __tablename__ = "wallet_holds"
+    
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    user_id = Column(UUID(as_uuid=True), ForeignKey("users.id"), nullable=False)
+    wallet_id = Column(Integer, ForeignKey("wallets.id"), nullable=False)
+    source = Column(String(20), nullable=False)  # 'personal' or 'communal'
+    amount_tokens = Column(Numeric(precision=15, scale=2), nullable=False)
+    # Communal holds: [[stripe_id, "tokens"], ...] taken from each stripe (wallet_id is the first)
+    parts = Column(JSON, nullable=True)
+    status = Column(Enum(HoldStatus), nullable=False, default=HoldStatus.active)
+    expires_at = Column(DateTime(timezone=True), nullable=False, index=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+class LedgerCommit(Base):
+    """Marks a write-behind ledger entry whose charge committed (see services/ledger)"""
+    __tablename__ = "ledger_commits"
+    
+    # Inserted with the balance update, deleted with the entry's ledger rows
+    entry_id = Column(UUID(as_uuid=True), primary_key=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+# Hot-path lookups (migration 007): a user's personal wallet, the admin's
+# latest transactions and a user's usage history
+Index("ix_wallets_user_type", Wallet.user_id, Wallet.type)
+Index("ix_transactions_created_at", Transaction.created_at)
+Index("ix_usage_records_user_requested", UsageRecord.user_id, UsageRecord.request_timestamp)
@@ -1,6 +1,6 @@
 import uuid
 import enum
-from sqlalchemy import Column, String, Integer, ForeignKey, DateTime, Numeric, Text
+from sqlalchemy import Column, String, Integer, ForeignKey, DateTime, Numeric, Text, Index
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
@@ -26,4 +26,7 @@ class WalletEvent(Base):
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     
     # Relationships
-    user = relationship("User")
\ No newline at end of file
+    user = relationship("User")
+
+# A user's wallet history, newest first (migration 007)
+Index("ix_wallet_events_user_created", WalletEvent.user_id, WalletEvent.created_at)
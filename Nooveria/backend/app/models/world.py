@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime, Boolean, ForeignKey
+from sqlalchemy import Column, Integer, String, Text, DateTime, Boolean, ForeignKey, Index
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
@@ -14,8 +14,11 @@ class World(Base):
     assistant_id = Column(String(255), nullable=False)  # OpenAI Assistant ID
     tokens_spent = Column(Integer, default=0)
     is_active = Column(Boolean, default=True)
+    response_cache_enabled = Column(Boolean, nullable=False, default=False, server_default="false")  # Reuse identical first-turn replies
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+    # Set on delete; the world, its chats and pins are removed later by services/purge
+    deleted_at = Column(DateTime(timezone=True), nullable=True)
     
     # Relationships
     user_worlds = relationship("UserWorld", back_populates="world", cascade="all, delete-orphan")
@@ -32,4 +35,7 @@ class UserWorld(Base):
     
     # Relationships
     user = relationship("User", back_populates="user_worlds")
-    world = relationship("World", back_populates="user_worlds")
\ No newline at end of file
+    world = relationship("World", back_populates="user_worlds")
+
+# Pins of a world (world deletion, see services/purge)
+Index("ix_user_worlds_world", UserWorld.world_id)
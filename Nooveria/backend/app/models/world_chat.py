@@ -1,9 +1,10 @@
 import uuid
-from sqlalchemy import Column, String, DateTime, Text, ForeignKey, Integer
+from sqlalchemy import Column, String, DateTime, Text, ForeignKey, Integer, Index
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from app.database import Base
+from app.models.search import search_vector_column, maintain_search_vector
 
 class WorldChat(Base):
     __tablename__ = "world_chats"
@@ -15,21 +16,51 @@ class WorldChat(Base):
     title = Column(String(255), default="World Chat")
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+    # Chat list metadata, kept up to date by the write path (see services/chat_list)
+    message_count = Column(Integer, nullable=False, default=0, server_default="0")
+    last_message_at = Column(DateTime(timezone=True), nullable=True)
+    last_message_preview = Column(String(200), nullable=True)
+    # Set on delete (or when the world is deleted); the rows are removed later by services/purge
+    deleted_at = Column(DateTime(timezone=True), nullable=True)
     
     # Relationships
     user = relationship("User", back_populates="world_chats")
     world = relationship("World", back_populates="world_chats")
-    messages = relationship("WorldChatMessage", back_populates="world_chat", cascade="all, delete-orphan")
+    # A user message and its reply share a timestamp; role desc puts "user" first
+    messages = relationship(
+        "WorldChatMessage", back_populates="world_chat", cascade="all, delete-orphan",
+        order_by="[WorldChatMessage.created_at, WorldChatMessage.role.desc()]"
+    )
 
 class WorldChatMessage(Base):
     __tablename__ = "world_chat_messages"
     
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     world_chat_id = Column(UUID(as_uuid=True), ForeignKey("world_chats.id"), nullable=False)
+    # The chat's owner, copied on write so search stays within one user's rows
+    user_id = Column(UUID(as_uuid=True), nullable=True)
     role = Column(String(20), nullable=False)  # 'user' or 'assistant'
     content = Column(Text, nullable=False)
     openai_message_id = Column(String(255))
     created_at = Column(DateTime(timezone=True), server_default=func.now())
+    search_vector = search_vector_column()  # set by a trigger (see models/search)
     
     # Relationships
-    world_chat = relationship("WorldChat", back_populates="messages")
\ No newline at end of file
+    world_chat = relationship("WorldChat", back_populates="messages")
+
+# Chat list pages, most recently active first
+Index("ix_world_chats_user_world_updated", WorldChat.user_id, WorldChat.world_id, WorldChat.updated_at.desc(), WorldChat.id.desc())
+
+# Deleted world chats awaiting the purge, and the chats of a world (world deletion)
+Index("ix_world_chats_deleted", WorldChat.deleted_at, postgresql_where=WorldChat.deleted_at.isnot(None))
+Index("ix_world_chats_world", WorldChat.world_id)
+
+# History pages, newest first (see services/message_history)
+Index(
+    "ix_world_chat_messages_history",
+    WorldChatMessage.world_chat_id, WorldChatMessage.created_at.desc(), WorldChatMessage.role, WorldChatMessage.id.desc()
+)
+
+# Full-text search, per user (btree_gin; see services/search)
+Index("ix_world_chat_messages_user_search", WorldChatMessage.user_id, WorldChatMessage.search_vector, postgresql_using="gin")
+maintain_search_vector(WorldChatMessage.__table__)
@@ -0,0 +1,176 @@
+import math
+import time
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Optional
+from app.config import Config
+from app.services import deadline
+
+# Admission for upstream LLM calls: at most UPSTREAM_MAX_CONCURRENCY calls in
+# flight per worker and UPSTREAM_PER_USER_INFLIGHT per user. Waiting requests
+# queue per role and free slots are shared between the queues in proportion to
+# the role's upstream_weight (stride scheduling), so a burst from one class of
+# users can't starve the others. Requests whose expected wait exceeds
+# UPSTREAM_QUEUE_DEADLINE are turned away at once with UpstreamBusy.
+
+class UpstreamBusy(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__("Upstream busy")
+        self.retry_after = retry_after
+
+class _Waiter:
+    __slots__ = ("user_id", "future", "enqueued")
+
+    def __init__(self, user_id: Optional[str]):
+        self.user_id = user_id
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued = time.monotonic()
+
+def _weight(queue_name: str) -> int:
+    return max(1, Config.get_role_config(queue_name).get("upstream_weight", 1))
+
+class AdmissionScheduler:
+    """Weighted fair admission (only touched from the event loop)"""
+
+    def __init__(self, capacity: int, per_user: int, deadline: float):
+        self.capacity = capacity
+        self.per_user = per_user
+        self.deadline = deadline
+        self.active = 0
+        self._user_active = {}
+        self._queues = {}
+        self._pass = {}
+        self._virtual_time = 0.0
+        # Moving average of how long a call holds its slot, for the wait estimate
+        self._service_time = 1.0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def _queue_name(self, role_name: Optional[str]) -> str:
+        return role_name if role_name in Config.ROLE_CONFIGS else "user"
+
+    def _has_room(self, user_id: Optional[str]) -> bool:
+        return self.active < self.capacity and self._user_active.get(user_id, 0) < self.per_user
+
+    def _expected_wait(self, queue_name: str) -> float:
+        """Queue ahead of us divided by the share of capacity this queue gets"""
+        busy = {name for name, queue in self._queues.items() if queue} | {queue_name}
+        share = _weight(queue_name) / sum(_weight(name) for name in busy)
+        ahead = len(self._queues.get(queue_name, ())) + 1
+        return ahead / (self.capacity * share) * self._service_time
+
+    def _grant(self, user_id: Optional[str], waited: float):
+        self.active += 1
+        self._user_active[user_id] = self._user_active.get(user_id, 0) + 1
+        self.admitted += 1
+        self._wait_total += waited
+        self._wait_max = max(self._wait_max, waited)
+
+    def _next_waiter(self, queue_name: str) -> Optional[_Waiter]:
+        """Oldest waiter in the queue whose user is under the per-user limit"""
+        queue = self._queues[queue_name]
+        for waiter in list(queue):
+            if waiter.future.done():
+                queue.remove(waiter)
+            elif self._user_active.get(waiter.user_id, 0) < self.per_user:
+                return waiter
+        return None
+
+    def _dispatch(self):
+        while self.active < self.capacity:
+            candidates = [
+                (self._pass[name], name, waiter) for name in self._queues
+                if (waiter := self._next_waiter(name)) is not None
+            ]
+            if not candidates:
+                return
+            pass_value, name, waiter = min(candidates, key=lambda candidate: candidate[0])
+            self._queues[name].remove(waiter)
+            self._virtual_time = pass_value
+            self._pass[name] = pass_value + 1 / _weight(name)
+            self._grant(waiter.user_id, time.monotonic() - waiter.enqueued)
+            waiter.future.set_result(None)
+
+    async def acquire(self, user_id: Optional[str], role_name: Optional[str] = None):
+        queue_name = self._queue_name(role_name)
+        if self._has_room(user_id) and not any(self._queues.values()):
+            self._grant(user_id, 0.0)
+            return
+
+        # Queue no longer than the request has left
+        wait_limit = deadline.stage_timeout("admission", self.deadline)
+        expected = self._expected_wait(queue_name)
+        if expected > wait_limit:
+            self.rejected += 1
+            raise UpstreamBusy(math.ceil(expected))
+
+        queue = self._queues.setdefault(queue_name, deque())
+        if not queue:
+            # A queue that was idle starts at the current virtual time instead of banking credit
+            self._pass[queue_name] = max(self._pass.get(queue_name, 0.0), self._virtual_time)
+        waiter = _Waiter(user_id)
+        queue.append(waiter)
+        self._dispatch()
+
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), wait_limit)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.future.done():
+                # Granted while we were giving up: hand the slot on
+                self.release(user_id)
+            else:
+                waiter.future.cancel()
+                if waiter in queue:
+                    queue.remove(waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                self.timed_out += 1
+                if wait_limit < self.deadline:
+                    deadline.deadline_stats.record("admission")
+                    raise deadline.DeadlineExceeded("admission")
+                raise UpstreamBusy(math.ceil(self._expected_wait(queue_name)))
+            raise
+
+    def release(self, user_id: Optional[str], held: Optional[float] = None):
+        self.active -= 1
+        remaining = self._user_active.get(user_id, 1) - 1
+        if remaining:
+            self._user_active[user_id] = remaining
+        else:
+            self._user_active.pop(user_id, None)
+        if held is not None:
+            self._service_time = 0.8 * self._service_time + 0.2 * held
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, user_id: Optional[str], role_name: Optional[str] = None):
+        """Hold one upstream slot for the duration of the block"""
+        await self.acquire(user_id, role_name)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(user_id, time.monotonic() - started)
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "capacity": self.capacity,
+            "queued": {name: len(queue) for name, queue in self._queues.items()},
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "avg_wait_ms": round(self._wait_total / self.admitted * 1000, 1) if self.admitted else 0.0,
+            "max_wait_ms": round(self._wait_max * 1000, 1),
+            "service_time_ms": round(self._service_time * 1000, 1)
+        }
+
+# Global scheduler for this worker
+upstream_scheduler = AdmissionScheduler(
+    Config.UPSTREAM_MAX_CONCURRENCY,
+    Config.UPSTREAM_PER_USER_INFLIGHT,
+    Config.UPSTREAM_QUEUE_DEADLINE
+)
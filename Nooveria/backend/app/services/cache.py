@@ -1,33 +1,160 @@
-import os
-import json
+import time
+import asyncio
 import redis
+from collections import OrderedDict
 from typing import Optional, Any
+from app.config import Config
+from app.services.redis_client import get_redis
 
-# Redis connection with connection pooling
-redis_client = redis.ConnectionPool.from_url(
-    os.getenv("REDIS_URL", "redis://localhost:6379"),
-    max_connections=20
-)
-cache = redis.Redis(connection_pool=redis_client)
+# Wallet reads go through two tiers: a bounded in-process TTL LRU per worker,
+# then Redis. Invalidations are broadcast on WALLET_INVALIDATION_CHANNEL so
+# every worker drops its local copy. The communal total is one shared key
+# ("communal_balance") that is never copied into the per-user entries.
+#
+# Personal balances are written through after each charge as "<version>:<balance>",
+# where version is Wallet.version returned by the UPDATE. A write only lands if
+# its version is newer than the stored one, so late writes can't regress it.
+
+WALLET_INVALIDATION_CHANNEL = "wallet_invalidate"
+
+# KEYS[1] = key, ARGV = value, version, ttl
+_SET_IF_NEWER = """
+local current = redis.call('GET', KEYS[1])
+if current then
+    local version = tonumber(string.match(current, '^(%d+):'))
+    if version and version >= tonumber(ARGV[2]) then
+        return 0
+    end
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[3])
+return 1
+"""
+
+class NearCache:
+    """Bounded in-process TTL LRU (only touched from the event loop)"""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self._data.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: str, value: Any, ttl: float = None):
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def peek(self, key: str) -> Optional[Any]:
+        """Current value without touching stats or recency"""
+        entry = self._data.get(key)
+        return entry[1] if entry is not None and entry[0] >= time.monotonic() else None
+
+    def delete(self, key: str):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self) -> dict:
+        return _tier_stats(self.hits, self.misses, size=len(self._data), max_size=self.max_size)
+
+def _tier_stats(hits: int, misses: int, **extra) -> dict:
+    lookups = hits + misses
+    return {"hits": hits, "misses": misses, "hit_rate": round(hits / lookups, 4) if lookups else 0.0, **extra}
+
+class _RedisTierStats:
+    hits = 0
+    misses = 0
+
+near_cache = NearCache(Config.WALLET_LOCAL_CACHE_SIZE, Config.WALLET_LOCAL_CACHE_TTL)
+redis_tier = _RedisTierStats()
+_inflight = {}
+
+def _version_of(value: Optional[str]) -> int:
+    """Version prefix of a "<version>:<balance>" entry (0 if absent)"""
+    if value is None or ":" not in value:
+        return 0
+    return int(value.split(":", 1)[0])
+
+def in_flight(key: str) -> bool:
+    """Whether single_flight(key) would join a load that is already running"""
+    return key in _inflight
+
+async def single_flight(key: str, load):
+    """
+    Run load() once per key on this worker; concurrent misses await the same
+    result instead of all querying the database.
+    """
+    pending = _inflight.get(key)
+    if pending is not None:
+        return await asyncio.shield(pending)
+    
+    pending = asyncio.get_running_loop().create_future()
+    _inflight[key] = pending
+    try:
+        value = await load()
+        pending.set_result(value)
+        return value
+    except BaseException as e:
+        pending.set_exception(e if isinstance(e, Exception) else RuntimeError("Cache load cancelled"))
+        pending.exception()  # retrieved: waiters get it re-raised, nobody else has to
+        raise
+    finally:
+        del _inflight[key]
+
+async def _get_two_tier(key: str) -> Optional[str]:
+    """Local tier first, then Redis (refilling the local tier on a Redis hit)"""
+    value = near_cache.get(key)
+    if value is not None:
+        return value
+    value = await get_redis().get(key)
+    if value is None:
+        redis_tier.misses += 1
+        return None
+    redis_tier.hits += 1
+    near_cache.set(key, value, Config.COMMUNAL_LOCAL_CACHE_TTL if key == "communal_balance" else None)
+    return value
 
 class CacheService:
     @staticmethod
-    def get_user_wallet_cache(user_id: str) -> Optional[dict]:
-        """Get cached wallet data"""
+    async def get_user_wallet_cache(user_id: str) -> Optional[float]:
+        """Get cached personal balance"""
         try:
-            data = cache.get(f"wallet:{user_id}")
-            return json.loads(data) if data else None
+            data = await _get_two_tier(f"wallet:{user_id}:personal")
+            return float(data.split(":", 1)[-1]) if data is not None else None
         except redis.RedisError:
             return None
         except Exception as e:
             print(f"Cache get error: {e}")
             return None
-    
+
     @staticmethod
-    def set_user_wallet_cache(user_id: str, wallet_data: dict, ttl: int = 300):
-        """Cache wallet data for 5 minutes"""
+    async def set_user_wallet_cache(user_id: str, personal_balance: float, version: int, ttl: int = 300):
+        """Cache personal balance for 5 minutes unless a newer version is already cached"""
+        key = f"wallet:{user_id}:personal"
+        value = f"{version}:{personal_balance}"
+        current = near_cache.peek(key)
+        if current is None or _version_of(current) < version:
+            near_cache.set(key, value)
         try:
-            cache.setex(f"wallet:{user_id}", ttl, json.dumps(wallet_data))
+            async with get_redis().pipeline(transaction=False) as pipe:
+                pipe.eval(_SET_IF_NEWER, 1, key, value, version, ttl)
+                # Other workers drop older local copies
+                pipe.publish(WALLET_INVALIDATION_CHANNEL, f"{key} {version}")
+                await pipe.execute()
         except redis.RedisError:
             # Log Redis connection issues but don't crash
             pass
@@ -35,42 +162,101 @@ class CacheService:
             # Log unexpected errors for debugging
             print(f"Cache set error: {e}")
             pass
-    
+
     @staticmethod
-    def invalidate_user_wallet_cache(user_id: str):
-        """Remove wallet cache after transaction"""
+    async def invalidate_user_wallet_cache(user_id: str):
+        """Remove wallet cache after transaction, on this worker and all others"""
+        key = f"wallet:{user_id}:personal"
+        near_cache.delete(key)
         try:
-            cache.delete(f"wallet:{user_id}")
+            async with get_redis().pipeline(transaction=False) as pipe:
+                pipe.delete(key)
+                pipe.publish(WALLET_INVALIDATION_CHANNEL, key)
+                await pipe.execute()
         except redis.RedisError:
             pass
         except Exception as e:
             print(f"Cache delete error: {e}")
             pass
-    
+
     @staticmethod
-    def get_daily_usage(user_id: str) -> int:
+    async def get_communal_balance_cache() -> Optional[float]:
+        """Get cached sum of all communal wallet stripes"""
+        try:
+            data = await _get_two_tier("communal_balance")
+            return float(data) if data is not None else None
+        except redis.RedisError:
+            return None
+        except Exception as e:
+            print(f"Cache get error: {e}")
+            return None
+
+    @staticmethod
+    async def set_communal_balance_cache(balance: float, ttl: int = 30):
+        """Cache communal total for 30 seconds (shared by all users)"""
+        near_cache.set("communal_balance", str(balance), Config.COMMUNAL_LOCAL_CACHE_TTL)
+        try:
+            await get_redis().setex("communal_balance", ttl, str(balance))
+        except redis.RedisError:
+            pass
+        except Exception as e:
+            print(f"Cache set error: {e}")
+            pass
+
+    @staticmethod
+    async def get_daily_usage(user_id: str) -> int:
         """Get daily communal usage counter"""
         try:
-            usage = cache.get(f"daily_usage:{user_id}")
+            usage = await get_redis().get(f"daily_usage:{user_id}")
             return int(usage) if usage else 0
         except redis.RedisError:
             return 0
         except Exception as e:
             print(f"Cache get error: {e}")
             return 0
-    
+
     @staticmethod
-    def increment_daily_usage(user_id: str, tokens: int) -> int:
+    async def increment_daily_usage(user_id: str, tokens: int) -> int:
         """Increment daily usage with expiration"""
         try:
             key = f"daily_usage:{user_id}"
-            pipe = cache.pipeline()
-            pipe.incrby(key, tokens)
-            pipe.expire(key, 86400)  # 24 hours
-            result = pipe.execute()
+            async with get_redis().pipeline() as pipe:
+                pipe.incrby(key, tokens)
+                pipe.expire(key, 86400)  # 24 hours
+                result = await pipe.execute()
             return result[0]
         except redis.RedisError:
             return tokens
         except Exception as e:
             print(f"Cache increment error: {e}")
-            return tokens
\ No newline at end of file
+            return tokens
+
+    @staticmethod
+    def stats() -> dict:
+        """Hit rates of the in-process and Redis tiers for this worker"""
+        return {
+            "local": near_cache.stats(),
+            "redis": _tier_stats(redis_tier.hits, redis_tier.misses)
+        }
+
+async def run_wallet_invalidation_listener():
+    """Drop local entries that another worker invalidated (one pub/sub connection per worker)"""
+    while True:
+        pubsub = get_redis().pubsub()
+        try:
+            await pubsub.subscribe(WALLET_INVALIDATION_CHANNEL)
+            # Invalidations may have been missed while unsubscribed
+            near_cache.clear()
+            async for message in pubsub.listen():
+                if message["type"] == "message":
+                    key, _, version = message["data"].partition(" ")
+                    if not version or _version_of(near_cache.peek(key)) < int(version):
+                        near_cache.delete(key)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Wallet invalidation listener error: {e}")
+            near_cache.clear()
+            await asyncio.sleep(1)
+        finally:
+            await pubsub.aclose()
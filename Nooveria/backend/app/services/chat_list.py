@@ -0,0 +1,37 @@
+import uuid
+from typing import Optional, List, Any
+from sqlalchemy import select, tuple_, func
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.config import Config
+
+# Chat lists (chats and world_chats). message_count, last_message_at and
+# last_message_preview live on the chat row and are bumped by the write path
+# in the same transaction as the messages, so a list page is one range scan
+# of the (user, updated_at DESC, id DESC) index with no message rows read.
+# Pages are newest activity first; before=<chat id> continues after that chat.
+
+def message_preview(content: str) -> str:
+    return " ".join(content.split())[:Config.CHAT_PREVIEW_LENGTH]
+
+def record_messages(chat: Any, count: int, last_content: str):
+    """Account for count new messages on an existing chat (flushed with them)"""
+    model = type(chat)
+    # In SQL, so concurrent turns in the same chat don't lose counts
+    chat.message_count = model.message_count + count
+    chat.last_message_at = func.current_timestamp()
+    chat.last_message_preview = message_preview(last_content)
+
+def list_limit(limit: Optional[int]) -> int:
+    if limit is None:
+        return Config.CHAT_LIST_PAGE_SIZE
+    return max(1, min(limit, Config.CHAT_LIST_PAGE_MAX))
+
+async def load_chat_page(db: AsyncSession, model: Any, filters: list, before: Optional[uuid.UUID], limit: int) -> List[Any]:
+    """Chats matching filters, most recently active first, after chat before"""
+    query = select(model).where(*filters)
+    if before is not None:
+        cursor = (await db.execute(select(model.updated_at, model.id).where(*filters, model.id == before))).first()
+        if cursor is None:
+            raise Exception("Invalid cursor")
+        query = query.where(tuple_(model.updated_at, model.id) < tuple_(*cursor))
+    return (await db.scalars(query.order_by(model.updated_at.desc(), model.id.desc()).limit(limit))).all()
@@ -0,0 +1,164 @@
+import asyncio
+from uuid import UUID
+from decimal import Decimal, ROUND_DOWN
+from sqlalchemy import update, select, func
+from sqlalchemy.orm import Session
+from app.models import Wallet, WalletType
+from app.services.cache import CacheService, single_flight
+from app.config import Config
+
+# The communal pool is split into several Wallet rows ("stripes") of type communal.
+# Users hash to a home stripe, so concurrent communal withdrawals spread over
+# several rows instead of all queueing on a single hot row.
+
+# pg_advisory_xact_lock key serialising the stripe split across workers
+STRIPES_LOCK_KEY = 7304
+
+def get_stripe_ids(db: Session) -> list:
+    """Ids of all communal stripes in stable order"""
+    return [row.id for row in db.query(Wallet.id).filter(
+        Wallet.type == WalletType.communal
+    ).order_by(Wallet.id).all()]
+
+def stripe_for_user(user_id: str, stripe_count: int) -> int:
+    """Stable home stripe index for a user"""
+    return UUID(str(user_id)).int % stripe_count
+
+def withdraw_communal(db: Session, user_id: str, tokens_needed: Decimal):
+    """
+    Withdraw from the user's home stripe, borrowing from the next stripes when it runs dry.
+    Each attempt is a single conditional UPDATE ... RETURNING. When no single
+    stripe covers the amount it is split across stripes (_withdraw_split).
+    Returns the (stripe_id, tokens) parts taken, or [] when the pool is short.
+    """
+    stripe_ids = get_stripe_ids(db)
+    if not stripe_ids:
+        return []
+
+    home = stripe_for_user(user_id, len(stripe_ids))
+    for offset in range(len(stripe_ids)):
+        stripe_id = stripe_ids[(home + offset) % len(stripe_ids)]
+        if _debit_stripe(db, stripe_id, tokens_needed):
+            return [(stripe_id, tokens_needed)]
+
+    return _withdraw_split(db, home, tokens_needed)
+
+def _debit_stripe(db: Session, stripe_id: int, tokens: Decimal):
+    return db.execute(
+        update(Wallet)
+        .where(Wallet.id == stripe_id, Wallet.balance_tokens >= tokens)
+        .values(balance_tokens=Wallet.balance_tokens - tokens, version=Wallet.version + 1)
+        .returning(Wallet.id, Wallet.balance_tokens, Wallet.version)
+    ).first()
+
+def _withdraw_split(db: Session, home: int, tokens_needed: Decimal):
+    """
+    Take the amount from several stripes, starting at the home stripe. All
+    stripes are locked (in id order, like the rebalancer) so the total cannot
+    change underneath. Returns the (stripe_id, tokens) part taken from each
+    stripe, or [] when the whole pool does not cover the amount.
+    """
+    stripes = db.execute(
+        select(Wallet.id, Wallet.balance_tokens)
+        .where(Wallet.type == WalletType.communal)
+        .order_by(Wallet.id)
+        .with_for_update()
+    ).all()
+    if sum(stripe.balance_tokens for stripe in stripes) < tokens_needed:
+        return []
+
+    parts, remaining = [], tokens_needed
+    for stripe in stripes[home:] + stripes[:home]:
+        part = min(stripe.balance_tokens, remaining)
+        if part <= 0:
+            continue
+        _debit_stripe(db, stripe.id, part)
+        parts.append((stripe.id, part))
+        remaining -= part
+        if remaining <= 0:
+            break
+    return parts
+
+def get_communal_balance(db: Session) -> float:
+    """Total communal balance across all stripes"""
+    total = db.query(func.sum(Wallet.balance_tokens)).filter(
+        Wallet.type == WalletType.communal
+    ).scalar()
+    return float(total) if total is not None else 0
+
+async def get_communal_balance_cached(db) -> float:
+    """get_communal_balance behind the cache (db is an AsyncSession); concurrent misses share one query"""
+    cached = await CacheService.get_communal_balance_cache()
+    if cached is not None:
+        return cached
+
+    async def load() -> float:
+        balance = await db.run_sync(get_communal_balance)
+        await CacheService.set_communal_balance_cache(balance)
+        return balance
+
+    return await single_flight("communal_balance", load)
+
+def rebalance_communal_stripes(db: Session, min_ratio: float = 0.5) -> bool:
+    """
+    Even out stripe balances. Skipped while every stripe holds at least
+    min_ratio of its fair share. Returns True if balances were moved.
+    """
+    stripes = db.query(Wallet).filter(
+        Wallet.type == WalletType.communal
+    ).order_by(Wallet.id).with_for_update().all()
+    if len(stripes) < 2:
+        return False
+
+    total = sum(stripe.balance_tokens for stripe in stripes)
+    share = (total / len(stripes)).quantize(Decimal("0.01"), rounding=ROUND_DOWN)
+    if all(stripe.balance_tokens >= share * Decimal(str(min_ratio)) for stripe in stripes):
+        db.rollback()
+        return False
+
+    for stripe in stripes:
+        stripe.balance_tokens = share
+    # Rounding remainder stays on the first stripe so the total is preserved
+    stripes[0].balance_tokens += total - share * len(stripes)
+    db.commit()
+    return True
+
+def ensure_communal_stripes(db: Session, stripe_count: int = None):
+    """Split the communal pool into stripe_count rows (idempotent, safe across workers)"""
+    stripe_count = stripe_count or Config.COMMUNAL_WALLET_STRIPES
+
+    # Row locks don't cover rows that are about to be inserted: serialise the
+    # workers on an advisory lock, and count the stripes only once it is held
+    db.execute(select(func.pg_advisory_xact_lock(STRIPES_LOCK_KEY)))
+    stripes = db.query(Wallet.id).filter(Wallet.type == WalletType.communal).count()
+    if not stripes or stripes >= stripe_count:
+        db.rollback()
+        return
+
+    for _ in range(stripe_count - stripes):
+        db.add(Wallet(user_id=None, type=WalletType.communal, balance_tokens=Decimal("0")))
+    db.commit()
+
+    rebalance_communal_stripes(db, min_ratio=1.0)
+    print(f"Communal wallet split into {stripe_count} stripes")
+
+async def run_communal_rebalancer(interval: int = None):
+    """Background loop evening out communal stripes"""
+    from starlette.concurrency import run_in_threadpool
+    from app.database import SessionLocal
+
+    interval = interval or Config.COMMUNAL_REBALANCE_INTERVAL
+
+    def rebalance_once():
+        db = SessionLocal()
+        try:
+            rebalance_communal_stripes(db)
+        finally:
+            db.close()
+
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await run_in_threadpool(rebalance_once)
+        except Exception as e:
+            print(f"Communal rebalance error: {e}")
@@ -0,0 +1,180 @@
+import asyncio
+from contextlib import aclosing
+from typing import List, Tuple, Optional
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.config import Config
+from app.models.chat import Chat, ChatMessage
+from app.services.tokenizer import count_tokens
+from app.services import deadline
+
+# Upstream context for a chat turn: a rolling summary of the oldest messages,
+# then the newest messages that fit the role's context_window_tokens budget.
+# Messages that fall out of the window are folded into the summary by a
+# background task, so prompt size stays flat as the chat grows.
+#
+# History is read newest first in pages of CHAT_CONTEXT_PAGE_SIZE on the
+# history index, only as far as the budget needs: a long chat costs as much
+# as a short one. The summary calls are a platform cost, not billed to the
+# user: at most CHAT_SUMMARY_CHUNK_TOKENS of input each, and only once
+# CHAT_SUMMARY_MIN_TOKENS have fallen out of the window.
+
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+
+SUMMARY_INSTRUCTIONS = (
+    "Update the summary of a conversation between a user and an assistant. "
+    "Keep names, facts, decisions and open questions; drop small talk. "
+    "Answer with the updated summary only, in the language of the conversation, "
+    "in at most 200 words."
+)
+
+def message_tokens(message: ChatMessage) -> int:
+    """Stored token count, or counted now for rows written before it was stored"""
+    return message.token_count if message.token_count is not None else count_tokens(message.content)
+
+def context_budget(role_name: str) -> int:
+    return Config.get_role_config(role_name).get("context_window_tokens", 3000)
+
+def _summary_message(chat: Chat) -> List[dict]:
+    return [{"role": "system", "content": SUMMARY_PREFIX + chat.summary}] if chat.summary else []
+
+def _summary_tokens(chat: Chat) -> int:
+    return sum(count_tokens(msg["content"]) for msg in _summary_message(chat))
+
+def _history(chat_id, newest_first: bool):
+    """A chat's messages in (reverse) chronological order, one range scan of ix_chat_messages_history"""
+    if newest_first:
+        order = (ChatMessage.created_at.desc(), ChatMessage.role, ChatMessage.id.desc())
+    else:
+        order = (ChatMessage.created_at, ChatMessage.role.desc(), ChatMessage.id)
+    return select(ChatMessage).where(ChatMessage.chat_id == chat_id).order_by(*order)
+
+async def load_recent_messages(db: AsyncSession, chat: Chat, budget: int) -> List[ChatMessage]:
+    """
+    The newest unsummarized messages, oldest first: enough to fill budget and
+    CHAT_SUMMARY_MIN_TOKENS more, which is all build_context looks at.
+    """
+    unsummarized = max(chat.message_count - (chat.summary_message_count or 0), 0)
+    wanted = budget + Config.CHAT_SUMMARY_MIN_TOKENS
+    messages, tokens = [], 0
+    while len(messages) < unsummarized and tokens < wanted:
+        page = (await db.scalars(
+            _history(chat.id, newest_first=True)
+            .offset(len(messages))
+            .limit(min(Config.CHAT_CONTEXT_PAGE_SIZE, unsummarized - len(messages)))
+        )).all()
+        if not page:
+            break
+        messages.extend(page)
+        tokens += sum(message_tokens(msg) for msg in page)
+    return list(reversed(messages))
+
+def _window_start(history: List[ChatMessage], budget: int, used: int) -> int:
+    """Index of the oldest message that still fits, walking back from the newest"""
+    start = len(history)
+    while start > 0:
+        cost = message_tokens(history[start - 1])
+        if used + cost > budget:
+            break
+        used += cost
+        start -= 1
+    return start
+
+def build_context(chat: Chat, history: List[ChatMessage], new_message: str, budget: int) -> Tuple[List[dict], bool]:
+    """
+    Messages for the upstream call: the summary (as a system message), the
+    most recent messages of history (load_recent_messages) that fit into
+    budget and the new user message.
+    Also returns whether enough messages fell out of the window unsummarized
+    to be worth a summary refresh.
+    """
+    prefix = _summary_message(chat)
+    used = count_tokens(new_message) + _summary_tokens(chat)
+    start = _window_start(history, budget, used)
+
+    messages = prefix + [
+        {"role": msg.role, "content": msg.content}
+        for msg in history[start:]
+    ] + [{"role": "user", "content": new_message}]
+
+    unsummarized = sum(message_tokens(msg) for msg in history[:start])
+    return messages, unsummarized >= Config.CHAT_SUMMARY_MIN_TOKENS
+
+def _summary_prompt(summary: str, messages: List[ChatMessage]) -> List[dict]:
+    transcript = "\n".join(f"{msg.role}: {msg.content}" for msg in messages)
+    return [
+        {"role": "system", "content": SUMMARY_INSTRUCTIONS},
+        {"role": "user", "content": f"Current summary:\n{summary or '(none)'}\n\nNew messages:\n{transcript}"}
+    ]
+
+async def refresh_summary(chat_id: str, budget: int, role_name: Optional[str] = None):
+    """Fold the oldest unsummarized messages that are outside the window into the summary"""
+    from app.database import get_async_db
+    from app.services.openai_client import chat_completion
+
+    async with aclosing(get_async_db()) as sessions:
+        db = await anext(sessions)
+        chat = await db.get(Chat, chat_id)
+        if not chat:
+            return
+
+        # Only messages the current window no longer covers, one bounded chunk at a time
+        summarized = chat.summary_message_count or 0
+        recent = await load_recent_messages(db, chat, budget)
+        window = len(recent) - _window_start(recent, budget, _summary_tokens(chat))
+        outside = chat.message_count - window - summarized
+
+        chunk, chunk_tokens = [], 0
+        while len(chunk) < outside and chunk_tokens < Config.CHAT_SUMMARY_CHUNK_TOKENS:
+            page = (await db.scalars(
+                _history(chat.id, newest_first=False)
+                .offset(summarized + len(chunk))
+                .limit(min(Config.CHAT_CONTEXT_PAGE_SIZE, outside - len(chunk)))
+            )).all()
+            if not page:
+                break
+            for msg in page:
+                if chunk_tokens >= Config.CHAT_SUMMARY_CHUNK_TOKENS:
+                    break
+                chunk.append(msg)
+                chunk_tokens += message_tokens(msg)
+        if not chunk:
+            return
+
+        # Platform cost (see above): not charged to the user's wallet
+        response = await chat_completion(
+            _summary_prompt(chat.summary, chunk),
+            user_id=str(chat.user_id), role_name=role_name
+        )
+
+        # Another worker may have folded the same messages already; keep updated_at (chat list order)
+        await db.execute(
+            update(Chat)
+            .where(Chat.id == chat_id, Chat.summary_message_count == summarized)
+            .values(
+                summary=response["message"]["content"],
+                summary_message_count=summarized + len(chunk),
+                updated_at=Chat.updated_at
+            )
+        )
+        await db.commit()
+
+_refreshing = {}
+
+def schedule_summary_refresh(chat_id: str, budget: int, role_name: Optional[str] = None):
+    """Start refresh_summary in the background (at most one per chat on this worker)"""
+    chat_id = str(chat_id)
+    if chat_id in _refreshing:
+        return
+
+    async def run():
+        try:
+            await refresh_summary(chat_id, budget, role_name)
+        except Exception as e:
+            print(f"Chat summary refresh failed for {chat_id}: {e}")
+        finally:
+            _refreshing.pop(chat_id, None)
+
+    # Background work: not bound by the deadline of the request that scheduled it
+    with deadline.suspended():
+        _refreshing[chat_id] = asyncio.create_task(run())
@@ -0,0 +1,87 @@
+import time
+import asyncio
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional, Awaitable, Any
+from app.config import Config
+
+# Request-scoped deadline. DeadlineMiddleware sets it per route; each layer
+# (DB pool checkout, Redis commands, admission, upstream calls) takes at most
+# what is left of it and fails with DeadlineExceeded(stage) instead of starting
+# work it can't finish. Outside a request (background tasks) there is no
+# deadline and every layer keeps its own timeouts.
+
+_deadline = ContextVar("request_deadline", default=None)
+
+class DeadlineExceeded(Exception):
+    def __init__(self, stage: str):
+        super().__init__(f"Deadline exceeded in {stage}")
+        self.stage = stage
+
+class _DeadlineStats:
+    def __init__(self):
+        self.exceeded = {}
+
+    def record(self, stage: str):
+        self.exceeded[stage] = self.exceeded.get(stage, 0) + 1
+        print(f"Request deadline exceeded in {stage}")
+
+    def stats(self) -> dict:
+        return {"exceeded": dict(self.exceeded)}
+
+deadline_stats = _DeadlineStats()
+
+def start(seconds: Optional[float]):
+    """Set the deadline for the current request; returns a token for reset()"""
+    return _deadline.set(time.monotonic() + seconds if seconds is not None else None)
+
+def reset(token):
+    _deadline.reset(token)
+
+def lift():
+    """Drop the deadline for the rest of this task (the reply is already streaming)"""
+    _deadline.set(None)
+
+@contextmanager
+def suspended():
+    """No deadline inside the block: bookkeeping for work that is already committed must finish"""
+    token = _deadline.set(None)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+def remaining() -> Optional[float]:
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+def stage_timeout(stage: str, default: Optional[float] = None, minimum: float = None) -> Optional[float]:
+    """
+    How long a stage may take: its own timeout capped by the time left.
+    Raises DeadlineExceeded when less than minimum is left to finish it.
+    """
+    left = remaining()
+    if left is None:
+        return default
+    if left < (Config.DEADLINE_MIN_STAGE if minimum is None else minimum):
+        deadline_stats.record(stage)
+        raise DeadlineExceeded(stage)
+    return left if default is None else min(default, left)
+
+async def run_stage(stage: str, work: Awaitable, default: Optional[float] = None, minimum: float = None) -> Any:
+    """Await work within stage_timeout (no extra task when neither bound applies)"""
+    try:
+        timeout = stage_timeout(stage, default, minimum)
+    except DeadlineExceeded:
+        if asyncio.iscoroutine(work):
+            work.close()
+        raise
+    if timeout is None:
+        return await work
+    try:
+        return await asyncio.wait_for(work, timeout)
+    except asyncio.TimeoutError:
+        if remaining() is not None and remaining() <= 0:
+            deadline_stats.record(stage)
+            raise DeadlineExceeded(stage)
+        raise
@@ -16,17 +16,6 @@ class DeviceTracker:
         self.secret = os.getenv("DEVICE_FINGERPRINT_SECRET")
         if not self.secret:
             raise ValueError("DEVICE_FINGERPRINT_SECRET environment variable is required")
-        
-        # Initialize Redis connection for security features
-        try:
-            import redis
-            redis_url = os.getenv("REDIS_URL", "redis://localhost:6379")
-            self.redis = redis.from_url(redis_url, decode_responses=True)
-            # Initialize security manager with Redis
-            from app.services.security import security_manager
-            security_manager.redis = self.redis
-        except Exception:
-            self.redis = None
     
     def extract_hardware_signals(self, fingerprint_data: Dict) -> Dict:
         """Extract stable hardware characteristics"""
@@ -55,7 +44,8 @@ class DeviceTracker:
                 # Touch hardware
                 'touch_signature': str(data.get('maxTouchPoints', 0))
             }
-        except:
+        except (ValueError, TypeError, AttributeError):
+            # Malformed fingerprint payload
             return {}
     
     def _normalize_gpu(self, gpu_string: str) -> str:
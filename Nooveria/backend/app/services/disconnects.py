@@ -0,0 +1,54 @@
+import asyncio
+from typing import Awaitable, Any
+from fastapi import Request
+from app.config import Config
+from app.services import deadline
+
+# Upstream work for clients that went away. Non-streaming requests run their
+# upstream call under run_unless_disconnected, which cancels it when the client
+# disconnects (nothing was delivered, so the hold is released). Streams are
+# cancelled by Starlette itself; the stream handlers then bill only what was
+# streamed. Both are counted here to size the capacity lost to abandoned requests.
+
+class ClientDisconnected(Exception):
+    def __init__(self):
+        super().__init__("Client disconnected")
+
+class _DisconnectStats:
+    cancelled_requests = 0
+    abandoned_streams = 0
+    partial_tokens_billed = 0
+
+    def stats(self) -> dict:
+        return {
+            "cancelled_requests": self.cancelled_requests,
+            "abandoned_streams": self.abandoned_streams,
+            "partial_tokens_billed": self.partial_tokens_billed
+        }
+
+disconnect_stats = _DisconnectStats()
+
+async def run_unless_disconnected(http_request: Request, work: Awaitable) -> Any:
+    """Await work, cancelling it and raising ClientDisconnected if the client goes away first"""
+    task = asyncio.ensure_future(work)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=Config.DISCONNECT_POLL_INTERVAL)
+            if done:
+                return task.result()
+            if await http_request.is_disconnected():
+                task.cancel()
+                disconnect_stats.cancelled_requests += 1
+                raise ClientDisconnected()
+    finally:
+        if not task.done():
+            task.cancel()
+
+_settling = set()
+
+def run_detached(work: Awaitable):
+    """Finish work outside the (cancelled) request task and its deadline"""
+    with deadline.suspended():
+        task = asyncio.ensure_future(work)
+    _settling.add(task)
+    task.add_done_callback(_settling.discard)
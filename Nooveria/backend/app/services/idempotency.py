@@ -0,0 +1,169 @@
+import json
+import time
+import uuid
+import asyncio
+import hashlib
+from typing import Optional, Dict, Any
+from redis.exceptions import RedisError
+from app.config import Config
+from app.services import deadline
+from app.services.redis_client import get_redis
+
+# Idempotency-Key support for chat message submission. The first request with
+# a key takes a Redis lock for it; duplicates that arrive while it runs wait
+# for it, and any later duplicate gets the stored response (kept for
+# IDEMPOTENCY_TTL) without another upstream call or charge. A request that
+# fails releases the key without storing anything, so its retry runs again.
+# Keys are per user and per route, and may not be reused for a different body.
+# A streamed reply can outlive IDEMPOTENCY_LOCK_TTL (the deadline is lifted at
+# the first token), so the stream refreshes the lock as it goes.
+# If Redis is unavailable requests run as if they had no key.
+
+IDEMPOTENCY_PREFIX = "idempotency:"
+IDEMPOTENCY_LOCK_PREFIX = "idempotency_lock:"
+MAX_KEY_LENGTH = 255
+
+# KEYS[1] = lock, ARGV[1] = owner token
+_RELEASE_LOCK = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# KEYS[1] = lock, ARGV[1] = owner token, ARGV[2] = ttl in seconds
+_EXTEND_LOCK = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+class IdempotencyConflict(Exception):
+    def __init__(self):
+        super().__init__("Idempotency key reused with a different request")
+
+class IdempotencyInProgress(Exception):
+    def __init__(self):
+        super().__init__("Request with this idempotency key still in progress")
+
+class _IdempotencyStats:
+    replayed = 0
+    waited = 0
+    conflicts = 0
+    saved_tokens = 0
+
+    def stats(self) -> dict:
+        return {
+            "replayed": self.replayed,
+            "waited": self.waited,
+            "conflicts": self.conflicts,
+            "saved_tokens": self.saved_tokens
+        }
+
+idempotency_stats = _IdempotencyStats()
+
+def request_fingerprint(payload: Dict[str, Any]) -> str:
+    encoded = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+class IdempotentRequest:
+    """One request's claim on its Idempotency-Key (a no-op without a key)"""
+
+    def __init__(self, key: Optional[str], user_id: str, scope: str, payload: Dict[str, Any]):
+        self.key = key
+        name = f"{user_id}:{scope}:{key}"
+        self.result_key = IDEMPOTENCY_PREFIX + name
+        self.lock_key = IDEMPOTENCY_LOCK_PREFIX + name
+        self.fingerprint = request_fingerprint(payload)
+        self.token = None
+        self.refresh_at = 0.0
+
+    def _replay(self, stored: str, waited: bool) -> dict:
+        stored = json.loads(stored)
+        if stored["fingerprint"] != self.fingerprint:
+            idempotency_stats.conflicts += 1
+            raise IdempotencyConflict()
+        response = stored["response"]
+        idempotency_stats.replayed += 1
+        idempotency_stats.waited += int(waited)
+        idempotency_stats.saved_tokens += response.get("usage", {}).get("total_tokens", 0)
+        return response
+
+    async def begin(self) -> Optional[dict]:
+        """
+        The stored response of an earlier request with this key, or None once
+        this request owns the key. Waits while another request holds it;
+        raises IdempotencyInProgress if it holds it for too long.
+        """
+        if self.key is None:
+            return None
+        if not 0 < len(self.key) <= MAX_KEY_LENGTH:
+            raise Exception("Invalid idempotency key")
+
+        redis = get_redis()
+        token = uuid.uuid4().hex
+        wait_limit = deadline.stage_timeout("idempotency", Config.IDEMPOTENCY_LOCK_TTL)
+        give_up = time.monotonic() + wait_limit
+        waited = False
+        try:
+            while True:
+                stored = await redis.get(self.result_key)
+                if stored is not None:
+                    return self._replay(stored, waited)
+                if await redis.set(self.lock_key, token, nx=True, ex=Config.IDEMPOTENCY_LOCK_TTL):
+                    # The holder may have stored its response between the two calls
+                    stored = await redis.get(self.result_key)
+                    if stored is None:
+                        self.token = token
+                        self.refresh_at = time.monotonic() + Config.IDEMPOTENCY_LOCK_TTL / 3
+                        return None
+                    await redis.eval(_RELEASE_LOCK, 1, self.lock_key, token)
+                    return self._replay(stored, waited)
+
+                if time.monotonic() >= give_up:
+                    if wait_limit < Config.IDEMPOTENCY_LOCK_TTL:
+                        deadline.deadline_stats.record("idempotency")
+                        raise deadline.DeadlineExceeded("idempotency")
+                    raise IdempotencyInProgress()
+                waited = True
+                await asyncio.sleep(Config.IDEMPOTENCY_POLL_INTERVAL)
+        except RedisError as e:
+            print(f"Idempotency check failed, running without it: {e}")
+            self.token = None
+            return None
+
+    async def finish(self, response: dict):
+        """Store the response for duplicates and release the key"""
+        if self.token is None:
+            return
+        stored = json.dumps({"fingerprint": self.fingerprint, "response": response}, ensure_ascii=False)
+        # Stored before the lock goes, so waiters that see no lock and no response know the request failed
+        with deadline.suspended():
+            try:
+                await get_redis().set(self.result_key, stored, ex=Config.IDEMPOTENCY_TTL)
+            except RedisError as e:
+                print(f"Idempotency store failed: {e}")
+            await self.abandon()
+
+    async def refresh(self):
+        """Extend the key's lock while the request is still running (at most once per third of its TTL)"""
+        if self.token is None or time.monotonic() < self.refresh_at:
+            return
+        self.refresh_at = time.monotonic() + Config.IDEMPOTENCY_LOCK_TTL / 3
+        with deadline.suspended():
+            try:
+                await get_redis().eval(_EXTEND_LOCK, 1, self.lock_key, self.token, Config.IDEMPOTENCY_LOCK_TTL)
+            except RedisError as e:
+                print(f"Idempotency lock refresh failed: {e}")
+
+    async def abandon(self):
+        """Release the key without a response (the request failed and may be retried)"""
+        if self.token is None:
+            return
+        token, self.token = self.token, None
+        with deadline.suspended():
+            try:
+                await get_redis().eval(_RELEASE_LOCK, 1, self.lock_key, token)
+            except RedisError as e:
+                print(f"Idempotency unlock failed: {e}")
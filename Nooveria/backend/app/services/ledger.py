@@ -0,0 +1,342 @@
+import os
+import glob
+import json
+import uuid
+import fcntl
+import asyncio
+import threading
+from decimal import Decimal
+from datetime import datetime, timezone
+from typing import List, Optional
+from sqlalchemy import insert, delete, select, event, exc
+from sqlalchemy.util import await_only
+from sqlalchemy.orm import Session
+from app.models import Transaction, UsageRecord, WalletEvent, TransactionType, LedgerCommit
+from app.config import Config
+
+# Write-behind ledger for the append-only billing rows (Transaction, UsageRecord,
+# WalletEvent). Balance updates stay synchronous in services/wallet.py; only the
+# history rows are buffered and written in batches with multi-row INSERTs.
+#
+# Crash safety: record_charge appends the entry to a per-process write-ahead
+# log and inserts a LedgerCommit marker (its entry_id) through the caller's
+# session, so the marker commits or rolls back with the balance update. The
+# WAL is fsynced before that commit (before_commit hook); concurrent commits
+# share one fsync (group commit), run in a worker thread so the event loop
+# never blocks on the disk. A flush writes the rows of the entries whose
+# marker exists and deletes those markers in the same transaction; entries
+# whose transaction rolled back have no marker and are dropped. The WAL is
+# rewritten after each flush, and WALs of dead processes are replayed on
+# startup: the markers tell which of their entries committed and are still
+# unwritten, so each charge is written exactly once.
+
+# Key of the entry id in Transaction.meta, and of the session's entries in Session.info
+ENTRY_ID_KEY = "ledger_entry_id"
+_PENDING_KEY = "ledger_pending_entries"
+
+def _serialize_entry(transaction: dict, usage: Optional[dict], events: List[dict]) -> dict:
+    now = datetime.now(timezone.utc).isoformat()
+    entry_id = uuid.uuid4().hex
+    return {
+        "entry_id": entry_id,
+        "transaction": {
+            "wallet_from_id": transaction["wallet_from_id"],
+            "amount_tokens": str(transaction["amount_tokens"]),
+            "type": transaction["type"].name,
+            "meta": {**(transaction["meta"] or {}), ENTRY_ID_KEY: entry_id},
+            "created_at": now
+        },
+        "usage": {**usage, "user_id": str(usage["user_id"]), "request_timestamp": now} if usage else None,
+        "events": [
+            {
+                **event,
+                "id": str(event.get("id") or uuid.uuid4()),
+                "user_id": str(event["user_id"]),
+                "chat_id": str(event["chat_id"]) if event.get("chat_id") else None,
+                "world_id": event.get("world_id"),
+                "amount": str(event["amount"]),
+                "created_at": now
+            }
+            for event in events
+        ]
+    }
+
+def _write_entries(db: Session, entries: List[dict]) -> List[int]:
+    """Insert a batch of ledger entries with one multi-row INSERT per table"""
+    if not entries:
+        return []
+    transaction_rows = [
+        {
+            **entry["transaction"],
+            "amount_tokens": Decimal(entry["transaction"]["amount_tokens"]),
+            "type": TransactionType[entry["transaction"]["type"]],
+            "created_at": datetime.fromisoformat(entry["transaction"]["created_at"])
+        }
+        for entry in entries
+    ]
+    transaction_ids = db.execute(
+        insert(Transaction).returning(Transaction.id, sort_by_parameter_order=True),
+        transaction_rows
+    ).scalars().all()
+
+    usage_rows = [
+        {
+            **entry["usage"],
+            "user_id": uuid.UUID(entry["usage"]["user_id"]),
+            "request_timestamp": datetime.fromisoformat(entry["usage"]["request_timestamp"]),
+            "transaction_id": transaction_id
+        }
+        for entry, transaction_id in zip(entries, transaction_ids) if entry["usage"]
+    ]
+    if usage_rows:
+        db.execute(insert(UsageRecord), usage_rows)
+
+    event_rows = [
+        {
+            **event,
+            "id": uuid.UUID(event["id"]),
+            "user_id": uuid.UUID(event["user_id"]),
+            "chat_id": uuid.UUID(event["chat_id"]) if event.get("chat_id") else None,
+            "amount": Decimal(event["amount"]),
+            "created_at": datetime.fromisoformat(event["created_at"])
+        }
+        for entry in entries for event in entry["events"]
+    ]
+    if event_rows:
+        db.execute(insert(WalletEvent), event_rows)
+
+    return transaction_ids
+
+class LedgerWriter:
+    """Buffers ledger entries in memory + WAL and flushes them in batches"""
+
+    def __init__(self, wal_dir: str = None, batch_size: int = None, flush_interval: float = None, session_factory=None):
+        self.session_factory = session_factory
+        self.wal_dir = wal_dir or Config.LEDGER_WAL_DIR
+        self.batch_size = batch_size or Config.LEDGER_BATCH_SIZE
+        self.flush_interval = flush_interval or Config.LEDGER_FLUSH_INTERVAL
+        self.running = False
+        self._buffer: List[dict] = []
+        # Entries whose transaction has not finished yet (no marker to look for)
+        self._pending = set()
+        # WAL positions, counted in appended entries
+        self._appended = 0
+        self._synced = 0
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wal = None
+        self._wal_path = None
+        self._task = None
+
+    def _open_wal(self, path: str):
+        wal = open(path, "a", encoding="utf-8")
+        fcntl.flock(wal.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return wal
+
+    def _write_wal(self, entries: List[dict]):
+        """Hand entries to the OS (caller holds _lock); sync() makes them durable"""
+        self._wal.write("".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in entries))
+        self._wal.flush()
+        self._appended += len(entries)
+
+    def _append_wal(self, entries: List[dict]):
+        self._write_wal(entries)
+        os.fsync(self._wal.fileno())
+        self._synced = self._appended
+
+    def _rewrite_wal(self):
+        """Replace the WAL with the entries that are still buffered (caller holds _sync_lock and _lock)"""
+        tmp_path = self._wal_path + ".tmp"
+        wal = self._open_wal(tmp_path)
+        wal.truncate(0)
+        old_wal, self._wal = self._wal, wal
+        self._append_wal(self._buffer)
+        os.replace(tmp_path, self._wal_path)
+        old_wal.close()
+
+    def _load_orphaned_wals(self) -> List[dict]:
+        """Collect entries from WALs whose process is gone (their lock is free)"""
+        entries = []
+        for path in sorted(glob.glob(os.path.join(self.wal_dir, "ledger-*.wal"))):
+            if path == self._wal_path:
+                continue
+            try:
+                orphan = open(path, "r+", encoding="utf-8")
+                fcntl.flock(orphan.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (BlockingIOError, OSError):
+                continue  # still owned by a live worker
+
+            orphan_entries = []
+            with orphan:
+                for line in orphan:
+                    try:
+                        orphan_entries.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        pass  # torn last line from the crash, never synced before a commit
+                # Take over the entries in our own WAL before dropping the orphan
+                self._append_wal(orphan_entries)
+                os.remove(path)
+            entries.extend(orphan_entries)
+        return entries
+
+    def append(self, entry: dict) -> int:
+        """Buffer an entry whose transaction is still open. Returns its WAL position for sync()."""
+        with self._lock:
+            self._write_wal([entry])
+            self._buffer.append(entry)
+            self._pending.add(entry["entry_id"])
+            return self._appended
+
+    def finished(self, entry_ids: List[str]):
+        """The transaction of these entries committed or rolled back; their marker now decides"""
+        with self._lock:
+            self._pending.difference_update(entry_ids)
+
+    def sync(self, position: int):
+        """fsync the WAL up to position. Callers waiting meanwhile are covered by the same fsync."""
+        with self._sync_lock:
+            if self._synced >= position:
+                return
+            with self._lock:
+                target = self._appended
+            os.fsync(self._wal.fileno())
+            self._synced = max(self._synced, target)
+
+    def flush(self) -> int:
+        """
+        Write the buffered entries whose charge committed to the database, drop
+        those whose charge rolled back. Returns the number of entries settled.
+        """
+        from app.database import SessionLocal
+
+        session_factory = self.session_factory or SessionLocal
+        with self._flush_lock:
+            with self._lock:
+                batch = self._buffer[:self.batch_size]
+                # Taken before the markers are read: an entry finished by then has its final marker state
+                pending = set(self._pending)
+            if not batch:
+                return 0
+
+            db = session_factory()
+            try:
+                entry_ids = [uuid.UUID(entry["entry_id"]) for entry in batch]
+                committed = {
+                    entry_id.hex for entry_id in db.scalars(
+                        select(LedgerCommit.entry_id).where(LedgerCommit.entry_id.in_(entry_ids))
+                    ).all()
+                }
+                _write_entries(db, [entry for entry in batch if entry["entry_id"] in committed])
+                db.execute(delete(LedgerCommit).where(LedgerCommit.entry_id.in_([uuid.UUID(entry_id) for entry_id in committed])))
+                db.commit()
+            except Exception as e:
+                db.rollback()
+                print(f"Ledger flush failed, will retry: {e}")
+                return 0
+            finally:
+                db.close()
+
+            settled = {entry["entry_id"] for entry in batch if entry["entry_id"] in committed or entry["entry_id"] not in pending}
+            with self._sync_lock, self._lock:
+                self._buffer = [entry for entry in self._buffer if entry["entry_id"] not in settled]
+                self._rewrite_wal()
+            return len(settled)
+
+    def open_wal(self):
+        """Open this process's WAL and adopt entries from orphaned ones"""
+        os.makedirs(self.wal_dir, exist_ok=True)
+        self._wal_path = os.path.join(self.wal_dir, f"ledger-{os.getpid()}-{uuid.uuid4().hex[:8]}.wal")
+        self._wal = self._open_wal(self._wal_path)
+
+        replayed = self._load_orphaned_wals()
+        if replayed:
+            print(f"Replaying {len(replayed)} ledger entries from previous runs")
+            with self._lock:
+                self._buffer.extend(replayed)
+
+    def start(self):
+        """Open the WAL and start the flush loop"""
+        self.open_wal()
+        self.running = True
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        from starlette.concurrency import run_in_threadpool
+
+        while self.running:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                while await run_in_threadpool(self.flush) == self.batch_size:
+                    pass
+            except Exception as e:
+                print(f"Ledger writer error: {e}")
+
+    async def stop(self):
+        """Stop the loop and flush whatever is left"""
+        from starlette.concurrency import run_in_threadpool
+
+        self.running = False
+        if self._task:
+            self._task.cancel()
+        while self._buffer and await run_in_threadpool(self.flush):
+            pass
+        if self._wal:
+            empty = not self._buffer
+            self._wal.close()
+            if empty:
+                os.remove(self._wal_path)
+
+    def stats(self) -> dict:
+        return {"running": self.running, "buffered_entries": len(self._buffer), "pending_entries": len(self._pending)}
+
+# Global ledger writer (started in app startup)
+ledger_writer = LedgerWriter()
+
+def record_charge(db: Session, transaction: dict, usage: Optional[dict] = None, events: Optional[List[dict]] = None) -> Optional[int]:
+    """
+    Record the ledger rows of one charge.
+    Queued for a batched write when the writer is running (written once the
+    caller commits db), otherwise written through the caller's session
+    (committed by the caller). Returns the transaction id for synchronous
+    writes, None when queued.
+    """
+    entry = _serialize_entry(transaction, usage, events or [])
+    if not ledger_writer.running:
+        return _write_entries(db, [entry])[0]
+
+    db.execute(insert(LedgerCommit).values(entry_id=uuid.UUID(entry["entry_id"])))
+    position = ledger_writer.append(entry)
+    pending = db.info.setdefault(_PENDING_KEY, {"entries": [], "position": 0})
+    pending["entries"].append(entry["entry_id"])
+    pending["position"] = position
+    return None
+
+def _sync_wal(position: int):
+    """ledger_writer.sync, off the event loop when called from an AsyncSession"""
+    from starlette.concurrency import run_in_threadpool
+
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        ledger_writer.sync(position)  # a worker thread (sync session)
+        return
+    try:
+        await_only(run_in_threadpool(ledger_writer.sync, position))
+    except exc.MissingGreenlet:
+        ledger_writer.sync(position)  # a sync session used on the loop
+
+@event.listens_for(Session, "before_commit")
+def _sync_before_commit(session: Session):
+    # The WAL must hold the entries before their markers commit
+    pending = session.info.get(_PENDING_KEY)
+    if pending:
+        _sync_wal(pending["position"])
+
+@event.listens_for(Session, "after_transaction_end")
+def _finish_entries(session: Session, transaction):
+    if transaction.parent is not None:
+        return
+    pending = session.info.pop(_PENDING_KEY, None)
+    if pending:
+        ledger_writer.finished(pending["entries"])
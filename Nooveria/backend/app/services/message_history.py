@@ -0,0 +1,46 @@
+import uuid
+from typing import Optional, Tuple, List, Any
+from sqlalchemy import select, and_, or_
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.config import Config
+
+# Keyset pagination of chat history (chat_messages and world_chat_messages),
+# newest first. A user message and its reply are written in one transaction
+# and share created_at, so the key is (created_at, role, id): chronological
+# order is created_at, then "user" before "assistant". Each page is one index
+# range scan on (chat id, created_at DESC, role, id DESC), whatever the length
+# of the chat. Pages come back oldest first, ready to prepend.
+
+def page_limit(limit: Optional[int]) -> int:
+    if limit is None:
+        return Config.MESSAGE_PAGE_SIZE
+    return max(1, min(limit, Config.MESSAGE_PAGE_MAX))
+
+async def load_message_page(db: AsyncSession, model: Any, chat_column: Any, chat_id, before: Optional[uuid.UUID], limit: int) -> Tuple[List[Any], bool]:
+    """
+    (messages, has_more): the newest limit messages of the chat that are
+    older than message before (the newest overall without it).
+    """
+    query = select(model).where(chat_column == chat_id)
+    if before is not None:
+        cursor = (await db.execute(
+            select(model.created_at, model.role, model.id).where(chat_column == chat_id, model.id == before)
+        )).first()
+        if cursor is None:
+            raise Exception("Invalid cursor")
+        created_at, role, message_id = cursor
+        query = query.where(
+            model.created_at <= created_at,
+            or_(
+                model.created_at < created_at,
+                and_(model.created_at == created_at, or_(
+                    model.role > role,
+                    and_(model.role == role, model.id < message_id)
+                ))
+            )
+        )
+
+    rows = (await db.scalars(
+        query.order_by(model.created_at.desc(), model.role, model.id.desc()).limit(limit + 1)
+    )).all()
+    return list(reversed(rows[:limit])), len(rows) > limit
@@ -1,11 +1,15 @@
 import os
-from typing import List, Dict, Any
+from typing import List, Dict, Any, AsyncIterator, Optional
 import asyncio
 import random
 import httpx
+from app.services.admission import upstream_scheduler
+from app.config import Config
+from app.services.deadline import DeadlineExceeded, run_stage, stage_timeout
 
 # Mock mode for development
-MOCK_MODE = os.getenv("OPENAI_API_KEY", "").startswith("mock-") or not os.getenv("OPENAI_API_KEY")
+_API_KEY = os.getenv("OPENAI_API_KEY") or os.getenv("OPENAI_API_KEYS", "").split(",")[0].strip()
+MOCK_MODE = _API_KEY.startswith("mock-") or not _API_KEY
 
 # Connection pooling for production - will be closed properly
 _http_client = None
@@ -26,29 +30,37 @@ async def close_http_client():
         _http_client = None
 
 if not MOCK_MODE:
-    from openai import AsyncOpenAI
-    client = AsyncOpenAI(
-        api_key=os.getenv("OPENAI_API_KEY"),
-        http_client=get_http_client()
-    )
+    # One client per configured key / base URL, picked per call by health
+    from app.services.upstream_router import build_router
+    upstream_router = build_router(get_http_client())
+
+def upstream_stats() -> dict:
+    if MOCK_MODE:
+        return {"endpoints": [], "hedging": None}
+    return {"endpoints": upstream_router.stats(), "hedging": upstream_router.hedge_stats()}
 
-async def chat_completion(messages: List[Dict[str, str]], model: str = "gpt-3.5-turbo") -> Dict[str, Any]:
+MOCK_RESPONSES = [
+    "This is a mock response from OrthodoxGPT. The real OpenAI integration will work once you add your API key.",
+    "Hello! I'm a simulated AI response for development purposes. Your wallet system and billing are working correctly.",
+    "Mock AI: I can help you test the frontend while you develop. Add OPENAI_API_KEY to .env for real responses.",
+    "Development mode active. This response simulates OpenAI's API without making real calls or charges."
+]
+
+async def chat_completion(messages: List[Dict[str, str]], model: str = "gpt-3.5-turbo", user_id: Optional[str] = None, role_name: Optional[str] = None) -> Dict[str, Any]:
     """
-    Call OpenAI API with connection pooling or return mock response.
+    Call OpenAI API with connection pooling or return mock response, once the
+    admission scheduler gives the caller a slot (raises UpstreamBusy otherwise).
     CRITICAL: This function does NOT store any chat content.
     """
+    async with upstream_scheduler.slot(user_id, role_name):
+        return await _chat_completion(messages, model)
+
+async def _chat_completion(messages: List[Dict[str, str]], model: str) -> Dict[str, Any]:
     if MOCK_MODE:
         # Mock response for development
         await asyncio.sleep(0.5)  # Simulate API delay
         
-        mock_responses = [
-            "This is a mock response from OrthodoxGPT. The real OpenAI integration will work once you add your API key.",
-            "Hello! I'm a simulated AI response for development purposes. Your wallet system and billing are working correctly.",
-            "Mock AI: I can help you test the frontend while you develop. Add OPENAI_API_KEY to .env for real responses.",
-            "Development mode active. This response simulates OpenAI's API without making real calls or charges."
-        ]
-        
-        content = random.choice(mock_responses)
+        content = random.choice(MOCK_RESPONSES)
         tokens_used = len(content.split()) * 2  # Rough token estimate
         
         return {
@@ -66,11 +78,12 @@ async def chat_completion(messages: List[Dict[str, str]], model: str = "gpt-3.5-
         }
     
     try:
-        response = await client.chat.completions.create(
+        response = await run_stage("upstream", upstream_router.hedged_call(lambda client: client.chat.completions.create(
             model=model,
             messages=messages,
-            max_tokens=4000
-        )
+            max_tokens=4000,
+            timeout=_attempt_timeout()
+        )))
         
         return {
             "message": {
@@ -85,5 +98,137 @@ async def chat_completion(messages: List[Dict[str, str]], model: str = "gpt-3.5-
             "model": response.model,
             "id": response.id
         }
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        raise Exception(f"OpenAI API error: {str(e)}")
+
+def _attempt_timeout() -> float:
+    """Timeout of one upstream attempt, capped by the request deadline"""
+    return stage_timeout("upstream", Config.UPSTREAM_TIMEOUT, Config.UPSTREAM_MIN_BUDGET)
+
+def _usage_to_dict(usage) -> Dict[str, int]:
+    """Normalize a usage object from a stream chunk (model or raw dict)"""
+    if isinstance(usage, dict):
+        get = usage.get
+    else:
+        get = lambda key: getattr(usage, key, None)
+    prompt_tokens = get("prompt_tokens") or 0
+    completion_tokens = get("completion_tokens") or 0
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": get("total_tokens") or prompt_tokens + completion_tokens
+    }
+
+def _estimate_stream_usage(messages: List[Dict[str, str]], content: str, chunks: int) -> Dict[str, int]:
+    """Fallback usage when upstream did not send a final usage chunk"""
+    from app.services.tokenizer import count_tokens, count_message_tokens
+    prompt_tokens = count_message_tokens(messages)
+    completion_tokens = max(chunks, count_tokens(content))
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens
+    }
+
+async def _open_stream(client, messages: List[Dict[str, str]], model: str):
+    """Start a stream and wait for its first chunk; returns (stream, all chunks)"""
+    stream = await client.chat.completions.create(
+        model=model,
+        messages=messages,
+        max_tokens=4000,
+        stream=True,
+        extra_body={"stream_options": {"include_usage": True}},
+        timeout=_attempt_timeout()
+    )
+    iterator = stream.__aiter__()
+    try:
+        first = [await iterator.__anext__()]
+    except StopAsyncIteration:
+        first = []
+    
+    async def chunks():
+        for chunk in first:
+            yield chunk
+        async for chunk in iterator:
+            yield chunk
+    
+    return stream, chunks()
+
+async def _close_stream(opened):
+    """Close the stream of a hedged attempt that lost"""
+    stream, _ = opened
+    await stream.response.aclose()
+
+async def chat_completion_stream(messages: List[Dict[str, str]], model: str = "gpt-3.5-turbo", user_id: Optional[str] = None, role_name: Optional[str] = None) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Stream a completion as it is generated, holding an admission slot until it ends.
+    Yields {"type": "delta", "content": ...} for every token and finishes with
+    {"type": "done", "message", "usage", "model", "id"} built from the final usage chunk.
+    CRITICAL: This function does NOT store any chat content.
+    """
+    async with upstream_scheduler.slot(user_id, role_name):
+        async for chunk in _chat_completion_stream(messages, model):
+            yield chunk
+
+async def _chat_completion_stream(messages: List[Dict[str, str]], model: str) -> AsyncIterator[Dict[str, Any]]:
+    if MOCK_MODE:
+        # Mock stream for development and offline load testing
+        await asyncio.sleep(0.2)  # Simulate time to first token
+        
+        content = random.choice(MOCK_RESPONSES)
+        words = content.split(" ")
+        for i, word in enumerate(words):
+            yield {"type": "delta", "content": word if i == 0 else " " + word}
+            await asyncio.sleep(0.03)
+        
+        completion_tokens = len(words) * 2
+        prompt_tokens = random.randint(10, 50)
+        yield {
+            "type": "done",
+            "message": {"role": "assistant", "content": content},
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens
+            },
+            "model": "mock-gpt-3.5-turbo",
+            "id": f"mock-{random.randint(1000, 9999)}"
+        }
+        return
+    
+    try:
+        # Routed (and hedged) up to the first chunk; a stream that breaks later is not retried
+        # The request deadline covers the wait for the first token only
+        _, chunks = await run_stage("upstream_first_token", upstream_router.hedged_call(
+            lambda client: _open_stream(client, messages, model),
+            kind="first_token",
+            discard=_close_stream
+        ))
+        
+        parts = []
+        usage = None
+        response_model = model
+        response_id = None
+        async for chunk in chunks:
+            response_id = chunk.id or response_id
+            response_model = chunk.model or response_model
+            if getattr(chunk, "usage", None):
+                usage = _usage_to_dict(chunk.usage)
+            if chunk.choices and chunk.choices[0].delta.content:
+                parts.append(chunk.choices[0].delta.content)
+                yield {"type": "delta", "content": chunk.choices[0].delta.content}
+        
+        content = "".join(parts)
+        yield {
+            "type": "done",
+            "message": {"role": "assistant", "content": content},
+            "usage": usage or _estimate_stream_usage(messages, content, len(parts)),
+            "model": response_model,
+            "id": response_id
+        }
+    except DeadlineExceeded:
+        raise
     except Exception as e:
-        raise Exception(f"OpenAI API error: {str(e)}")
\ No newline at end of file
+        raise Exception(f"OpenAI API error: {str(e)}")
@@ -0,0 +1,123 @@
+import asyncio
+from datetime import datetime
+from typing import Optional
+from sqlalchemy import select, delete, update, exists, func
+from sqlalchemy.orm import Session
+from app.models import Chat, ChatMessage, World, UserWorld, WorldChat, WorldChatMessage
+from app.config import Config
+
+# Deleting a chat, a world chat or a world only sets deleted_at: one UPDATE,
+# and every read filters on deleted_at IS NULL, so the rows are gone for the
+# user at once. The purge worker then removes them with set-based
+# DELETE ... WHERE id IN (batch) statements of at most PURGE_BATCH_SIZE rows,
+# children first, one short transaction per batch. Batches take their rows
+# with FOR UPDATE SKIP LOCKED, so several workers can purge side by side.
+#
+# A deleted world is purged as: its chats are marked deleted (in batches),
+# their messages and the chats go the usual way, then its pins, then the world.
+
+def deleted_world_chat_values() -> dict:
+    """Soft-delete values for world chats; frees the unique thread id so a new chat can take it"""
+    return {"deleted_at": func.now(), "openai_thread_id": func.concat("deleted_", WorldChat.id)}
+
+def _batch_ids(query, size: int, of=None):
+    return query.limit(size).with_for_update(of=of, skip_locked=True)
+
+def _steps(size: int) -> list:
+    """(table, statement) in purge order; each statement touches at most size rows"""
+    deleted_worlds = select(World.id).where(World.deleted_at.isnot(None))
+    return [
+        ("world_chats_marked", update(WorldChat).where(WorldChat.id.in_(_batch_ids(
+            select(WorldChat.id).where(WorldChat.world_id.in_(deleted_worlds), WorldChat.deleted_at.is_(None)), size
+        ))).values(**deleted_world_chat_values())),
+        ("chat_messages", delete(ChatMessage).where(ChatMessage.id.in_(_batch_ids(
+            select(ChatMessage.id).join(Chat, Chat.id == ChatMessage.chat_id).where(Chat.deleted_at.isnot(None)), size, of=ChatMessage
+        )))),
+        ("chats", delete(Chat).where(Chat.id.in_(_batch_ids(
+            select(Chat.id).where(Chat.deleted_at.isnot(None), ~exists().where(ChatMessage.chat_id == Chat.id)), size
+        )))),
+        ("world_chat_messages", delete(WorldChatMessage).where(WorldChatMessage.id.in_(_batch_ids(
+            select(WorldChatMessage.id).join(WorldChat, WorldChat.id == WorldChatMessage.world_chat_id)
+            .where(WorldChat.deleted_at.isnot(None)), size, of=WorldChatMessage
+        )))),
+        ("world_chats", delete(WorldChat).where(WorldChat.id.in_(_batch_ids(
+            select(WorldChat.id).where(
+                WorldChat.deleted_at.isnot(None), ~exists().where(WorldChatMessage.world_chat_id == WorldChat.id)
+            ), size
+        )))),
+        ("user_worlds", delete(UserWorld).where(UserWorld.id.in_(_batch_ids(
+            select(UserWorld.id).where(UserWorld.world_id.in_(deleted_worlds)), size
+        )))),
+        ("worlds", delete(World).where(World.id.in_(_batch_ids(
+            select(World.id).where(
+                World.deleted_at.isnot(None),
+                ~exists().where(WorldChat.world_id == World.id),
+                ~exists().where(UserWorld.world_id == World.id)
+            ), size
+        )))),
+    ]
+
+class _PurgeStats:
+    def __init__(self):
+        self.rows = {}
+        self.batches = 0
+        self.errors = 0
+        self.last_batch_at: Optional[datetime] = None
+
+    def record(self, table: str, count: int):
+        self.rows[table] = self.rows.get(table, 0) + count
+        self.batches += 1
+        self.last_batch_at = datetime.utcnow()
+
+    def stats(self) -> dict:
+        return {
+            "rows": dict(self.rows),
+            "batches": self.batches,
+            "errors": self.errors,
+            "last_batch_at": self.last_batch_at.isoformat() if self.last_batch_at else None
+        }
+
+purge_stats = _PurgeStats()
+
+def purge_batch(db: Session, size: int = None) -> bool:
+    """Run the first purge step that has work, as one committed batch; False when nothing is left"""
+    for table, statement in _steps(size or Config.PURGE_BATCH_SIZE):
+        count = db.execute(statement, execution_options={"synchronize_session": False}).rowcount
+        if count:
+            db.commit()
+            purge_stats.record(table, count)
+            return True
+    db.rollback()
+    return False
+
+def pending_purge(db: Session) -> dict:
+    """Deleted rows still waiting for the purge (admin progress view)"""
+    return {
+        "chats": db.scalar(select(func.count()).select_from(Chat).where(Chat.deleted_at.isnot(None))),
+        "world_chats": db.scalar(select(func.count()).select_from(WorldChat).where(WorldChat.deleted_at.isnot(None))),
+        "worlds": db.scalar(select(func.count()).select_from(World).where(World.deleted_at.isnot(None)))
+    }
+
+async def run_purge_worker(interval: int = None):
+    """Background loop draining deleted rows batch by batch"""
+    from starlette.concurrency import run_in_threadpool
+    from app.database import SessionLocal
+
+    interval = interval or Config.PURGE_INTERVAL
+
+    def purge_once() -> bool:
+        db = SessionLocal()
+        try:
+            return purge_batch(db)
+        finally:
+            db.close()
+
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            # One short transaction per batch, with a pause so user traffic gets the locks in between
+            while await run_in_threadpool(purge_once):
+                await asyncio.sleep(Config.PURGE_BATCH_PAUSE)
+        except Exception as e:
+            purge_stats.errors += 1
+            print(f"Purge error: {e}")
@@ -0,0 +1,77 @@
+import asyncio
+import redis.asyncio as redis
+from redis.asyncio.client import Pipeline
+from app.config import Config
+from app.services import deadline
+
+# One redis.asyncio pool shared by the cache, rate limiter and security manager.
+# Every call is awaited, so a slow Redis never blocks the event loop, and the
+# pool is bounded (BlockingConnectionPool waits for a free connection instead
+# of opening new ones without limit).
+
+class DeadlinePipeline(Pipeline):
+    """A pipeline's round trip takes at most what is left of the request deadline"""
+
+    async def execute(self, raise_on_error: bool = True):
+        return await deadline.run_stage("redis", super().execute(raise_on_error))
+
+class DeadlineRedis(redis.Redis):
+    """Commands and pipelines take at most what is left of the request deadline"""
+
+    async def execute_command(self, *args, **options):
+        return await deadline.run_stage("redis", super().execute_command(*args, **options))
+
+    def pipeline(self, transaction: bool = True, shard_hint: str = None) -> DeadlinePipeline:
+        return DeadlinePipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+class RedisManager:
+    """Lazily created shared Redis client (opened on startup, closed on shutdown)"""
+
+    def __init__(self, url: str = None, max_connections: int = None):
+        self.url = url or Config.REDIS_URL
+        self.max_connections = max_connections or Config.REDIS_MAX_CONNECTIONS
+        self._pool = None
+        self._client = None
+        self._loop = None
+
+    def get_redis(self) -> redis.Redis:
+        # Connections belong to the loop they were opened on; a new loop
+        # (test clients, a restarted server) gets a fresh pool
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._loop is not loop:
+            self._loop = loop
+            self._pool = redis.BlockingConnectionPool.from_url(
+                self.url,
+                max_connections=self.max_connections,
+                timeout=Config.REDIS_POOL_TIMEOUT,
+                socket_timeout=Config.REDIS_SOCKET_TIMEOUT,
+                socket_connect_timeout=Config.REDIS_SOCKET_TIMEOUT,
+                decode_responses=True
+            )
+            self._client = DeadlineRedis(connection_pool=self._pool)
+        return self._client
+
+    async def close(self):
+        if self._client is None:
+            return
+        client, pool = self._client, self._pool
+        self._client = self._pool = self._loop = None
+        await client.aclose()
+        await pool.disconnect()
+
+    def stats(self) -> dict:
+        if self._pool is None:
+            return {"connected": False, "max_connections": self.max_connections, "in_use": 0, "available": 0}
+        return {
+            "connected": True,
+            "max_connections": self.max_connections,
+            "in_use": len(self._pool._in_use_connections),
+            "available": len(self._pool._available_connections)
+        }
+
+# Global Redis manager
+redis_manager = RedisManager()
+
+def get_redis() -> redis.Redis:
+    """Shared async Redis client"""
+    return redis_manager.get_redis()
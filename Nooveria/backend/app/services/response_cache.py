@@ -0,0 +1,202 @@
+import json
+import math
+import time
+import uuid
+import asyncio
+import hashlib
+from typing import List, Dict, Any, Optional
+from redis.exceptions import RedisError
+from app.config import Config
+from app.services.cache import NearCache, _tier_stats, single_flight, in_flight
+from app.services.redis_client import get_redis
+
+# Exact-match cache for upstream chat completions, keyed by a hash of the
+# model, the normalised messages and the request params. Opt-in per world
+# (World.response_cache_enabled) and only for the first turn of a conversation
+# (system prompt plus one user message), so replies to personal conversations
+# are never stored. Entries live in a bounded in-process LRU and in Redis.
+#
+# Hits are still billed, at RESPONSE_CACHE_BILLING_RATIO of the original
+# usage; the usage dict carries cache_hit and upstream_total_tokens so usage
+# records show the hit rate and the tokens saved.
+#
+# Concurrent misses for the same key are coalesced into one upstream call:
+# on this worker through single_flight, across workers through a short Redis
+# lock. Workers that don't get the lock wait for the leader's cache entry
+# (the result mailbox) and are billed like a cache hit.
+
+RESPONSE_CACHE_PREFIX = "response_cache:"
+RESPONSE_LOCK_PREFIX = "response_lock:"
+
+# KEYS[1] = lock, ARGV[1] = owner token
+_RELEASE_LOCK = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+local_responses = NearCache(Config.RESPONSE_CACHE_LOCAL_SIZE, Config.RESPONSE_CACHE_LOCAL_TTL)
+
+class _ResponseCacheStats:
+    redis_hits = 0
+    misses = 0
+    coalesced = 0
+    upstream_calls = 0
+    saved_tokens = 0
+
+response_cache_stats = _ResponseCacheStats()
+
+def _normalise(message: Dict[str, str]) -> List[str]:
+    return [message["role"].strip().lower(), " ".join(message["content"].split())]
+
+def response_cache_key(model: str, messages: List[Dict[str, str]], params: Optional[dict] = None) -> str:
+    payload = json.dumps(
+        {"model": model, "messages": [_normalise(msg) for msg in messages], "params": params or {}},
+        sort_keys=True, ensure_ascii=False, separators=(",", ":")
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def is_cacheable(messages: List[Dict[str, str]]) -> bool:
+    """First turn only: any number of system messages and exactly one user message"""
+    roles = [msg["role"] for msg in messages]
+    return roles.count("user") == 1 and all(role in ("system", "user") for role in roles)
+
+def discounted_usage(usage: Dict[str, int]) -> Dict[str, Any]:
+    """Billable usage of a cache hit"""
+    ratio = Config.RESPONSE_CACHE_BILLING_RATIO
+    prompt_tokens = math.ceil(usage["prompt_tokens"] * ratio)
+    completion_tokens = math.ceil(usage["completion_tokens"] * ratio)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        "cache_hit": True,
+        "upstream_total_tokens": usage["total_tokens"]
+    }
+
+async def _lookup(key: str) -> Optional[dict]:
+    cached = local_responses.get(key)
+    if cached is not None:
+        return cached
+    try:
+        value = await get_redis().get(RESPONSE_CACHE_PREFIX + key)
+    except RedisError as e:
+        print(f"Response cache read failed: {e}")
+        return None
+    if value is None:
+        return None
+    cached = json.loads(value)
+    local_responses.set(key, cached)
+    response_cache_stats.redis_hits += 1
+    return cached
+
+async def _store(key: str, response: dict):
+    cached = {field: response[field] for field in ("message", "usage", "model", "id")}
+    local_responses.set(key, cached)
+    try:
+        await get_redis().set(
+            RESPONSE_CACHE_PREFIX + key, json.dumps(cached, ensure_ascii=False), ex=Config.RESPONSE_CACHE_TTL
+        )
+    except RedisError as e:
+        print(f"Response cache write failed: {e}")
+
+async def _await_leader(key: str) -> Optional[dict]:
+    """
+    Poll for the result of another worker's upstream call. None when the
+    leader gave up (lock released without a result) or took too long.
+    """
+    deadline = time.monotonic() + Config.RESPONSE_COALESCE_LOCK_TTL
+    while time.monotonic() < deadline:
+        await asyncio.sleep(Config.RESPONSE_COALESCE_POLL_INTERVAL)
+        try:
+            value, holder = await get_redis().mget(RESPONSE_CACHE_PREFIX + key, RESPONSE_LOCK_PREFIX + key)
+        except RedisError as e:
+            print(f"Response coalescing poll failed: {e}")
+            return None
+        if value is not None:
+            cached = json.loads(value)
+            local_responses.set(key, cached)
+            return cached
+        if holder is None:
+            return None
+    return None
+
+async def _fetch(key: str, messages: List[Dict[str, str]], model: str, user_id: Optional[str], role_name: Optional[str]):
+    """
+    (response, fresh): one upstream call per key across workers. fresh is
+    False when another worker made the call and its result was picked up.
+    """
+    from app.services.openai_client import chat_completion
+
+    redis = get_redis()
+    lock_key, token = RESPONSE_LOCK_PREFIX + key, uuid.uuid4().hex
+    try:
+        leader = await redis.set(lock_key, token, nx=True, ex=Config.RESPONSE_COALESCE_LOCK_TTL)
+    except RedisError as e:
+        print(f"Response coalescing lock failed: {e}")
+        leader = False
+        token = None
+    if not leader and token is not None:
+        cached = await _await_leader(key)
+        if cached is not None:
+            return cached, False
+
+    try:
+        response = await chat_completion(messages, model, user_id, role_name)
+        response_cache_stats.upstream_calls += 1
+        await _store(key, response)
+        return response, True
+    finally:
+        # Stored before the lock goes, so waiters that see no lock and no entry know the call failed
+        if leader:
+            try:
+                await redis.eval(_RELEASE_LOCK, 1, lock_key, token)
+            except RedisError as e:
+                print(f"Response coalescing unlock failed: {e}")
+
+def _hit(cached: dict) -> Dict[str, Any]:
+    usage = discounted_usage(cached["usage"])
+    response_cache_stats.saved_tokens += usage["upstream_total_tokens"] - usage["total_tokens"]
+    return {**cached, "usage": usage}
+
+async def cached_chat_completion(messages: List[Dict[str, str]], model: str = "gpt-3.5-turbo", enabled: bool = False, user_id: Optional[str] = None, role_name: Optional[str] = None) -> Dict[str, Any]:
+    """
+    chat_completion through the response cache when enabled for the caller.
+    Cacheable requests get usage["cache_hit"]; hits and coalesced requests
+    come back with discounted usage.
+    """
+    from app.services.openai_client import chat_completion
+
+    if not (enabled and Config.RESPONSE_CACHE_ENABLED and is_cacheable(messages)):
+        return await chat_completion(messages, model, user_id, role_name)
+
+    key = response_cache_key(model, messages)
+    cached = await _lookup(key)
+    if cached is not None:
+        return _hit(cached)
+
+    response_cache_stats.misses += 1
+    flight_key = "response:" + key
+    joined = in_flight(flight_key)
+    # Shielded: a caller that goes away must not fail the callers coalesced onto its fetch
+    response, fresh = await asyncio.shield(
+        asyncio.ensure_future(single_flight(flight_key, lambda: _fetch(key, messages, model, user_id, role_name)))
+    )
+    if joined or not fresh:
+        response_cache_stats.coalesced += 1
+        return _hit(response)
+    return {**response, "usage": {**response["usage"], "cache_hit": False}}
+
+def stats() -> dict:
+    """Hit rate, coalescing and tokens saved on this worker (local misses that Redis answered count as hits)"""
+    hits = local_responses.hits + response_cache_stats.redis_hits
+    return {
+        **_tier_stats(
+            hits, response_cache_stats.misses,
+            coalesced=response_cache_stats.coalesced,
+            upstream_calls=response_cache_stats.upstream_calls,
+            saved_tokens=response_cache_stats.saved_tokens
+        ),
+        "local": local_responses.stats()
+    }
@@ -0,0 +1,115 @@
+import html
+import json
+import uuid
+import base64
+from datetime import datetime
+from typing import Optional, Tuple, List
+from sqlalchemy import select, union_all, literal, cast, null, tuple_, func, Integer, DateTime, REAL
+from sqlalchemy.dialects.postgresql import REGCONFIG
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.config import Config
+from app.models import Chat, ChatMessage, WorldChat, WorldChatMessage
+from app.models.search import SEARCH_CONFIG
+
+# Full-text search over a user's chat and world chat messages. Matching is
+# user_id = :user AND search_vector @@ websearch_to_tsquery (one GIN index on
+# both, never a LIKE scan), so only the user's own matches are read and
+# ranked, by ts_rank, then newest first. Keyset pagination: the cursor carries
+# the last result's (rank, created_at, id), so the next page is not matched
+# twice. Snippets are built only for the rows of the page.
+
+# Private-use characters mark the matches in ts_headline output, so the
+# content can be escaped before the <mark> tags go in
+_START, _STOP = "\ue000", "\ue001"
+HEADLINE_OPTIONS = f"StartSel={_START}, StopSel={_STOP}, MaxWords=30, MinWords=10, MaxFragments=2, FragmentDelimiter=\" … \""
+
+def search_limit(limit: Optional[int]) -> int:
+    if limit is None:
+        return Config.SEARCH_PAGE_SIZE
+    return max(1, min(limit, Config.SEARCH_PAGE_MAX))
+
+def search_terms(q: Optional[str]) -> str:
+    """The query text, or Exception("Invalid search query")"""
+    q = " ".join((q or "").split())
+    if not q or len(q) > Config.SEARCH_QUERY_MAX_LENGTH:
+        raise Exception("Invalid search query")
+    return q
+
+def highlight(headline: str) -> str:
+    """ts_headline output as HTML: content escaped, matches in <mark>"""
+    return html.escape(headline).replace(_START, "<mark>").replace(_STOP, "</mark>")
+
+def encode_cursor(result: dict) -> str:
+    """Opaque before= cursor continuing after result"""
+    key = json.dumps([result["rank"], result["created_at"], result["id"]])
+    return base64.urlsafe_b64encode(key.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> tuple:
+    """(rank, created_at, id) of a cursor, or Exception("Invalid cursor")"""
+    try:
+        rank, created_at, message_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return float(rank), datetime.fromisoformat(created_at), uuid.UUID(message_id)
+    except (ValueError, TypeError):
+        raise Exception("Invalid cursor")
+
+def _matches(user_id, query):
+    """One row per matching message of the user's live chats and world chats"""
+    branches = []
+    for kind, message, chat, chat_column, world_id in (
+        ("chat", ChatMessage, Chat, ChatMessage.chat_id, cast(null(), Integer)),
+        ("world_chat", WorldChatMessage, WorldChat, WorldChatMessage.world_chat_id, WorldChat.world_id)
+    ):
+        branches.append(
+            select(
+                message.id,
+                literal(kind).label("kind"),
+                chat.id.label("chat_id"),
+                world_id.label("world_id"),
+                chat.title.label("chat_title"),
+                message.role,
+                message.content,
+                cast(message.created_at, DateTime(timezone=True)).label("created_at"),
+                func.ts_rank(message.search_vector, query).label("rank")
+            )
+            .join(chat, chat.id == chat_column)
+            .where(message.user_id == user_id, message.search_vector.bool_op("@@")(query), chat.deleted_at.is_(None))
+        )
+    return union_all(*branches).subquery("matches")
+
+async def search_messages(db: AsyncSession, user_id, q: str, before: Optional[str], limit: int) -> Tuple[List[dict], Optional[str]]:
+    """(results, next_before): the best limit matches for q after cursor before, and the cursor of the next page"""
+    config = literal(SEARCH_CONFIG, REGCONFIG)
+    query = func.websearch_to_tsquery(config, search_terms(q))
+    matches = _matches(user_id, query)
+    key = (matches.c.rank, matches.c.created_at, matches.c.id)
+
+    page = select(matches)
+    if before is not None:
+        rank, created_at, message_id = decode_cursor(before)
+        # ts_rank is a real; compare as one, whatever precision the driver read it with
+        page = page.where(tuple_(*key) < tuple_(cast(rank, REAL), created_at, message_id))
+    page = page.order_by(*(column.desc() for column in key)).limit(limit + 1).subquery("page")
+
+    rows = (await db.execute(
+        select(
+            *(column for column in page.c if column.name != "content"),
+            func.ts_headline(config, page.c.content, query, HEADLINE_OPTIONS).label("headline")
+        )
+        .order_by(page.c.rank.desc(), page.c.created_at.desc(), page.c.id.desc())
+    )).mappings().all()
+
+    results = [
+        {
+            "id": str(row["id"]),
+            "kind": row["kind"],
+            "chat_id": str(row["chat_id"]),
+            "world_id": row["world_id"],
+            "chat_title": row["chat_title"],
+            "role": row["role"],
+            "snippet": highlight(row["headline"]),
+            "created_at": row["created_at"].isoformat(),
+            "rank": row["rank"]
+        }
+        for row in rows[:limit]
+    ]
+    return results, encode_cursor(results[-1]) if len(rows) > limit else None
@@ -6,9 +6,10 @@ from datetime import datetime, timedelta
 from typing import Optional, Dict, Tuple
 from passlib.context import CryptContext
 from passlib.hash import argon2
-import redis
 import re
 from sqlalchemy.orm import Session
+from redis.exceptions import RedisError
+from app.services.redis_client import get_redis
 
 # Enterprise-grade password context (used by Google, Microsoft, etc.)
 pwd_context = CryptContext(
@@ -25,12 +26,17 @@ class SecurityManager:
     """Enterprise security manager for authentication"""
     
     def __init__(self, redis_client=None):
-        self.redis = redis_client
+        self._redis_client = redis_client
         self.max_login_attempts = 5
         self.lockout_duration = 900  # 15 minutes
         self.rate_limit_window = 300  # 5 minutes
         self.max_requests_per_window = 10
         
+    @property
+    def redis(self):
+        """Injected client, or the shared async one"""
+        return self._redis_client or get_redis()
+    
     def hash_password(self, password: str) -> str:
         """Hash password using Argon2id (industry standard)"""
         return pwd_context.hash(password)
@@ -70,47 +76,49 @@ class SecurityManager:
         
         return True, "Password is strong"
     
-    def check_rate_limit(self, identifier: str, action: str) -> Tuple[bool, int]:
+    async def check_rate_limit(self, identifier: str, action: str) -> Tuple[bool, int]:
         """Check if action is rate limited"""
-        if not self.redis:
-            return True, 0
-        
         key = f"rate_limit:{action}:{identifier}"
         current_time = int(time.time())
         window_start = current_time - self.rate_limit_window
         
-        # Remove old entries
-        self.redis.zremrangebyscore(key, 0, window_start)
-        
-        # Count current requests
-        current_count = self.redis.zcard(key)
-        
-        if current_count >= self.max_requests_per_window:
-            ttl = self.redis.ttl(key)
-            return False, ttl if ttl > 0 else self.rate_limit_window
-        
-        # Add current request
-        self.redis.zadd(key, {str(current_time): current_time})
-        self.redis.expire(key, self.rate_limit_window)
+        try:
+            # Remove old entries
+            await self.redis.zremrangebyscore(key, 0, window_start)
+            
+            # Count current requests
+            current_count = await self.redis.zcard(key)
+            
+            if current_count >= self.max_requests_per_window:
+                ttl = await self.redis.ttl(key)
+                return False, ttl if ttl > 0 else self.rate_limit_window
+            
+            # Add current request
+            await self.redis.zadd(key, {str(current_time): current_time})
+            await self.redis.expire(key, self.rate_limit_window)
+        except RedisError as e:
+            print(f"Rate limit check skipped: {e}")
         
         return True, 0
     
-    def record_failed_login(self, identifier: str) -> Dict:
+    async def record_failed_login(self, identifier: str) -> Dict:
         """Record failed login attempt"""
-        if not self.redis:
-            return {"locked": False, "attempts": 0}
-        
         key = f"failed_login:{identifier}"
-        attempts = self.redis.incr(key)
-        
-        if attempts == 1:
-            self.redis.expire(key, self.lockout_duration)
+        try:
+            attempts = await self.redis.incr(key)
+            
+            if attempts == 1:
+                await self.redis.expire(key, self.lockout_duration)
+            
+            if attempts >= self.max_login_attempts:
+                # Lock account
+                lock_key = f"account_locked:{identifier}"
+                await self.redis.setex(lock_key, self.lockout_duration, "locked")
+        except RedisError as e:
+            print(f"Failed login not recorded: {e}")
+            return {"locked": False, "attempts": 0}
         
         if attempts >= self.max_login_attempts:
-            # Lock account
-            lock_key = f"account_locked:{identifier}"
-            self.redis.setex(lock_key, self.lockout_duration, "locked")
-            
             return {
                 "locked": True,
                 "attempts": attempts,
@@ -119,27 +127,35 @@ class SecurityManager:
         
         return {"locked": False, "attempts": attempts}
     
-    def clear_failed_logins(self, identifier: str):
+    async def clear_failed_logins(self, identifier: str):
         """Clear failed login attempts after successful login"""
-        if not self.redis:
-            return
-        
-        self.redis.delete(f"failed_login:{identifier}")
-        self.redis.delete(f"account_locked:{identifier}")
+        try:
+            await self.redis.delete(f"failed_login:{identifier}")
+            await self.redis.delete(f"account_locked:{identifier}")
+        except RedisError as e:
+            print(f"Failed logins not cleared: {e}")
     
-    def is_account_locked(self, identifier: str) -> Tuple[bool, Optional[datetime]]:
+    async def is_account_locked(self, identifier: str) -> Tuple[bool, Optional[datetime]]:
         """Check if account is locked"""
-        if not self.redis:
-            return False, None
-        
         lock_key = f"account_locked:{identifier}"
-        if self.redis.exists(lock_key):
-            ttl = self.redis.ttl(lock_key)
-            unlock_time = datetime.utcnow() + timedelta(seconds=ttl) if ttl > 0 else None
-            return True, unlock_time
+        try:
+            if await self.redis.exists(lock_key):
+                ttl = await self.redis.ttl(lock_key)
+                unlock_time = datetime.utcnow() + timedelta(seconds=ttl) if ttl > 0 else None
+                return True, unlock_time
+        except RedisError as e:
+            print(f"Account lock check skipped: {e}")
         
         return False, None
     
+    async def failed_login_count(self, identifier: str) -> int:
+        """Failed login attempts in the current lockout window"""
+        try:
+            return int(await self.redis.get(f"failed_login:{identifier}") or 0)
+        except RedisError as e:
+            print(f"Failed login count unavailable: {e}")
+            return 0
+    
     def generate_secure_token(self, length: int = 32) -> str:
         """Generate cryptographically secure token"""
         return secrets.token_urlsafe(length)
@@ -155,25 +171,22 @@ class SecurityManager:
         
         return f"{data}:{signature}"
     
-    def detect_suspicious_activity(self, user_id: str, ip_address: str, user_agent: str) -> Dict:
+    async def detect_suspicious_activity(self, user_id: str, ip_address: str, user_agent: str) -> Dict:
         """Detect suspicious login patterns"""
-        if not self.redis:
-            return {"suspicious": False}
-        
         # Check for multiple IPs
         ip_key = f"user_ips:{user_id}"
-        self.redis.sadd(ip_key, ip_address)
-        self.redis.expire(ip_key, 86400)  # 24 hours
+        await self.redis.sadd(ip_key, ip_address)
+        await self.redis.expire(ip_key, 86400)  # 24 hours
         
-        ip_count = self.redis.scard(ip_key)
+        ip_count = await self.redis.scard(ip_key)
         
         # Check for rapid location changes (simplified)
         location_key = f"user_locations:{user_id}"
         current_time = int(time.time())
-        self.redis.zadd(location_key, {ip_address: current_time})
-        self.redis.expire(location_key, 3600)  # 1 hour
+        await self.redis.zadd(location_key, {ip_address: current_time})
+        await self.redis.expire(location_key, 3600)  # 1 hour
         
-        recent_locations = self.redis.zrangebyscore(
+        recent_locations = await self.redis.zrangebyscore(
             location_key, current_time - 1800, current_time  # Last 30 minutes
         )
         
@@ -187,12 +200,12 @@ class SecurityManager:
         
         # Check for unusual user agent
         ua_key = f"user_agents:{user_id}"
-        known_agents = self.redis.smembers(ua_key)
-        if known_agents and user_agent.encode() not in known_agents:
+        known_agents = await self.redis.smembers(ua_key)
+        if known_agents and user_agent not in known_agents:
             suspicious_indicators.append("new_device")
         
-        self.redis.sadd(ua_key, user_agent)
-        self.redis.expire(ua_key, 2592000)  # 30 days
+        await self.redis.sadd(ua_key, user_agent)
+        await self.redis.expire(ua_key, 2592000)  # 30 days
         
         return {
             "suspicious": len(suspicious_indicators) > 0,
@@ -200,11 +213,8 @@ class SecurityManager:
             "risk_score": len(suspicious_indicators) * 25  # 0-100 scale
         }
     
-    def log_security_event(self, event_type: str, user_id: str, details: Dict):
+    async def log_security_event(self, event_type: str, user_id: str, details: Dict):
         """Log security events for monitoring"""
-        if not self.redis:
-            return
-        
         event = {
             "timestamp": datetime.utcnow().isoformat(),
             "type": event_type,
@@ -214,11 +224,17 @@ class SecurityManager:
         
         # Store in Redis for real-time monitoring
         key = f"security_events:{datetime.utcnow().strftime('%Y-%m-%d')}"
-        self.redis.lpush(key, str(event))
-        self.redis.expire(key, 604800)  # 7 days
-        
-        # Keep only last 1000 events per day
-        self.redis.ltrim(key, 0, 999)
+        try:
+            async with self.redis.pipeline() as pipe:
+                pipe.lpush(key, str(event))
+                pipe.expire(key, 604800)  # 7 days
+                
+                # Keep only last 1000 events per day
+                pipe.ltrim(key, 0, 999)
+                await pipe.execute()
+        except RedisError as e:
+            # Monitoring must not fail the request that is being logged
+            print(f"Security event not logged: {e}")
 
 # Global security manager instance
 security_manager = SecurityManager()
\ No newline at end of file
@@ -0,0 +1,90 @@
+import threading
+from collections import OrderedDict
+from typing import List, Dict
+from app.config import Config
+
+# Token counts for pre-flight size checks, holds and the billing paths that
+# have no upstream usage to go by. tiktoken's BPE runs in-process and its
+# vocabulary is loaded once from TIKTOKEN_CACHE_DIR (filled when the image is
+# built), so counting never needs the network. Without tiktoken the counter
+# falls back to ~4 characters per token.
+
+# Chat format overhead: role and separators per message, priming of the reply
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+class TokenCounter:
+    """BPE token counter with memoised counts (safe to call from threadpool workers)"""
+
+    def __init__(self, encoding_name: str = None, cache_size: int = None):
+        self.encoding_name = encoding_name or Config.TOKENIZER_ENCODING
+        self.cache_size = cache_size or Config.TOKENIZER_CACHE_SIZE
+        self._encoding = None
+        self._loaded = False
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Load the vocabulary (once); called at startup so the first request doesn't pay for it"""
+        with self._lock:
+            if self._loaded:
+                return self._encoding
+            self._loaded = True
+            try:
+                import tiktoken
+                self._encoding = tiktoken.get_encoding(self.encoding_name)
+            except Exception as e:
+                print(f"Tokenizer unavailable, estimating tokens from text length: {e}")
+            return self._encoding
+
+    @property
+    def exact(self) -> bool:
+        return self.load() is not None
+
+    def _cached(self, text: str):
+        with self._lock:
+            count = self._cache.get(text)
+            if count is not None:
+                self._cache.move_to_end(text)
+            return count
+
+    def _remember(self, text: str, count: int):
+        with self._lock:
+            self._cache[text] = count
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def count(self, text: str) -> int:
+        return self.count_batch([text])[0]
+
+    def count_batch(self, texts: List[str]) -> List[int]:
+        """Counts for several texts; only the ones not seen recently are encoded"""
+        counts = [self._cached(text) for text in texts]
+        missing = [text for text, count in zip(texts, counts) if count is None]
+        if not missing:
+            return counts
+
+        encoding = self.load()
+        if encoding is None:
+            fresh = [len(text) // 4 + 1 for text in missing]
+        else:
+            fresh = [len(tokens) for tokens in encoding.encode_batch(missing, disallowed_special=())]
+
+        fresh_counts = dict(zip(missing, fresh))
+        for text, count in fresh_counts.items():
+            self._remember(text, count)
+        return [count if count is not None else fresh_counts[text] for text, count in zip(texts, counts)]
+
+    def count_messages(self, messages: List[Dict[str, str]]) -> int:
+        """Prompt tokens of a chat completion request"""
+        contents = self.count_batch([msg["content"] for msg in messages])
+        return sum(contents) + TOKENS_PER_MESSAGE * len(messages) + TOKENS_PER_REPLY
+
+# Global token counter
+token_counter = TokenCounter()
+
+def count_tokens(text: str) -> int:
+    return token_counter.count(text)
+
+def count_message_tokens(messages: List[Dict[str, str]]) -> int:
+    return token_counter.count_messages(messages)
@@ -0,0 +1,317 @@
+import os
+import time
+import random
+import asyncio
+from collections import deque
+from typing import List, Optional, Callable, Awaitable, Any
+from app.config import Config
+from app.services.deadline import DeadlineExceeded, remaining
+
+# Routing of upstream calls over a pool of credentials / base URLs
+# (OPENAI_API_KEYS, OPENAI_BASE_URLS). Each endpoint keeps moving averages of
+# latency and error rate; traffic goes to the endpoint with the best score.
+# Repeated failures open the endpoint's circuit breaker for a cooldown that
+# doubles while half-open trials keep failing. A 429 takes the endpoint out of
+# rotation for its Retry-After (plus jitter) without counting as a failure.
+# When no endpoint is usable, the router backs off with full jitter.
+#
+# With UPSTREAM_HEDGING on, a call that has not answered within the recent
+# UPSTREAM_HEDGE_PERCENTILE latency gets a second attempt (which the scoring
+# steers to another endpoint while the first is in flight). The first to finish
+# wins and the other is cancelled, so only the winner's usage is ever billed.
+# Hedges are capped at UPSTREAM_HEDGE_BUDGET of all calls.
+
+def _jitter(seconds: float) -> float:
+    return seconds * (1 + random.uniform(0, Config.UPSTREAM_RETRY_JITTER))
+
+def _retry_after(error: Exception) -> Optional[float]:
+    """Retry-After of an upstream error response, in seconds"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    for header, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+        value = headers.get(header)
+        if value is not None:
+            try:
+                return max(0.0, float(value) * scale)
+            except ValueError:
+                continue
+    return None
+
+def _classify(error: Exception) -> str:
+    """'throttled' (429), 'fatal' (the request itself is bad) or 'failure' (endpoint trouble)"""
+    if isinstance(error, DeadlineExceeded):
+        return "fatal"
+    status = getattr(error, "status_code", None)
+    if status == 429:
+        return "throttled"
+    if status is not None and status < 500 and status not in (408, 409):
+        return "fatal"
+    return "failure"
+
+class UpstreamEndpoint:
+    """One credential / base URL with its health (only touched from the event loop)"""
+
+    def __init__(self, name: str, client: Any):
+        self.name = name
+        self.client = client
+        self.latency = None
+        self.error_rate = 0.0
+        self.failures = 0
+        self.open_until = 0.0
+        self.cooldown = Config.UPSTREAM_BREAKER_COOLDOWN
+        self.throttled_until = 0.0
+        self.throttles = 0
+        self.trial = False
+        self.inflight = 0
+        self.requests = 0
+        self.errors = 0
+
+    def state(self, now: float) -> str:
+        if self.failures < Config.UPSTREAM_BREAKER_THRESHOLD:
+            return "closed"
+        return "open" if now < self.open_until else "half_open"
+
+    def available(self, now: float) -> bool:
+        if now < self.throttled_until:
+            return False
+        state = self.state(now)
+        return state == "closed" or (state == "half_open" and not self.trial)
+
+    def available_at(self, now: float) -> float:
+        """When the endpoint can take a request again"""
+        ready = self.throttled_until
+        if self.state(now) == "open":
+            ready = max(ready, self.open_until)
+        return ready
+
+    def score(self) -> float:
+        """Lower is better: expected latency, inflated by load and error rate"""
+        latency = self.latency if self.latency is not None else 0.0
+        return (latency + 0.01) * (1 + self.inflight) / max(0.05, 1 - self.error_rate)
+
+    def begin(self, now: float):
+        if self.state(now) == "half_open":
+            self.trial = True
+        self.inflight += 1
+        self.requests += 1
+
+    def succeeded(self, elapsed: float):
+        self.inflight -= 1
+        self.trial = False
+        self.failures = 0
+        self.throttles = 0
+        self.cooldown = Config.UPSTREAM_BREAKER_COOLDOWN
+        self.error_rate *= 0.8
+        self.latency = elapsed if self.latency is None else 0.8 * self.latency + 0.2 * elapsed
+
+    def failed(self, now: float):
+        self.inflight -= 1
+        self.errors += 1
+        self.error_rate = 0.8 * self.error_rate + 0.2
+        reopening = self.trial
+        self.trial = False
+        self.failures += 1
+        if self.failures >= Config.UPSTREAM_BREAKER_THRESHOLD:
+            if reopening:
+                self.cooldown = min(self.cooldown * 2, Config.UPSTREAM_BREAKER_MAX_COOLDOWN)
+            self.open_until = now + _jitter(self.cooldown)
+
+    def throttled(self, now: float, retry_after: Optional[float]):
+        self.inflight -= 1
+        self.trial = False
+        self.throttles += 1
+        if retry_after is None:
+            retry_after = min(Config.UPSTREAM_BACKOFF_BASE * 2 ** self.throttles, Config.UPSTREAM_BACKOFF_MAX)
+        self.throttled_until = now + _jitter(retry_after)
+
+    def released(self):
+        """The request failed for reasons that say nothing about the endpoint"""
+        self.inflight -= 1
+        self.trial = False
+
+    def stats(self, now: float) -> dict:
+        return {
+            "name": self.name,
+            "state": self.state(now),
+            "throttled": now < self.throttled_until,
+            "latency_ms": round(self.latency * 1000, 1) if self.latency is not None else None,
+            "error_rate": round(self.error_rate, 4),
+            "inflight": self.inflight,
+            "requests": self.requests,
+            "errors": self.errors
+        }
+
+class UpstreamRouter:
+    def __init__(self, endpoints: List[UpstreamEndpoint]):
+        self.endpoints = endpoints
+        self._latencies = {}
+        self.hedgeable = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.hedges_denied = 0
+
+    def _pick(self, now: float, tried: set) -> Optional[UpstreamEndpoint]:
+        candidates = [endpoint for endpoint in self.endpoints if endpoint not in tried and endpoint.available(now)]
+        return min(candidates, key=lambda endpoint: endpoint.score()) if candidates else None
+
+    async def call(self, request: Callable[[Any], Awaitable[Any]]) -> Any:
+        """
+        Run request(client) on the healthiest endpoint, moving on to the next
+        one when it fails. Raises the last upstream error once
+        UPSTREAM_MAX_ATTEMPTS are used up or no endpoint is usable in time.
+        """
+        last_error = None
+        tried = set()
+        for attempt in range(Config.UPSTREAM_MAX_ATTEMPTS):
+            now = time.monotonic()
+            endpoint = self._pick(now, tried)
+            if endpoint is None:
+                # Everything usable was tried: back off, at least until an endpoint is back
+                ready = min(endpoint.available_at(now) for endpoint in self.endpoints) - now
+                backoff = random.uniform(0, min(Config.UPSTREAM_BACKOFF_BASE * 2 ** attempt, Config.UPSTREAM_BACKOFF_MAX))
+                delay = max(ready, backoff)
+                left = remaining()
+                if delay > Config.UPSTREAM_BACKOFF_MAX or (left is not None and delay >= left):
+                    break
+                await asyncio.sleep(delay)
+                tried.clear()
+                now = time.monotonic()
+                endpoint = self._pick(now, tried)
+                if endpoint is None:
+                    break
+
+            tried.add(endpoint)
+            endpoint.begin(now)
+            try:
+                result = await request(endpoint.client)
+            except Exception as e:
+                kind = _classify(e)
+                if kind == "fatal":
+                    endpoint.released()
+                    raise
+                if kind == "throttled":
+                    endpoint.throttled(time.monotonic(), _retry_after(e))
+                else:
+                    endpoint.failed(time.monotonic())
+                print(f"Upstream {endpoint.name} {kind}: {e}")
+                last_error = e
+                continue
+            except BaseException:
+                endpoint.released()
+                raise
+            endpoint.succeeded(time.monotonic() - now)
+            return result
+
+        raise last_error or Exception("No upstream endpoint available")
+
+    def hedge_delay(self, kind: str) -> Optional[float]:
+        """UPSTREAM_HEDGE_PERCENTILE of recent latencies of this kind (None until there are enough)"""
+        samples = self._latencies.get(kind)
+        if not samples or len(samples) < Config.UPSTREAM_HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(samples)
+        index = min(len(ordered) - 1, int(len(ordered) * Config.UPSTREAM_HEDGE_PERCENTILE / 100))
+        return max(ordered[index], Config.UPSTREAM_HEDGE_MIN_DELAY)
+
+    def _record_latency(self, kind: str, elapsed: float):
+        self._latencies.setdefault(kind, deque(maxlen=Config.UPSTREAM_HEDGE_WINDOW)).append(elapsed)
+
+    def _hedge_allowed(self) -> bool:
+        return self.hedges < Config.UPSTREAM_HEDGE_BUDGET * self.hedgeable + Config.UPSTREAM_HEDGE_BURST
+
+    async def hedged_call(self, request: Callable[[Any], Awaitable[Any]], kind: str = "completion", discard: Optional[Callable[[Any], Awaitable[None]]] = None) -> Any:
+        """
+        call(request), plus a second attempt if the first is slower than usual
+        for this kind of request. discard(result) cleans up the result of an
+        attempt that finished but lost (e.g. closes an open stream).
+        """
+        if not Config.UPSTREAM_HEDGING:
+            return await self.call(request)
+
+        started = time.monotonic()
+        self.hedgeable += 1
+        primary = asyncio.ensure_future(self.call(request))
+        attempts = [primary]
+        winner = None
+        try:
+            delay = self.hedge_delay(kind)
+            if delay is not None:
+                done, _ = await asyncio.wait(attempts, timeout=delay)
+                if not done:
+                    if self._hedge_allowed():
+                        self.hedges += 1
+                        attempts.append(asyncio.ensure_future(self.call(request)))
+                    else:
+                        self.hedges_denied += 1
+
+            pending, error = set(attempts), None
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for attempt in done:
+                    if attempt.exception() is not None:
+                        error = attempt.exception()
+                    elif winner is None:
+                        winner = attempt
+            if winner is None:
+                raise error
+
+            if winner is not primary:
+                self.hedge_wins += 1
+            self._record_latency(kind, time.monotonic() - started)
+            return winner.result()
+        finally:
+            losers = [attempt for attempt in attempts if attempt is not winner]
+            for attempt in losers:
+                attempt.cancel()
+            # Wait for the cancellations, so their endpoints are released before we return
+            await asyncio.gather(*losers, return_exceptions=True)
+            for attempt in losers:
+                await _discard_result(attempt, discard)
+
+    def hedge_stats(self) -> dict:
+        return {
+            "enabled": Config.UPSTREAM_HEDGING,
+            "calls": self.hedgeable,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "denied": self.hedges_denied,
+            "delays_ms": {
+                kind: round(delay * 1000, 1) for kind in self._latencies
+                if (delay := self.hedge_delay(kind)) is not None
+            }
+        }
+
+    def stats(self) -> list:
+        now = time.monotonic()
+        return [endpoint.stats(now) for endpoint in self.endpoints]
+
+async def _discard_result(attempt: asyncio.Future, discard: Optional[Callable[[Any], Awaitable[None]]]):
+    """Clean up a losing attempt that finished before its cancellation took effect"""
+    if discard and not attempt.cancelled() and attempt.exception() is None:
+        try:
+            await discard(attempt.result())
+        except Exception as e:
+            print(f"Discarding hedged attempt failed: {e}")
+
+def _split(value: str) -> List[str]:
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+def configured_endpoints() -> List[tuple]:
+    """(api_key, base_url) pairs from OPENAI_API_KEYS / OPENAI_BASE_URLS (cycled to the longer list)"""
+    keys = _split(os.getenv("OPENAI_API_KEYS", "")) or _split(os.getenv("OPENAI_API_KEY", ""))
+    base_urls = _split(os.getenv("OPENAI_BASE_URLS", "")) or [None]
+    if not keys:
+        return []
+    count = max(len(keys), len(base_urls))
+    return [(keys[i % len(keys)], base_urls[i % len(base_urls)]) for i in range(count)]
+
+def build_router(http_client) -> UpstreamRouter:
+    from openai import AsyncOpenAI
+
+    endpoints = []
+    for api_key, base_url in configured_endpoints():
+        # The router does the retrying, so the SDK must not
+        client = AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client, max_retries=0)
+        name = f"{base_url or 'openai'} (...{api_key[-4:]})"
+        endpoints.append(UpstreamEndpoint(name, client))
+    return UpstreamRouter(endpoints)
@@ -1,34 +1,133 @@
 from decimal import Decimal
+from typing import Optional
+from datetime import datetime, timedelta, timezone
 from sqlalchemy.orm import Session
-from sqlalchemy import and_
-from app.models import Wallet, Transaction, UsageRecord, WalletType, TransactionType, User
-from app.services.cache import CacheService
+from sqlalchemy import and_, update
+from app.models import Wallet, Transaction, UsageRecord, WalletHold, WalletType, TransactionType, HoldStatus, User, Role
+from app.services.cache import CacheService, single_flight
+from app.config import Config
+from app.services.communal_wallet import withdraw_communal, get_communal_balance, get_communal_balance_cached
+from app.services.tokenizer import count_message_tokens
 
-def get_user_wallets(db: Session, user_id: str) -> dict:
-    # Try cache first
-    cached = CacheService.get_user_wallet_cache(user_id)
-    if cached:
-        return cached
-    
-    # Query database
-    personal_wallet = db.query(Wallet).filter(
+def get_personal_balance(db: Session, user_id: str) -> tuple:
+    """Personal wallet (balance, version) straight from the database"""
+    row = db.query(Wallet.balance_tokens, Wallet.version).filter(
         and_(Wallet.user_id == user_id, Wallet.type == WalletType.personal)
     ).first()
+    return (float(row.balance_tokens), row.version) if row else (0, 0)
+
+def get_user_wallets(db: Session, user_id: str) -> dict:
+    """Wallet balances straight from the database (see get_user_wallets_cached)"""
+    return {
+        "personal": {"balance": get_personal_balance(db, user_id)[0]},
+        "communal": {"balance": get_communal_balance(db)}
+    }
+
+async def get_user_wallets_cached(db, user_id: str) -> dict:
+    """
+    get_user_wallets behind the two-tier cache (db is an AsyncSession).
+    Only the personal balance is cached per user; the communal total is the
+    shared communal_balance entry. Concurrent misses share one query.
+    """
+    personal = await CacheService.get_user_wallet_cache(user_id)
+    if personal is None:
+        async def load() -> float:
+            balance, version = await db.run_sync(get_personal_balance, user_id)
+            await CacheService.set_user_wallet_cache(user_id, balance, version)
+            return balance
+        
+        personal = await single_flight(f"wallet:{user_id}", load)
     
-    communal_wallet = db.query(Wallet).filter(Wallet.type == WalletType.communal).first()
+    return {
+        "personal": {"balance": personal},
+        "communal": {"balance": await get_communal_balance_cached(db)}
+    }
+
+async def after_wallet_change(user_id: str, result: dict = None, events: list = None):
+    """
+    Redis bookkeeping once a charge, hold or release is committed. result is
+    what charge_tokens, settle_hold, reserve_tokens or release_hold returned:
+    communal charges count towards the daily limit, a new personal balance is
+    written through to the cache (versioned), and without a result the cached
+    balance is dropped. Open wallet streams are notified, including the
+    WalletEvent rows (events) recorded with the charge. Runs outside the
+    request deadline: the change is committed, so the caches must follow.
+    """
+    from app.services.wallet_push import publish_balance_change
+    from app.services import deadline
     
-    result = {
-        "personal": {"balance": float(personal_wallet.balance_tokens) if personal_wallet else 0},
-        "communal": {"balance": float(communal_wallet.balance_tokens) if communal_wallet else 0}
+    user_id = str(user_id)
+    with deadline.suspended():
+        if not result:
+            await CacheService.invalidate_user_wallet_cache(user_id)
+        else:
+            if result.get("charged_from") == "communal":
+                await CacheService.increment_daily_usage(user_id, int(result["amount"]))
+            if result.get("charged_from", result.get("source")) == "personal":
+                await CacheService.set_user_wallet_cache(user_id, result["balance"], result["version"])
+        
+        await publish_balance_change(user_id, result, events)
+
+def _withdraw(db: Session, criteria: list, tokens_needed: Decimal):
+    """
+    Single conditional UPDATE:
+    UPDATE wallets SET balance_tokens = balance_tokens - :n, version = version + 1
+    WHERE <criteria> AND balance_tokens >= :n RETURNING id, balance_tokens, version
+    Returns the (id, new balance, version) row, or None when funds are insufficient.
+    """
+    stmt = (
+        update(Wallet)
+        .where(*criteria, Wallet.balance_tokens >= tokens_needed)
+        .values(balance_tokens=Wallet.balance_tokens - tokens_needed, version=Wallet.version + 1)
+        .returning(Wallet.id, Wallet.balance_tokens, Wallet.version)
+    )
+    return db.execute(stmt).first()
+
+def _record_transaction(db: Session, defer: bool, wallet_id: int, amount: Decimal, transaction_type: TransactionType, meta: dict) -> dict:
+    """
+    Insert the Transaction row now, or only describe it when the caller hands
+    it to the ledger writer (defer=True, transaction_id is then None).
+    """
+    row = {
+        "wallet_from_id": wallet_id,
+        "amount_tokens": amount,
+        "type": transaction_type,
+        "meta": meta
     }
+    if defer:
+        return {"transaction_id": None, "transaction": row}
     
-    # Cache result
-    CacheService.set_user_wallet_cache(user_id, result)
-    return result
+    transaction = Transaction(**row)
+    db.add(transaction)
+    db.flush()
+    return {"transaction_id": transaction.id, "transaction": row}
 
-def charge_tokens(db: Session, user_id: str, total_tokens: int, prefer_communal: bool = False) -> dict:
+def _record_communal_transactions(db: Session, defer: bool, parts: list, meta: dict) -> dict:
+    """
+    One communal_withdraw Transaction per (stripe_id, tokens) part. The first
+    is recorded like _record_transaction (the usage record points at it); the
+    rest, only there when a charge was split across stripes, are inserted in
+    the caller's transaction right away.
+    """
+    for stripe_id, part in parts[1:]:
+        db.add(Transaction(
+            wallet_from_id=stripe_id, amount_tokens=part,
+            type=TransactionType.communal_withdraw, meta={**meta, "stripe_wallet_id": stripe_id}
+        ))
+    stripe_id, part = parts[0]
+    return _record_transaction(
+        db, defer, stripe_id, part, TransactionType.communal_withdraw,
+        {**meta, "stripe_wallet_id": stripe_id}
+    )
+
+def charge_tokens(db: Session, user_id: str, total_tokens: int, prefer_communal: bool = False, defer_transaction: bool = False, daily_used: int = 0) -> dict:
     """
     Atomic token charging with personal-first, then communal fallback.
+    Each withdrawal is one conditional UPDATE, so no row is locked beyond that
+    statement and the communal wallet is only touched when falling back to it.
+    With defer_transaction the Transaction row is returned instead of inserted.
+    daily_used is the caller's communal usage today (CacheService.get_daily_usage);
+    after commit the caller hands the result to after_wallet_change.
     Returns transaction details or raises exception.
     """
     # Validate user_id format to prevent injection
@@ -38,81 +137,288 @@ def charge_tokens(db: Session, user_id: str, total_tokens: int, prefer_communal:
     except ValueError:
         raise Exception("Invalid user ID format")
     
-    user = db.query(User).filter(User.id == user_id).first()
-    if not user:
-        raise Exception("User not found")
-    
-    # Get wallets with row locks
-    personal_wallet = db.query(Wallet).filter(
-        and_(Wallet.user_id == user_id, Wallet.type == WalletType.personal)
-    ).with_for_update().first()
-    
-    communal_wallet = db.query(Wallet).filter(
-        Wallet.type == WalletType.communal
-    ).with_for_update().first()
-    
-    if not personal_wallet:
-        raise Exception("Personal wallet not found")
-    
     tokens_needed = Decimal(str(total_tokens))
-    personal_balance = personal_wallet.balance_tokens
     
     # Try personal wallet first
-    if personal_balance >= tokens_needed:
-        personal_wallet.balance_tokens -= tokens_needed
-        
-        transaction = Transaction(
-            wallet_from_id=personal_wallet.id,
-            amount_tokens=tokens_needed,
-            type=TransactionType.usage,
-            meta={"source": "personal"}
+    row = _withdraw(db, [Wallet.user_id == user_id, Wallet.type == WalletType.personal], tokens_needed)
+    if row:
+        recorded = _record_transaction(
+            db, defer_transaction, row.id, tokens_needed,
+            TransactionType.usage, {"source": "personal"}
         )
-        db.add(transaction)
-        db.flush()
-        
-        # Invalidate cache after transaction
-        CacheService.invalidate_user_wallet_cache(user_id)
         
-        return {"charged_from": "personal", "amount": float(tokens_needed), "transaction_id": transaction.id}
+        return {
+            "charged_from": "personal", "amount": float(tokens_needed),
+            "balance": float(row.balance_tokens), "version": row.version, **recorded
+        }
+    
+    # Only now find out whether the wallet is missing or just short of funds
+    has_personal_wallet = db.query(Wallet.id).filter(
+        and_(Wallet.user_id == user_id, Wallet.type == WalletType.personal)
+    ).first()
+    if not has_personal_wallet:
+        raise Exception("Personal wallet not found")
     
     # Use communal if preferred and available
-    elif prefer_communal and communal_wallet:
-        # Check daily communal limit with Redis counter
-        daily_used = CacheService.get_daily_usage(user_id)
+    if prefer_communal:
+        user = db.query(User).filter(User.id == user_id).first()
+        if not user:
+            raise Exception("User not found")
+        
+        # Check daily communal limit against the Redis counter
         if daily_used + total_tokens <= user.role.daily_communal_limit_tokens:
-            if communal_wallet.balance_tokens >= tokens_needed:
-                communal_wallet.balance_tokens -= tokens_needed
-                
-                transaction = Transaction(
-                    wallet_from_id=communal_wallet.id,
-                    amount_tokens=tokens_needed,
-                    type=TransactionType.communal_withdraw,
-                    meta={"source": "communal", "user_id": str(user_id)}
+            parts = withdraw_communal(db, user_id, tokens_needed)
+            if parts:
+                recorded = _record_communal_transactions(
+                    db, defer_transaction, parts,
+                    {"source": "communal", "user_id": str(user_id)}
                 )
-                db.add(transaction)
-                db.flush()
-                
-                # Update daily usage counter
-                CacheService.increment_daily_usage(user_id, total_tokens)
-                # Invalidate cache
-                CacheService.invalidate_user_wallet_cache(user_id)
                 
-                return {"charged_from": "communal", "amount": float(tokens_needed), "transaction_id": transaction.id}
+                return {"charged_from": "communal", "amount": float(tokens_needed), **recorded}
     
     raise Exception("Insufficient funds")
 
+def _deposit(db: Session, wallet_id: int, tokens: Decimal):
+    """Return tokens to a wallet, giving back the (id, new balance, version) row"""
+    stmt = (
+        update(Wallet)
+        .where(Wallet.id == wallet_id)
+        .values(balance_tokens=Wallet.balance_tokens + tokens, version=Wallet.version + 1)
+        .returning(Wallet.id, Wallet.balance_tokens, Wallet.version)
+    )
+    return db.execute(stmt).first()
+
+def _close_hold(db: Session, hold_id: str, status: HoldStatus):
+    """Move an active hold to a final status; None if it was already closed"""
+    stmt = (
+        update(WalletHold)
+        .where(WalletHold.id == hold_id, WalletHold.status == HoldStatus.active)
+        .values(status=status)
+        .returning(WalletHold.user_id, WalletHold.wallet_id, WalletHold.source, WalletHold.amount_tokens, WalletHold.parts)
+    )
+    return db.execute(stmt).first()
+
+def _hold_parts(hold) -> list:
+    """(wallet_id, tokens) parts a hold was taken from"""
+    if not hold.parts:
+        return [(hold.wallet_id, hold.amount_tokens)]
+    return [(wallet_id, Decimal(tokens)) for wallet_id, tokens in hold.parts]
+
+def estimate_request_tokens(messages: list) -> int:
+    """Pre-flight estimate: counted prompt tokens plus a completion allowance"""
+    return count_message_tokens(messages) + Config.HOLD_COMPLETION_TOKENS
+
+def check_request_size(db: Session, user_id: str, estimated_tokens: int):
+    """Reject a request over the role's max_request_tokens before anything is spent on it"""
+    max_tokens = db.query(Role.max_request_tokens).join(User, User.role_id == Role.id).filter(User.id == user_id).scalar()
+    if max_tokens is not None and estimated_tokens > max_tokens:
+        raise Exception("Request too large")
+
+def reserve_tokens(db: Session, user_id: str, estimated_tokens: int, prefer_communal: bool = False, ttl: int = None, daily_used: int = 0, reject_oversized: bool = False) -> dict:
+    """
+    Pre-authorise a request: move an estimated amount (capped by the role's
+    max_request_tokens) out of the balance into a hold that expires on its own.
+    With reject_oversized an estimate over the cap raises instead.
+    Commit right after, so no lock is held during the upstream call.
+    """
+    try:
+        from uuid import UUID
+        UUID(user_id)
+    except ValueError:
+        raise Exception("Invalid user ID format")
+    
+    role = db.query(Role).join(User, User.role_id == Role.id).filter(User.id == user_id).first()
+    if not role:
+        raise Exception("User not found")
+    
+    if reject_oversized and estimated_tokens > role.max_request_tokens:
+        raise Exception("Request too large")
+    
+    amount = Decimal(str(min(estimated_tokens, role.max_request_tokens)))
+    source, parts = "personal", None
+    row = _withdraw(db, [Wallet.user_id == user_id, Wallet.type == WalletType.personal], amount)
+    
+    if not row and prefer_communal:
+        if daily_used + int(amount) <= role.daily_communal_limit_tokens:
+            source = "communal"
+            parts = withdraw_communal(db, user_id, amount)
+    
+    if not row and not parts:
+        raise Exception("Insufficient funds")
+    
+    hold = WalletHold(
+        user_id=user_id,
+        wallet_id=row.id if row else parts[0][0],
+        source=source,
+        amount_tokens=amount,
+        parts=[[stripe_id, str(part)] for stripe_id, part in parts] if parts else None,
+        status=HoldStatus.active,
+        expires_at=datetime.now(timezone.utc) + timedelta(seconds=ttl or Config.HOLD_TTL_SECONDS)
+    )
+    db.add(hold)
+    db.flush()
+    
+    result = {"hold_id": str(hold.id), "amount": float(amount), "source": source}
+    if row:
+        result.update(balance=float(row.balance_tokens), version=row.version)
+    return result
+
+def settle_hold(db: Session, hold_id: str, actual_tokens: int, defer_transaction: bool = False, daily_used: int = 0) -> dict:
+    """
+    Charge the actual usage against a hold and release the surplus.
+    Falls back to a regular charge if the hold already expired (its tokens
+    went back to the wallet). A hold that was settled or released is never
+    charged again.
+    Returns the same shape as charge_tokens.
+    """
+    hold = _close_hold(db, hold_id, HoldStatus.settled)
+    if not hold:
+        # Mark the expired hold settled as well, so a retried settle cannot charge twice
+        expired = db.execute(
+            update(WalletHold)
+            .where(WalletHold.id == hold_id, WalletHold.status == HoldStatus.expired)
+            .values(status=HoldStatus.settled)
+            .returning(WalletHold.user_id, WalletHold.source)
+        ).first()
+        if expired:
+            return charge_tokens(db, str(expired.user_id), actual_tokens, expired.source == "communal", defer_transaction, daily_used)
+        if not db.query(WalletHold.id).filter(WalletHold.id == hold_id).first():
+            raise Exception("Hold not found")
+        raise Exception("Hold already closed")
+    
+    actual = Decimal(str(actual_tokens))
+    charged = actual
+    meta = {"source": hold.source, "hold_id": str(hold_id)}
+    if hold.source == "communal":
+        return _settle_communal_hold(db, hold, actual, meta, defer_transaction)
+    
+    if actual <= hold.amount_tokens:
+        row = _deposit(db, hold.wallet_id, hold.amount_tokens - actual)
+    else:
+        # Usage exceeded the hold: take the rest if the wallet still has it
+        row = _withdraw(db, [Wallet.id == hold.wallet_id], actual - hold.amount_tokens)
+        if not row:
+            charged = hold.amount_tokens
+            meta["uncharged_tokens"] = float(actual - hold.amount_tokens)
+            row = db.query(Wallet.id, Wallet.balance_tokens, Wallet.version).filter(Wallet.id == hold.wallet_id).first()
+    
+    recorded = _record_transaction(db, defer_transaction, hold.wallet_id, charged, TransactionType.usage, meta)
+    
+    return {
+        "charged_from": hold.source, "amount": float(charged),
+        "balance": float(row.balance_tokens), "version": row.version, **recorded
+    }
+
+def _settle_communal_hold(db: Session, hold, actual: Decimal, meta: dict, defer_transaction: bool) -> dict:
+    """settle_hold for a communal hold: each stripe it was taken from is settled on its own"""
+    meta["user_id"] = str(hold.user_id)
+    parts = _hold_parts(hold)
+    
+    if actual <= hold.amount_tokens:
+        # The surplus goes back to the stripes borrowed from last
+        surplus, charged = hold.amount_tokens - actual, []
+        for stripe_id, part in reversed(parts):
+            back = min(part, surplus)
+            if back > 0:
+                _deposit(db, stripe_id, back)
+                surplus -= back
+            charged.insert(0, (stripe_id, part - back))
+    else:
+        # Usage exceeded the hold: take the rest if the pool still has it
+        extra = withdraw_communal(db, str(hold.user_id), actual - hold.amount_tokens)
+        if not extra:
+            meta["uncharged_tokens"] = float(actual - hold.amount_tokens)
+        totals = {}
+        for stripe_id, part in parts + extra:
+            totals[stripe_id] = totals.get(stripe_id, Decimal("0")) + part
+        charged = list(totals.items())
+    
+    charged = [(stripe_id, part) for stripe_id, part in charged if part > 0] or [(hold.wallet_id, Decimal("0"))]
+    recorded = _record_communal_transactions(db, defer_transaction, charged, meta)
+    
+    return {"charged_from": "communal", "amount": float(sum(part for _, part in charged)), **recorded}
+
+def release_hold(db: Session, hold_id: str, status: HoldStatus = HoldStatus.released) -> Optional[dict]:
+    """
+    Give the whole hold back (upstream call failed or was never made).
+    Returns the source and new balance for after_wallet_change, or None if
+    the hold was already closed.
+    """
+    hold = _close_hold(db, hold_id, status)
+    if not hold:
+        return None
+    
+    if hold.source == "communal":
+        # Back to every stripe the hold was taken from
+        for stripe_id, part in _hold_parts(hold):
+            _deposit(db, stripe_id, part)
+        return {"source": hold.source}
+    
+    row = _deposit(db, hold.wallet_id, hold.amount_tokens)
+    return {"source": hold.source, "balance": float(row.balance_tokens), "version": row.version}
+
+def expire_holds(db: Session, limit: int = 500) -> list:
+    """Release holds left behind by crashed requests. Returns the owners of the released holds."""
+    expired = db.query(WalletHold.id, WalletHold.user_id).filter(
+        WalletHold.status == HoldStatus.active,
+        WalletHold.expires_at < datetime.now(timezone.utc)
+    ).limit(limit).all()
+    
+    released = [str(row.user_id) for row in expired if release_hold(db, row.id, HoldStatus.expired)]
+    db.commit()
+    return released
+
+async def run_hold_expirer(interval: int = None):
+    """Background loop releasing expired holds"""
+    import asyncio
+    from starlette.concurrency import run_in_threadpool
+    from app.database import SessionLocal
+    
+    interval = interval or Config.HOLD_EXPIRY_INTERVAL
+    
+    def expire_once() -> list:
+        db = SessionLocal()
+        try:
+            return expire_holds(db)
+        finally:
+            db.close()
+    
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            released = await run_in_threadpool(expire_once)
+            if released:
+                print(f"Released {len(released)} expired wallet holds")
+            for user_id in set(released):
+                await after_wallet_change(user_id)
+        except Exception as e:
+            print(f"Hold expiry error: {e}")
+
+def usage_record_values(user_id: str, usage_data: dict) -> dict:
+    """UsageRecord column values with only metadata - NO CHAT CONTENT"""
+    meta = {
+        "model": usage_data.get("model"),
+        "openai_id": usage_data.get("id")
+    }
+    # Set for requests that went through the response cache (hit rate, tokens saved)
+    if "cache_hit" in usage_data:
+        meta["cache_hit"] = usage_data["cache_hit"]
+        meta["upstream_total_tokens"] = usage_data.get("upstream_total_tokens", usage_data["total_tokens"])
+    # Partial reply billed after the client went away mid-stream
+    if usage_data.get("client_disconnected"):
+        meta["client_disconnected"] = True
+    return {
+        "user_id": user_id,
+        "prompt_tokens": usage_data["prompt_tokens"],
+        "completion_tokens": usage_data["completion_tokens"],
+        "total_tokens": usage_data["total_tokens"],
+        "openai_response_meta": meta
+    }
+
 def create_usage_record(db: Session, user_id: str, usage_data: dict, transaction_id: int):
-    """Create usage record with only metadata - NO CHAT CONTENT"""
+    """Create usage record with only metadata - NO CHAT CONTENT (committed by the caller)"""
     usage_record = UsageRecord(
-        user_id=user_id,
-        prompt_tokens=usage_data["prompt_tokens"],
-        completion_tokens=usage_data["completion_tokens"],
-        total_tokens=usage_data["total_tokens"],
-        openai_response_meta={
-            "model": usage_data.get("model"),
-            "openai_id": usage_data.get("id")
-        },
+        **usage_record_values(user_id, usage_data),
         transaction_id=transaction_id
     )
     db.add(usage_record)
-    db.commit()
\ No newline at end of file
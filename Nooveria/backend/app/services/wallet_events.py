@@ -1,3 +1,4 @@
+import uuid
 from sqlalchemy.orm import Session
 from app.models import WalletEvent
 from decimal import Decimal
@@ -12,36 +13,47 @@ def create_topup_event(db: Session, user_id: str, amount: float, description: st
     )
     db.add(event)
 
-def create_chat_expense_event(db: Session, user_id: str, amount: float, chat_id: str = None, is_communal: bool = False):
-    print(f"Creating chat expense event: user={user_id}, amount={amount}, chat_id={chat_id}, communal={is_communal}")
-    """Create separate events for personal and communal expenses"""
+def chat_expense_event_values(user_id: str, amount: float, chat_id: str = None, is_communal: bool = False) -> dict:
+    """WalletEvent column values for a chat expense (personal or communal)"""
     event_type = "chat_expense_communal" if is_communal else "chat_expense_personal"
     description = f"Расходы на чат (общие токены): {amount} токенов" if is_communal else f"Расходы на чат (личные токены): {amount} токенов"
     
+    return {
+        # Chosen up front so the live push can name the row the ledger writes later
+        "id": uuid.uuid4(),
+        "user_id": user_id,
+        "event_type": event_type,
+        "amount": Decimal(str(amount)),
+        "description": description,
+        "chat_id": chat_id
+    }
+
+def world_chat_expense_event_values(user_id: str, amount: float, world_id: int, world_name: str, is_communal: bool = False) -> dict:
+    """WalletEvent column values for a world chat expense (personal or communal)"""
+    event_type = "world_chat_expense_communal" if is_communal else "world_chat_expense_personal"
+    description = f"Расходы в мире '{world_name}' (общие токены): {amount} токенов" if is_communal else f"Расходы в мире '{world_name}' (личные токены): {amount} токенов"
+    
+    return {
+        "id": uuid.uuid4(),
+        "user_id": user_id,
+        "event_type": event_type,
+        "amount": Decimal(str(amount)),
+        "description": description,
+        "world_id": world_id
+    }
+
+def create_chat_expense_event(db: Session, user_id: str, amount: float, chat_id: str = None, is_communal: bool = False):
+    print(f"Creating chat expense event: user={user_id}, amount={amount}, chat_id={chat_id}, communal={is_communal}")
+    """Create separate events for personal and communal expenses"""
     # Always create new event for each expense
-    event = WalletEvent(
-        user_id=user_id,
-        event_type=event_type,
-        amount=Decimal(str(amount)),
-        description=description,
-        chat_id=chat_id
-    )
+    event = WalletEvent(**chat_expense_event_values(user_id, amount, chat_id, is_communal))
     db.add(event)
 
 def create_world_chat_expense_event(db: Session, user_id: str, amount: float, world_id: int, world_name: str, is_communal: bool = False):
     print(f"Creating world chat expense event: user={user_id}, amount={amount}, world_id={world_id}, world_name={world_name}, communal={is_communal}")
     """Create separate events for personal and communal world chat expenses"""
-    event_type = "world_chat_expense_communal" if is_communal else "world_chat_expense_personal"
-    description = f"Расходы в мире '{world_name}' (общие токены): {amount} токенов" if is_communal else f"Расходы в мире '{world_name}' (личные токены): {amount} токенов"
-    
     # Always create new event for each expense
-    event = WalletEvent(
-        user_id=user_id,
-        event_type=event_type,
-        amount=Decimal(str(amount)),
-        description=description,
-        world_id=world_id
-    )
+    event = WalletEvent(**world_chat_expense_event_values(user_id, amount, world_id, world_name, is_communal))
     db.add(event)
 
 def create_transfer_event(db: Session, from_user_id: str, to_user_id: str, amount: float):
@@ -0,0 +1,179 @@
+import json
+import asyncio
+from datetime import datetime
+from typing import Optional, List
+from redis.exceptions import RedisError
+from app.config import Config
+from app.services.redis_client import get_redis
+
+# Per-user push of wallet changes (GET /api/wallets/stream).
+# Every notification is appended to a short Redis stream per user (the replay
+# buffer for Last-Event-ID) and published on WALLET_PUSH_CHANNEL in the same
+# script. Each worker holds one subscription and fans messages out to the
+# connections it serves, so an open stream costs no Redis connection.
+
+WALLET_PUSH_CHANNEL = "wallet_push"
+
+# KEYS[1] = stream, ARGV = maxlen, ttl, event, data, user_id, channel
+_APPEND_AND_PUBLISH = """
+local id = redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[1], '*', 'event', ARGV[3], 'data', ARGV[4])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+redis.call('PUBLISH', ARGV[6], cjson.encode({user_id = ARGV[5], id = id, event = ARGV[3], data = ARGV[4]}))
+return id
+"""
+
+def _stream_key(user_id: str) -> str:
+    return f"wallet_push:{user_id}"
+
+def _id_tuple(entry_id: str) -> tuple:
+    ms, _, seq = entry_id.partition("-")
+    return int(ms), int(seq or 0)
+
+class _Subscriber:
+    def __init__(self):
+        self.queue = asyncio.Queue(maxsize=Config.WALLET_PUSH_QUEUE_SIZE)
+        self.lagging = False
+
+class WalletPushHub:
+    """Connections served by this worker, keyed by user id"""
+
+    def __init__(self):
+        self._subscribers = {}
+
+    def subscribe(self, user_id: str) -> _Subscriber:
+        subscriber = _Subscriber()
+        self._subscribers.setdefault(user_id, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, user_id: str, subscriber: _Subscriber):
+        subscribers = self._subscribers.get(user_id)
+        if subscribers:
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self._subscribers[user_id]
+
+    def dispatch(self, message: dict):
+        for subscriber in self._subscribers.get(message["user_id"], ()):
+            try:
+                subscriber.queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # The connection catches up from the replay buffer instead
+                subscriber.lagging = True
+
+    def mark_lagging(self):
+        """Every connection replays from its last id (messages may have been missed)"""
+        for subscribers in self._subscribers.values():
+            for subscriber in subscribers:
+                subscriber.lagging = True
+
+    def stats(self) -> dict:
+        return {
+            "users": len(self._subscribers),
+            "connections": sum(len(subscribers) for subscribers in self._subscribers.values())
+        }
+
+wallet_push_hub = WalletPushHub()
+
+async def publish_wallet_update(user_id: str, event: str, data: dict):
+    """Push one notification to every open stream of the user (best effort)"""
+    try:
+        await get_redis().eval(
+            _APPEND_AND_PUBLISH, 1, _stream_key(user_id),
+            Config.WALLET_PUSH_REPLAY, Config.WALLET_PUSH_TTL,
+            event, json.dumps(data, ensure_ascii=False, default=str), str(user_id), WALLET_PUSH_CHANNEL
+        )
+    except RedisError as e:
+        print(f"Wallet push failed: {e}")
+
+async def publish_balance_change(user_id: str, result: Optional[dict], events: Optional[List[dict]] = None):
+    """
+    balance_changed (with the personal balance when the change was to the
+    personal wallet) followed by one wallet_event per new WalletEvent row.
+    """
+    data = {}
+    if result:
+        data["source"] = result.get("charged_from", result.get("source"))
+        if data["source"] == "personal":
+            data["personal"] = {"balance": result["balance"]}
+    await publish_wallet_update(user_id, "balance_changed", data)
+
+    for values in events or []:
+        await publish_wallet_update(user_id, "wallet_event", {
+            "id": str(values["id"]) if values.get("id") else None,
+            "type": values["event_type"],
+            "amount": float(values["amount"]),
+            "description": values.get("description"),
+            "created_at": datetime.utcnow().isoformat()
+        })
+
+async def _replay(user_id: str, last_event_id: str) -> list:
+    """Entries after last_event_id still held in the replay buffer"""
+    try:
+        return await get_redis().xrange(_stream_key(user_id), min=f"({last_event_id}", max="+")
+    except RedisError as e:
+        print(f"Wallet push replay failed: {e}")
+        return []
+
+async def _latest_id(user_id: str) -> Optional[str]:
+    """Id of the newest entry in the replay buffer"""
+    try:
+        entries = await get_redis().xrevrange(_stream_key(user_id), count=1)
+    except RedisError:
+        return None
+    return entries[0][0] if entries else None
+
+def _sse_frame(entry_id: str, event: str, data: str) -> str:
+    return f"id: {entry_id}\nevent: {event}\ndata: {data}\n\n"
+
+async def stream_wallet_updates(user_id: str, last_event_id: Optional[str] = None):
+    """SSE frames for one connection: replay after last_event_id, then live updates and heartbeats"""
+    # Without a Last-Event-ID, start after the newest entry. The start id is read
+    # before subscribing and replayed after, so nothing published in between is lost.
+    start_id = last_event_id or await _latest_id(user_id) or "0-0"
+    last_seen = _id_tuple(start_id)
+    subscriber = wallet_push_hub.subscribe(user_id)
+    try:
+        yield f"retry: {Config.WALLET_PUSH_RETRY_MS}\n\n"
+        subscriber.lagging = True
+
+        while True:
+            if subscriber.lagging:
+                subscriber.lagging = False
+                while not subscriber.queue.empty():
+                    subscriber.queue.get_nowait()
+                for entry_id, fields in await _replay(user_id, "%d-%d" % last_seen):
+                    last_seen = _id_tuple(entry_id)
+                    yield _sse_frame(entry_id, fields["event"], fields["data"])
+
+            try:
+                message = await asyncio.wait_for(subscriber.queue.get(), Config.WALLET_PUSH_HEARTBEAT)
+            except asyncio.TimeoutError:
+                yield ": ping\n\n"
+                continue
+
+            entry_id = _id_tuple(message["id"])
+            if entry_id <= last_seen:
+                continue  # already sent during replay
+            last_seen = entry_id
+            yield _sse_frame(message["id"], message["event"], message["data"])
+    finally:
+        wallet_push_hub.unsubscribe(user_id, subscriber)
+
+async def run_wallet_push_listener():
+    """Fan published notifications out to this worker's connections"""
+    while True:
+        pubsub = get_redis().pubsub()
+        try:
+            await pubsub.subscribe(WALLET_PUSH_CHANNEL)
+            # Anything published while unsubscribed comes from the replay buffers
+            wallet_push_hub.mark_lagging()
+            async for message in pubsub.listen():
+                if message["type"] == "message":
+                    wallet_push_hub.dispatch(json.loads(message["data"]))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Wallet push listener error: {e}")
+            await asyncio.sleep(1)
+        finally:
+            await pubsub.aclose()
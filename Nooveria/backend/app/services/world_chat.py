@@ -1,5 +1,8 @@
+from sqlalchemy import update
 from sqlalchemy.orm import Session
 from app.models import WorldChat, WorldChatMessage, World, User
+from app.services.chat_list import record_messages
+from app.services.purge import deleted_world_chat_values
 import os
 import openai
 import time
@@ -7,12 +10,13 @@ import time
 # Removed - no longer needed
 
 def send_world_message(db: Session, world_chat: WorldChat, message: str) -> dict:
-    """Send message to world chat and get response"""
+    """Send message to world chat and get response (the messages are committed by the caller, with the charge)"""
     world = db.query(World).filter(World.id == world_chat.world_id).first()
     
     # Save user message
     user_message = WorldChatMessage(
         world_chat_id=world_chat.id,
+        user_id=world_chat.user_id,
         role="user",
         content=message
     )
@@ -24,16 +28,16 @@ def send_world_message(db: Session, world_chat: WorldChat, message: str) -> dict
     # Save assistant message
     assistant_message = WorldChatMessage(
         world_chat_id=world_chat.id,
+        user_id=world_chat.user_id,
         role="assistant",
         content=assistant_response
     )
     db.add(assistant_message)
     
     # Update chat title if first message
-    if len(world_chat.messages) == 0:
+    if not world_chat.message_count:
         world_chat.title = message[:50] + ("..." if len(message) > 50 else "")
-    
-    db.commit()
+    record_messages(world_chat, 2, assistant_response)
     
     return {
         "response": assistant_response,
@@ -41,13 +45,9 @@ def send_world_message(db: Session, world_chat: WorldChat, message: str) -> dict
         "usage": {"total_tokens": 50}
     }
 
-def delete_world_chat(db: Session, world_chat: WorldChat):
-    """Delete world chat"""
-    db.delete(world_chat)
-
-def delete_all_world_chats(db: Session, world_id: int):
-    """Delete all chats for a world"""
-    world_chats = db.query(WorldChat).filter(WorldChat.world_id == world_id).all()
-    
-    for world_chat in world_chats:
-        db.delete(world_chat)
\ No newline at end of file
+def delete_world_chats(db: Session, *filters) -> int:
+    """Delete the world chats matching filters: hidden at once, rows purged in the background (see services/purge)"""
+    return db.execute(
+        update(WorldChat).where(*filters, WorldChat.deleted_at.is_(None)).values(**deleted_world_chat_values()),
+        execution_options={"synchronize_session": False}
+    ).rowcount
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Benchmark charge_tokens under concurrent load.
+
+Compares the conditional-UPDATE charging path in app.services.wallet with the
+previous SELECT ... FOR UPDATE implementation (kept below as legacy_charge_tokens).
+Creates throwaway users and wallets, runs both implementations with the same
+thread count, prints throughput and latency percentiles, then cleans up.
+
+Usage:
+    DATABASE_URL=postgresql://... python benchmark_charge_tokens.py --users 50 --threads 32 --charges 2000
+"""
+
+import os
+import sys
+import time
+import uuid
+import argparse
+import statistics
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from sqlalchemy import and_
+from app.database import SessionLocal
+from app.models import User, Role, Wallet, Transaction, WalletType, TransactionType
+from app.services.wallet import charge_tokens
+
+def legacy_charge_tokens(db, user_id: str, total_tokens: int, prefer_communal: bool = False) -> dict:
+    """Previous implementation: locks the personal AND the communal wallet row on every charge"""
+    user = db.query(User).filter(User.id == user_id).first()
+    if not user:
+        raise Exception("User not found")
+
+    personal_wallet = db.query(Wallet).filter(
+        and_(Wallet.user_id == user_id, Wallet.type == WalletType.personal)
+    ).with_for_update().first()
+
+    communal_wallet = db.query(Wallet).filter(
+        Wallet.type == WalletType.communal
+    ).with_for_update().first()
+
+    tokens_needed = Decimal(str(total_tokens))
+    if personal_wallet.balance_tokens >= tokens_needed:
+        personal_wallet.balance_tokens -= tokens_needed
+        transaction = Transaction(
+            wallet_from_id=personal_wallet.id,
+            amount_tokens=tokens_needed,
+            type=TransactionType.usage,
+            meta={"source": "personal"}
+        )
+        db.add(transaction)
+        db.flush()
+        return {"charged_from": "personal", "transaction_id": transaction.id}
+
+    raise Exception("Insufficient funds")
+
+def seed_users(count: int, balance: int) -> list:
+    db = SessionLocal()
+    try:
+        role = db.query(Role).filter(Role.name == "user").first()
+        if not role:
+            raise SystemExit("Role 'user' not found - run init_db.py first")
+
+        user_ids = []
+        for i in range(count):
+            user = User(
+                email=f"bench-{uuid.uuid4().hex[:12]}@benchmark.local",
+                role_id=role.id,
+                display_name=f"bench-{i}"
+            )
+            db.add(user)
+            db.flush()
+            db.add(Wallet(user_id=user.id, type=WalletType.personal, balance_tokens=Decimal(balance)))
+            user_ids.append(str(user.id))
+        db.commit()
+        return user_ids
+    finally:
+        db.close()
+
+def cleanup(user_ids: list):
+    db = SessionLocal()
+    try:
+        wallet_ids = [w.id for w in db.query(Wallet.id).filter(Wallet.user_id.in_(user_ids)).all()]
+        db.query(Transaction).filter(Transaction.wallet_from_id.in_(wallet_ids)).delete(synchronize_session=False)
+        db.query(Wallet).filter(Wallet.id.in_(wallet_ids)).delete(synchronize_session=False)
+        db.query(User).filter(User.id.in_(user_ids)).delete(synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+def run(charge_fn, user_ids: list, threads: int, charges: int) -> dict:
+    def one_charge(i: int) -> float:
+        db = SessionLocal()
+        started = time.perf_counter()
+        try:
+            charge_fn(db, user_ids[i % len(user_ids)], 1)
+            db.commit()
+        except Exception:
+            db.rollback()
+        finally:
+            db.close()
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        latencies = sorted(pool.map(one_charge, range(charges)))
+    elapsed = time.perf_counter() - started
+
+    return {
+        "throughput": charges / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark charge_tokens implementations")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--charges", type=int, default=2000)
+    args = parser.parse_args()
+
+    user_ids = seed_users(args.users, args.charges * 2)
+    try:
+        for name, fn in [("legacy (FOR UPDATE)", legacy_charge_tokens), ("conditional UPDATE", charge_tokens)]:
+            result = run(fn, user_ids, args.threads, args.charges)
+            print(f"{name:22} {result['throughput']:8.1f} charges/s  p50 {result['p50_ms']:7.2f} ms  p99 {result['p99_ms']:7.2f} ms")
+    finally:
+        cleanup(user_ids)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Benchmark API latency with the async database layer vs the sync one.
+
+Starts the API once per mode (ASYNC_DB=true / ASYNC_DB=false) with uvicorn,
+drives the same mixed load against each - chat list, chat history, wallet
+balance, wallet events and streamed chat messages - and prints p50/p99 per
+request kind. Throwaway users, wallets and chats are cleaned up afterwards.
+Run with OPENAI_API_KEY unset so chat messages use the mock upstream.
+
+Usage:
+    DATABASE_URL=postgresql://... python benchmark_db_latency.py --users 20 --concurrency 64 --duration 30
+"""
+
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import statistics
+import subprocess
+from collections import defaultdict
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import httpx
+from app.database import SessionLocal
+from app.models import Chat, ChatMessage, WalletEvent, UsageRecord, WalletHold
+from app.services.auth import create_access_token
+from benchmark_charge_tokens import seed_users, cleanup
+
+# (kind, weight) - roughly what the frontend sends while users are chatting
+REQUEST_MIX = [
+    ("list_chats", 30),
+    ("get_chat", 20),
+    ("wallets", 25),
+    ("wallet_events", 10),
+    ("send_message", 15),
+]
+
+def seed_chats(user_ids: list) -> dict:
+    db = SessionLocal()
+    try:
+        chats = {}
+        for user_id in user_ids:
+            chat = Chat(user_id=user_id, title="benchmark")
+            db.add(chat)
+            db.flush()
+            chats[user_id] = str(chat.id)
+        db.commit()
+        return chats
+    finally:
+        db.close()
+
+def cleanup_chat_data(user_ids: list):
+    db = SessionLocal()
+    try:
+        chat_ids = [c.id for c in db.query(Chat.id).filter(Chat.user_id.in_(user_ids)).all()]
+        db.query(ChatMessage).filter(ChatMessage.chat_id.in_(chat_ids)).delete(synchronize_session=False)
+        db.query(Chat).filter(Chat.id.in_(chat_ids)).delete(synchronize_session=False)
+        db.query(WalletEvent).filter(WalletEvent.user_id.in_(user_ids)).delete(synchronize_session=False)
+        db.query(UsageRecord).filter(UsageRecord.user_id.in_(user_ids)).delete(synchronize_session=False)
+        db.query(WalletHold).filter(WalletHold.user_id.in_(user_ids)).delete(synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+def start_server(async_db: bool, port: int) -> subprocess.Popen:
+    env = {**os.environ, "ASYNC_DB": "true" if async_db else "false", "OPENAI_API_KEY": ""}
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env
+    )
+    for _ in range(100):
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/health", timeout=1)
+            return server
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    server.terminate()
+    raise SystemExit("API did not start")
+
+async def one_request(client: httpx.AsyncClient, kind: str, user_id: str, chat_id: str):
+    headers = {"Authorization": f"Bearer {create_access_token({'sub': user_id, 'role': 'user'})}"}
+    if kind == "list_chats":
+        await client.get("/api/chats", headers=headers)
+    elif kind == "get_chat":
+        await client.get(f"/api/chats/{chat_id}", headers=headers)
+    elif kind == "wallets":
+        await client.get("/api/wallets", headers=headers)
+    elif kind == "wallet_events":
+        await client.get("/api/wallets/events", headers=headers, params={"limit": 200})
+    else:
+        async with client.stream("POST", f"/api/chats/{chat_id}/messages", headers=headers,
+                                 json={"message": "benchmark", "stream": True}) as response:
+            async for _ in response.aiter_bytes():
+                pass
+
+async def run_load(port: int, chats: dict, concurrency: int, duration: float) -> dict:
+    kinds = [kind for kind, _ in REQUEST_MIX]
+    weights = [weight for _, weight in REQUEST_MIX]
+    user_ids = list(chats)
+    latencies = defaultdict(list)
+    deadline = time.perf_counter() + duration
+
+    async def worker(client: httpx.AsyncClient):
+        while time.perf_counter() < deadline:
+            kind = random.choices(kinds, weights)[0]
+            user_id = random.choice(user_ids)
+            started = time.perf_counter()
+            try:
+                await one_request(client, kind, user_id, chats[user_id])
+            except httpx.HTTPError:
+                kind = "errors"
+            latencies[kind].append(time.perf_counter() - started)
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=60, limits=limits) as client:
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+    return latencies
+
+def report(name: str, latencies: dict):
+    print(f"\n{name}")
+    everything = sorted(value for values in latencies.values() for value in values)
+    for kind, values in sorted(latencies.items()) + [("all", everything)]:
+        values = sorted(values)
+        p99 = values[max(int(len(values) * 0.99) - 1, 0)]
+        print(f"  {kind:14} {len(values):7} req  p50 {statistics.median(values) * 1000:8.2f} ms  p99 {p99 * 1000:8.2f} ms")
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare p99 latency of the async and sync database layers")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    user_ids = seed_users(args.users, 10_000_000)
+    chats = seed_chats(user_ids)
+    try:
+        for name, async_db in [("sync (psycopg2 in threadpool)", False), ("async (asyncpg)", True)]:
+            server = start_server(async_db, args.port)
+            try:
+                report(name, asyncio.run(run_load(args.port, chats, args.concurrency, args.duration)))
+            finally:
+                server.terminate()
+                server.wait()
+    finally:
+        cleanup_chat_data(user_ids)
+        cleanup(user_ids)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import asyncio
+from app.services.admission import AdmissionScheduler, UpstreamBusy
+
+def _run(scheduler, callers, hold=0.01):
+    order = []
+    
+    async def call(user_id, role_name):
+        async with scheduler.slot(user_id, role_name):
+            order.append(role_name)
+            await asyncio.sleep(hold)
+    
+    async def burst():
+        return await asyncio.gather(*(call(user_id, role_name) for user_id, role_name in callers), return_exceptions=True)
+    
+    return asyncio.run(burst()), order
+
+def test_queued_roles_share_slots_by_weight():
+    scheduler = AdmissionScheduler(capacity=1, per_user=1, deadline=5.0)
+    scheduler._service_time = 0.01
+    callers = [(f"anon-{i}", "anonymous") for i in range(8)] + [(f"admin-{i}", "admin") for i in range(8)]
+    
+    _, order = _run(scheduler, callers)
+    
+    # While both queues are backed up, admins get most of the slots
+    contended = order[2:10]
+    assert contended.count("admin") > contended.count("anonymous")
+    assert scheduler.stats()["admitted"] == 16
+
+def test_per_user_inflight_limit():
+    scheduler = AdmissionScheduler(capacity=5, per_user=1, deadline=5.0)
+    scheduler._service_time = 0.01
+    peak = []
+    
+    async def call():
+        async with scheduler.slot("same-user", "user"):
+            peak.append(scheduler.active)
+            await asyncio.sleep(0.01)
+    
+    async def burst():
+        await asyncio.gather(*(call() for _ in range(4)))
+    
+    asyncio.run(burst())
+    assert max(peak) == 1
+
+def test_rejects_when_expected_wait_exceeds_deadline():
+    scheduler = AdmissionScheduler(capacity=1, per_user=1, deadline=0.5)
+    scheduler._service_time = 1.0
+    
+    results, _ = _run(scheduler, [("a", "user"), ("b", "user")])
+    
+    assert results[0] is None
+    assert isinstance(results[1], UpstreamBusy)
+    assert results[1].retry_after >= 1
+    assert scheduler.stats()["rejected"] == 1
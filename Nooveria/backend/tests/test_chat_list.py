@@ -0,0 +1,29 @@
+from app.config import Config
+from app.models.chat import Chat
+from app.models.world_chat import WorldChat
+from app.services.chat_list import message_preview, record_messages, list_limit
+
+def test_preview_is_short_and_single_line():
+    assert message_preview("  Hello\n\nthere  ") == "Hello there"
+    assert len(message_preview("word " * 100)) == Config.CHAT_PREVIEW_LENGTH
+
+def test_new_messages_update_the_chat_row():
+    chat = Chat(title="Test", message_count=4)
+    record_messages(chat, 2, "The reply\nin two lines")
+
+    assert chat.last_message_preview == "The reply in two lines"
+    # Incremented in SQL, not from the value this request happened to load
+    assert "message_count +" in str(chat.message_count)
+
+def test_list_page_size_is_bounded():
+    assert list_limit(None) == Config.CHAT_LIST_PAGE_SIZE
+    assert list_limit(0) == 1
+    assert list_limit(10 ** 6) == Config.CHAT_LIST_PAGE_MAX
+
+def test_chat_lists_have_an_index_by_user_and_activity():
+    for model, name, columns in (
+        (Chat, "ix_chats_user_updated", ["user_id", "updated_at", "id"]),
+        (WorldChat, "ix_world_chats_user_world_updated", ["user_id", "world_id", "updated_at", "id"])
+    ):
+        index = {index.name: index for index in model.__table__.indexes}[name]
+        assert [getattr(expression, "element", expression).name for expression in index.expressions] == columns
@@ -0,0 +1,35 @@
+from app.models.chat import Chat, ChatMessage
+from app.services.context_window import build_context
+
+def make_chat(turns: int, summary: str = None, summarized: int = 0):
+    """A chat and its unsummarized messages, as load_recent_messages returns them"""
+    chat = Chat(title="Test", summary=summary, summary_message_count=summarized, message_count=turns * 2)
+    history = [
+        ChatMessage(role="user" if n % 2 == 0 else "assistant", content=f"message {n}", token_count=100)
+        for n in range(turns * 2)
+    ]
+    return chat, history[summarized:]
+
+def test_short_chat_is_sent_whole():
+    messages, needs_summary = build_context(*make_chat(2), "hello", budget=1000)
+    
+    assert [msg["content"] for msg in messages] == ["message 0", "message 1", "message 2", "message 3", "hello"]
+    assert not needs_summary
+
+def test_long_chat_keeps_newest_messages_within_budget():
+    messages, needs_summary = build_context(*make_chat(50), "hello", budget=1000)
+    
+    assert len(messages) == 10  # 9 x 100 tokens of history plus the new message
+    assert messages[0]["content"] == "message 91"
+    assert messages[-1] == {"role": "user", "content": "hello"}
+    assert needs_summary
+
+def test_summary_replaces_folded_messages():
+    chat, history = make_chat(50, summary="The user asked about icons.", summarized=90)
+    messages, needs_summary = build_context(chat, history, "hello", budget=1000)
+    
+    assert messages[0]["role"] == "system"
+    assert "icons" in messages[0]["content"]
+    # The summary takes part of the budget, so only 9 recent messages fit
+    assert [msg["content"] for msg in messages[1:-1]] == [f"message {n}" for n in range(91, 100)]
+    assert not needs_summary  # one 100-token message out of the window is below CHAT_SUMMARY_MIN_TOKENS
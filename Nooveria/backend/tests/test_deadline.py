@@ -0,0 +1,93 @@
+import asyncio
+import pytest
+from app.services import deadline
+from app.services.deadline import DeadlineExceeded, run_stage, stage_timeout, deadline_stats
+
+def test_stage_timeout_is_capped_by_the_time_left():
+    async def scenario():
+        assert stage_timeout("upstream", 30) == 30
+        token = deadline.start(2)
+        try:
+            assert stage_timeout("upstream", 30) <= 2
+            assert stage_timeout("upstream", 0.5) == 0.5
+        finally:
+            deadline.reset(token)
+
+    asyncio.run(scenario())
+
+def test_stage_fails_fast_when_too_little_is_left():
+    async def scenario():
+        token = deadline.start(0.5)
+        try:
+            with pytest.raises(DeadlineExceeded) as exc:
+                stage_timeout("upstream", 30, minimum=1.0)
+            assert exc.value.stage == "upstream"
+        finally:
+            deadline.reset(token)
+
+    asyncio.run(scenario())
+
+def test_run_stage_reports_the_stage_that_ran_out():
+    async def scenario():
+        before = deadline_stats.exceeded.get("redis", 0)
+        token = deadline.start(0.1)
+        try:
+            with pytest.raises(DeadlineExceeded) as exc:
+                await run_stage("redis", asyncio.sleep(5))
+        finally:
+            deadline.reset(token)
+        assert exc.value.stage == "redis"
+        assert deadline_stats.exceeded["redis"] == before + 1
+
+    asyncio.run(scenario())
+
+def test_suspended_bookkeeping_ignores_the_deadline():
+    async def scenario():
+        token = deadline.start(0.01)
+        try:
+            await asyncio.sleep(0.02)
+            with deadline.suspended():
+                assert await run_stage("redis", asyncio.sleep(0, result="done")) == "done"
+            with pytest.raises(DeadlineExceeded):
+                await run_stage("redis", asyncio.sleep(0))
+        finally:
+            deadline.reset(token)
+
+    asyncio.run(scenario())
+
+def test_admission_wait_is_bounded_by_the_request_deadline():
+    from app.services.admission import AdmissionScheduler
+
+    async def scenario():
+        scheduler = AdmissionScheduler(capacity=1, per_user=1, deadline=10)
+        scheduler._service_time = 0.01
+        await scheduler.acquire("a")
+        token = deadline.start(0.2)
+        try:
+            with pytest.raises(DeadlineExceeded) as exc:
+                await scheduler.acquire("b")
+        finally:
+            deadline.reset(token)
+        assert exc.value.stage == "admission"
+        assert scheduler.active == 1
+
+    asyncio.run(scenario())
+
+def test_redis_pipeline_is_bounded_by_the_request_deadline():
+    from app.services.redis_client import DeadlineRedis
+
+    async def scenario():
+        client = DeadlineRedis()
+        token = deadline.start(0.01)
+        try:
+            await asyncio.sleep(0.02)
+            async with client.pipeline(transaction=False) as pipe:
+                pipe.get("key")
+                with pytest.raises(DeadlineExceeded) as exc:
+                    await pipe.execute()
+            assert exc.value.stage == "redis"
+        finally:
+            deadline.reset(token)
+            await client.aclose()
+
+    asyncio.run(scenario())
@@ -0,0 +1,41 @@
+import asyncio
+import pytest
+from app.services.disconnects import run_unless_disconnected, ClientDisconnected, disconnect_stats
+
+class FakeRequest:
+    def __init__(self, disconnect_after: int):
+        self.checks = 0
+        self.disconnect_after = disconnect_after
+
+    async def is_disconnected(self) -> bool:
+        self.checks += 1
+        return self.checks >= self.disconnect_after
+
+def test_upstream_work_is_cancelled_when_the_client_leaves(monkeypatch):
+    from app.config import Config
+    monkeypatch.setattr(Config, "DISCONNECT_POLL_INTERVAL", 0.01)
+    cancelled = []
+
+    async def upstream():
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def scenario():
+        before = disconnect_stats.cancelled_requests
+        with pytest.raises(ClientDisconnected):
+            await run_unless_disconnected(FakeRequest(disconnect_after=2), upstream())
+        await asyncio.sleep(0)
+        return disconnect_stats.cancelled_requests - before
+
+    assert asyncio.run(scenario()) == 1
+    assert cancelled == [True]
+
+def test_result_is_returned_while_the_client_waits():
+    async def upstream():
+        await asyncio.sleep(0.01)
+        return "reply"
+
+    assert asyncio.run(run_unless_disconnected(FakeRequest(disconnect_after=1000), upstream())) == "reply"
@@ -0,0 +1,112 @@
+import asyncio
+import pytest
+from app.services import idempotency
+from app.services.idempotency import IdempotentRequest, IdempotencyConflict
+
+class FakeRedis:
+    """The few commands the idempotency keys use, in memory"""
+
+    def __init__(self):
+        self.values = {}
+        self.ttls = {}
+
+    async def get(self, key):
+        return self.values.get(key)
+
+    async def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.values:
+            return None
+        self.values[key] = value
+        self.ttls[key] = ex
+        return True
+
+    async def eval(self, script, numkeys, key, token, *args):
+        if self.values.get(key) != token:
+            return 0
+        if script == idempotency._EXTEND_LOCK:
+            self.ttls[key] = args[0]
+        else:
+            del self.values[key]
+        return 1
+
+@pytest.fixture
+def redis(monkeypatch):
+    from app.config import Config
+    fake = FakeRedis()
+    monkeypatch.setattr(idempotency, "get_redis", lambda: fake)
+    monkeypatch.setattr(Config, "IDEMPOTENCY_POLL_INTERVAL", 0.01)
+    return fake
+
+def test_duplicate_waits_for_the_original_and_gets_its_reply(redis):
+    calls = []
+
+    async def submit():
+        request = IdempotentRequest("key-1", "user", "chats/1", {"message": "Hi"})
+        stored = await request.begin()
+        if stored is not None:
+            return stored
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        reply = {"message": {"role": "assistant", "content": "Hello"}, "usage": {"total_tokens": 12}}
+        await request.finish(reply)
+        return reply
+
+    async def scenario():
+        return await asyncio.gather(submit(), submit(), submit())
+
+    replies = asyncio.run(scenario())
+    assert len(calls) == 1
+    assert all(reply["message"]["content"] == "Hello" for reply in replies)
+    assert asyncio.run(submit())["usage"]["total_tokens"] == 12
+    assert len(calls) == 1
+
+def test_failed_request_can_be_retried(redis):
+    async def scenario():
+        first = IdempotentRequest("key-2", "user", "chats/1", {"message": "Hi"})
+        assert await first.begin() is None
+        await first.abandon()
+        retry = IdempotentRequest("key-2", "user", "chats/1", {"message": "Hi"})
+        assert await retry.begin() is None
+
+    asyncio.run(scenario())
+
+def test_key_reused_for_another_message_is_rejected(redis):
+    async def scenario():
+        first = IdempotentRequest("key-3", "user", "chats/1", {"message": "Hi"})
+        assert await first.begin() is None
+        await first.finish({"message": {"role": "assistant", "content": "Hello"}, "usage": {"total_tokens": 12}})
+        with pytest.raises(IdempotencyConflict):
+            await IdempotentRequest("key-3", "user", "chats/1", {"message": "Bye"}).begin()
+        # Other users and other chats have their own keys
+        assert await IdempotentRequest("key-3", "other", "chats/1", {"message": "Bye"}).begin() is None
+        assert await IdempotentRequest("key-3", "user", "chats/2", {"message": "Bye"}).begin() is None
+
+    asyncio.run(scenario())
+
+def test_requests_without_a_key_run_normally(redis):
+    async def scenario():
+        request = IdempotentRequest(None, "user", "chats/1", {"message": "Hi"})
+        assert await request.begin() is None
+        await request.finish({"usage": {"total_tokens": 1}})
+
+    asyncio.run(scenario())
+    assert redis.values == {}
+
+def test_long_request_refreshes_its_lock(redis, monkeypatch):
+    from app.config import Config
+    monkeypatch.setattr(Config, "IDEMPOTENCY_LOCK_TTL", 3)
+
+    async def scenario():
+        request = IdempotentRequest("key-4", "user", "chats/1", {"message": "Hi"})
+        assert await request.begin() is None
+        redis.ttls[request.lock_key] = 0
+        await request.refresh()
+        assert redis.ttls[request.lock_key] == 0  # refreshed at most once per third of the TTL
+        request.refresh_at = 0.0
+        await request.refresh()
+        assert redis.ttls[request.lock_key] == 3
+        await request.abandon()
+        await request.refresh()
+        assert request.lock_key not in redis.values
+
+    asyncio.run(scenario())
@@ -0,0 +1,17 @@
+from app.config import Config
+from app.models.chat import ChatMessage
+from app.models.world_chat import WorldChatMessage
+from app.services.message_history import page_limit
+
+def test_page_size_is_bounded():
+    assert page_limit(None) == Config.MESSAGE_PAGE_SIZE
+    assert page_limit(0) == 1
+    assert page_limit(10) == 10
+    assert page_limit(10 ** 6) == Config.MESSAGE_PAGE_MAX
+
+def test_history_pages_have_a_covering_index():
+    for model, chat_column in ((ChatMessage, "chat_id"), (WorldChatMessage, "world_chat_id")):
+        indexes = {index.name: index for index in model.__table__.indexes}
+        index = indexes[f"ix_{model.__tablename__}_history"]
+        columns = [getattr(expression, "element", expression) for expression in index.expressions]
+        assert [column.name for column in columns] == [chat_column, "created_at", "role", "id"]
@@ -0,0 +1,46 @@
+from types import SimpleNamespace
+from sqlalchemy.dialects import postgresql
+from app.services.purge import _steps, purge_batch, purge_stats
+
+class FakeSession:
+    """Returns the given row counts for the purge statements, in order"""
+
+    def __init__(self, *counts):
+        self.counts = list(counts)
+        self.executed = 0
+        self.commits = 0
+        self.rollbacks = 0
+
+    def execute(self, statement, execution_options=None):
+        self.executed += 1
+        return SimpleNamespace(rowcount=self.counts.pop(0) if self.counts else 0)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+def test_children_are_purged_before_their_parents():
+    tables = [table for table, _ in _steps(100)]
+    assert tables.index("chat_messages") < tables.index("chats")
+    assert tables.index("world_chats_marked") < tables.index("world_chat_messages") < tables.index("world_chats")
+    assert tables.index("world_chats") < tables.index("worlds")
+    assert tables.index("user_worlds") < tables.index("worlds")
+
+def test_every_batch_is_bounded_and_skips_locked_rows():
+    for table, statement in _steps(100):
+        sql = str(statement.compile(dialect=postgresql.dialect()))
+        assert "LIMIT" in sql and "FOR UPDATE" in sql and "SKIP LOCKED" in sql, table
+
+def test_one_batch_per_call_until_nothing_is_left():
+    before = purge_stats.rows.get("chat_messages", 0)
+    db = FakeSession(0, 250)
+    assert purge_batch(db, 250) is True
+    # Stops at the first step with work, in its own transaction
+    assert (db.executed, db.commits) == (2, 1)
+    assert purge_stats.rows["chat_messages"] == before + 250
+
+    idle = FakeSession()
+    assert purge_batch(idle, 250) is False
+    assert (idle.executed, idle.commits, idle.rollbacks) == (len(_steps(250)), 0, 1)
@@ -0,0 +1,157 @@
+import os
+import re
+import ast
+import uuid
+from pathlib import Path
+import pytest
+from app.models import Base
+
+# EXPLAIN for each hot-path query against seeded Postgres data, failing when
+# the planner falls back to a sequential scan of the table it reads. Needs a
+# scratch database: TEST_DATABASE_URL=postgresql://... (a throwaway schema is
+# created and dropped in it).
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+
+USERS = 1000
+
+SEED = [
+    "INSERT INTO roles (name, display_name) VALUES ('user', 'User')",
+    f"""INSERT INTO users (id, role_id, display_name)
+        SELECT gen_random_uuid(), (SELECT id FROM roles), 'User ' || n FROM generate_series(1, {USERS}) n""",
+    """INSERT INTO wallets (user_id, type, balance_tokens) SELECT id, 'personal'::wallettype, 100 FROM users
+       UNION ALL SELECT NULL, 'communal'::wallettype, 1000000""",
+    """INSERT INTO chats (id, user_id, title, updated_at)
+        SELECT gen_random_uuid(), u.id, 'Chat', now() - n * interval '1 hour' FROM users u, generate_series(1, 10) n""",
+    # Distinct words per message, with a rare phrase for the search to find and
+    # a common one that every user has
+    """INSERT INTO chat_messages (id, chat_id, user_id, role, content, created_at)
+        SELECT gen_random_uuid(), c.id, c.user_id, CASE WHEN n % 2 = 0 THEN 'user' ELSE 'assistant' END,
+               CASE WHEN random() < 0.001 THEN 'Литургия в воскресенье'
+                    WHEN n % 2 = 0 THEN 'Утренние молитвы ' || md5(random()::text)
+                    ELSE 'Сообщение ' || md5(random()::text) END,
+               now() - n * interval '1 minute'
+        FROM chats c, generate_series(1, 4) n""",
+    # A few chats deleted and waiting for the purge
+    "UPDATE chats SET deleted_at = now() WHERE id IN (SELECT id FROM chats LIMIT 100)",
+    "INSERT INTO worlds (name, assistant_id) SELECT 'World ' || n, 'asst_' || n FROM generate_series(1, 10) n",
+    """INSERT INTO world_chats (id, user_id, world_id, openai_thread_id, updated_at)
+        SELECT gen_random_uuid(), u.id, w.id, gen_random_uuid()::text, now() - n * interval '1 hour'
+        FROM users u, worlds w, generate_series(1, 2) n""",
+    """INSERT INTO world_chat_messages (id, world_chat_id, user_id, role, content, created_at)
+        SELECT gen_random_uuid(), c.id, c.user_id, CASE WHEN n % 2 = 0 THEN 'user' ELSE 'assistant' END, 'Message', now() - n * interval '1 minute'
+        FROM world_chats c, generate_series(1, 2) n""",
+    """INSERT INTO wallet_events (id, user_id, event_type, amount, description, created_at)
+        SELECT gen_random_uuid(), u.id, 'chat_expense', 1, 'Chat', now() - n * interval '1 hour'
+        FROM users u, generate_series(1, 20) n""",
+    """INSERT INTO transactions (wallet_from_id, amount_tokens, type, created_at)
+        SELECT w.id, 1, 'usage'::transactiontype, now() - n * interval '1 hour' FROM wallets w, generate_series(1, 20) n""",
+    """INSERT INTO usage_records (user_id, request_timestamp, prompt_tokens, completion_tokens, total_tokens)
+        SELECT u.id, now() - n * interval '1 hour', 10, 10, 20 FROM users u, generate_series(1, 20) n""",
+]
+
+# (relation, query) as the API runs them; :user_id, :chat_id, :world_id,
+# :world_chat_id are filled from the seeded rows
+HOT_QUERIES = {
+    "personal_wallet": ("wallets", "SELECT * FROM wallets WHERE user_id = :user_id AND type = 'personal'"),
+    "chat_list": ("chats", "SELECT * FROM chats WHERE user_id = :user_id AND deleted_at IS NULL ORDER BY updated_at DESC, id DESC LIMIT 50"),
+    "chat_history": ("chat_messages", """SELECT * FROM chat_messages WHERE chat_id = :chat_id
+        ORDER BY created_at DESC, role, id DESC LIMIT 51"""),
+    "world_chat_list": ("world_chats", """SELECT * FROM world_chats WHERE user_id = :user_id AND world_id = :world_id
+        AND deleted_at IS NULL ORDER BY updated_at DESC, id DESC LIMIT 50"""),
+    "world_chat_history": ("world_chat_messages", """SELECT * FROM world_chat_messages WHERE world_chat_id = :world_chat_id
+        ORDER BY created_at DESC, role, id DESC LIMIT 51"""),
+    "wallet_events": ("wallet_events", "SELECT * FROM wallet_events WHERE user_id = :user_id ORDER BY created_at DESC LIMIT 50"),
+    "purge_chat_messages": ("chat_messages", """SELECT m.id FROM chat_messages m JOIN chats c ON c.id = m.chat_id
+        WHERE c.deleted_at IS NOT NULL LIMIT 1000 FOR UPDATE OF m SKIP LOCKED"""),
+    "message_search": ("chat_messages", """SELECT m.id FROM chat_messages m JOIN chats c ON c.id = m.chat_id
+        WHERE m.user_id = :user_id AND m.search_vector @@ websearch_to_tsquery('ru_en', 'литургии')
+        AND c.deleted_at IS NULL"""),
+    "message_search_common_term": ("chat_messages", """SELECT m.id FROM chat_messages m JOIN chats c ON c.id = m.chat_id
+        WHERE m.user_id = :user_id AND m.search_vector @@ websearch_to_tsquery('ru_en', 'молитва')
+        AND c.deleted_at IS NULL"""),
+    "admin_transactions": ("transactions", "SELECT * FROM transactions ORDER BY created_at DESC LIMIT 50"),
+    "daily_usage": ("usage_records", """SELECT sum(total_tokens) FROM usage_records
+        WHERE user_id = :user_id AND request_timestamp >= now() - interval '1 day'"""),
+}
+
+def seq_scans(plan: dict) -> list:
+    """Relations read by a Seq Scan anywhere in an EXPLAIN (FORMAT JSON) plan"""
+    found = [plan["Relation Name"]] if plan["Node Type"] == "Seq Scan" else []
+    for child in plan.get("Plans", []):
+        found += seq_scans(child)
+    return found
+
+@pytest.fixture(scope="module")
+def seeded():
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL is not set")
+    from sqlalchemy import create_engine, text
+
+    schema = f"plan_test_{uuid.uuid4().hex[:8]}"
+    engine = create_engine(TEST_DATABASE_URL, connect_args={"options": f"-csearch_path={schema}"})
+    with engine.begin() as conn:
+        conn.execute(text(f"CREATE SCHEMA {schema}"))
+    try:
+        Base.metadata.create_all(engine)
+        with engine.begin() as conn:
+            for statement in SEED:
+                conn.execute(text(statement))
+        with engine.connect() as conn:
+            conn.execute(text("ANALYZE"))
+            params = conn.execute(text("""
+                SELECT c.user_id, c.world_id, c.id AS world_chat_id,
+                       (SELECT id FROM chats WHERE user_id = c.user_id LIMIT 1) AS chat_id
+                FROM world_chats c LIMIT 1
+            """)).mappings().one()
+        yield engine, dict(params)
+    finally:
+        with engine.begin() as conn:
+            conn.execute(text(f"DROP SCHEMA {schema} CASCADE"))
+        engine.dispose()
+
+@pytest.mark.parametrize("name", sorted(HOT_QUERIES))
+def test_hot_query_uses_an_index(seeded, name):
+    from sqlalchemy import text
+    engine, params = seeded
+    relation, query = HOT_QUERIES[name]
+    with engine.connect() as conn:
+        plan = conn.execute(text(f"EXPLAIN (FORMAT JSON) {query}"), params).scalar()[0]["Plan"]
+    assert relation not in seq_scans(plan), f"{name} scans all of {relation}"
+
+def index_conditions(plan: dict) -> dict:
+    """Index Cond of every index scan in an EXPLAIN (FORMAT JSON) plan, by index name"""
+    found = {plan["Index Name"]: plan.get("Index Cond", "")} if "Index Name" in plan else {}
+    for child in plan.get("Plans", []):
+        found.update(index_conditions(child))
+    return found
+
+def test_common_term_search_reads_only_the_users_matches(seeded):
+    """A term in half of all messages is still looked up among one user's rows"""
+    from sqlalchemy import text
+    engine, params = seeded
+    _, query = HOT_QUERIES["message_search_common_term"]
+    with engine.connect() as conn:
+        matching = conn.execute(text(
+            "SELECT count(DISTINCT user_id) FROM chat_messages WHERE search_vector @@ websearch_to_tsquery('ru_en', 'молитва')"
+        )).scalar()
+        plan = conn.execute(text(f"EXPLAIN (FORMAT JSON) {query}"), params).scalar()[0]["Plan"]
+    assert matching > USERS // 2
+    conditions = index_conditions(plan)
+    assert "ix_chat_messages_user_search" in conditions
+    assert "user_id" in conditions["ix_chat_messages_user_search"]
+    # Estimated rows: one user's matches, not every user's
+    assert plan["Plan Rows"] < 100
+
+def test_migration_matches_the_model_indexes():
+    path = Path(__file__).parent.parent / "alembic" / "versions" / "007_add_hot_path_indexes.py"
+    source = path.read_text()
+    # The revision's own module needs alembic; only its INDEXES list is checked here
+    indexes = re.search(r"^INDEXES = (\[.*?\n\])", source, re.S | re.M).group(1)
+    declared = {
+        index.name: (table.name, ", ".join(column.name for column in index.columns))
+        for table in Base.metadata.tables.values()
+        for index in table.indexes
+    }
+    for name, table, columns in ast.literal_eval(indexes):
+        assert declared[name] == (table, columns)
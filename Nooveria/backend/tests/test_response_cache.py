@@ -0,0 +1,49 @@
+from app.services.response_cache import response_cache_key, is_cacheable, discounted_usage
+from app.services.wallet import usage_record_values
+
+def test_key_ignores_whitespace_differences():
+    a = [{"role": "system", "content": "You are a guide."}, {"role": "user", "content": "Hello  there\n"}]
+    b = [{"role": "system", "content": " You are a guide."}, {"role": "user", "content": "Hello there"}]
+    
+    assert response_cache_key("gpt-3.5-turbo", a) == response_cache_key("gpt-3.5-turbo", b)
+    assert response_cache_key("gpt-3.5-turbo", a) != response_cache_key("gpt-4", a)
+    assert response_cache_key("gpt-3.5-turbo", a) != response_cache_key("gpt-3.5-turbo", a, {"temperature": 0})
+
+def test_only_first_turns_are_cacheable():
+    assert is_cacheable([{"role": "system", "content": "x"}, {"role": "user", "content": "Hi"}])
+    assert not is_cacheable([
+        {"role": "user", "content": "Hi"},
+        {"role": "assistant", "content": "Hello"},
+        {"role": "user", "content": "How are you?"}
+    ])
+
+def test_hits_are_billed_at_a_discount_and_recorded():
+    usage = discounted_usage({"prompt_tokens": 11, "completion_tokens": 30, "total_tokens": 41})
+    
+    assert usage["total_tokens"] < 41
+    assert usage["total_tokens"] == usage["prompt_tokens"] + usage["completion_tokens"]
+    meta = usage_record_values("user", usage)["openai_response_meta"]
+    assert meta["cache_hit"] is True
+    assert meta["upstream_total_tokens"] == 41
+
+def test_concurrent_identical_loads_share_one_call():
+    import asyncio
+    from app.services.cache import single_flight, in_flight
+    
+    calls = []
+    
+    async def load():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "reply"
+    
+    async def burst():
+        first = asyncio.ensure_future(single_flight("response:k", load))
+        await asyncio.sleep(0)
+        assert in_flight("response:k")
+        results = await asyncio.gather(first, *(single_flight("response:k", load) for _ in range(4)))
+        assert not in_flight("response:k")
+        return results
+    
+    assert asyncio.run(burst()) == ["reply"] * 5
+    assert len(calls) == 1
@@ -0,0 +1,42 @@
+import pytest
+from sqlalchemy import select, literal, func
+from sqlalchemy.dialects import postgresql
+from app.config import Config
+from app.models.chat import ChatMessage
+from app.models.world_chat import WorldChatMessage
+from app.services.search import search_limit, search_terms, highlight, encode_cursor, decode_cursor, _matches, _START, _STOP
+
+def test_snippets_escape_content_and_mark_matches():
+    headline = f"<script>alert(1)</script> {_START}литургия{_STOP} в воскресенье"
+    assert highlight(headline) == "&lt;script&gt;alert(1)&lt;/script&gt; <mark>литургия</mark> в воскресенье"
+
+def test_query_and_page_size_are_bounded():
+    assert search_terms("  утренние\n молитвы ") == "утренние молитвы"
+    for q in ("", "   ", None, "x" * (Config.SEARCH_QUERY_MAX_LENGTH + 1)):
+        with pytest.raises(Exception, match="Invalid search query"):
+            search_terms(q)
+    assert search_limit(None) == Config.SEARCH_PAGE_SIZE
+    assert search_limit(0) == 1
+    assert search_limit(10 ** 6) == Config.SEARCH_PAGE_MAX
+
+def test_matching_goes_through_the_per_user_search_index():
+    for model in (ChatMessage, WorldChatMessage):
+        index = {index.name: index for index in model.__table__.indexes}[f"ix_{model.__tablename__}_user_search"]
+        assert index.dialect_options["postgresql"]["using"] == "gin"
+        assert [column.name for column in index.columns] == ["user_id", "search_vector"]
+
+    query = func.websearch_to_tsquery(literal("ru_en", postgresql.REGCONFIG), "литургия")
+    sql = str(select(_matches("user", query)).compile(dialect=postgresql.dialect()))
+    assert sql.count("search_vector @@ websearch_to_tsquery") == 2
+    assert sql.count("_messages.user_id = ") == 2
+    assert "LIKE" not in sql.upper()
+
+def test_cursor_carries_the_rank():
+    result = {"rank": 0.0607927, "created_at": "2026-10-16T12:00:00.123456+00:00", "id": "9b2f6a4e-6c1d-4a57-8f0e-3c2d1b0a9e8f"}
+    rank, created_at, message_id = decode_cursor(encode_cursor(result))
+    assert rank == result["rank"]
+    assert created_at.isoformat() == result["created_at"]
+    assert str(message_id) == result["id"]
+    for cursor in ("", "not-a-cursor", encode_cursor({"rank": "x", "created_at": "y", "id": "z"})):
+        with pytest.raises(Exception, match="Invalid cursor"):
+            decode_cursor(cursor)
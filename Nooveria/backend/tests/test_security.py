@@ -0,0 +1,67 @@
+import asyncio
+import pytest
+from redis.exceptions import ConnectionError as RedisConnectionError
+from app.middleware.rate_limit import RateLimiter
+from app.services.deadline import DeadlineExceeded
+from app.services.security import SecurityManager
+
+class FailingRedis:
+    """Client whose every command and pipeline raises the given error"""
+
+    def __init__(self, error):
+        self.error = error
+
+    def __getattr__(self, name):
+        async def command(*args, **kwargs):
+            raise self.error
+        return command
+
+    def pipeline(self, *args, **kwargs):
+        return FailingPipeline(self.error)
+
+class FailingPipeline:
+    def __init__(self, error):
+        self.error = error
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self
+
+    async def execute(self):
+        raise self.error
+
+def test_security_checks_fall_back_without_redis():
+    manager = SecurityManager(FailingRedis(RedisConnectionError("down")))
+
+    async def scenario():
+        assert await manager.check_rate_limit("1.2.3.4", "login") == (True, 0)
+        assert await manager.record_failed_login("a@b.c") == {"locked": False, "attempts": 0}
+        assert await manager.clear_failed_logins("a@b.c") is None
+        assert await manager.is_account_locked("a@b.c") == (False, None)
+        assert await manager.failed_login_count("a@b.c") == 0
+
+    asyncio.run(scenario())
+
+def test_rate_limiter_falls_back_to_memory_without_redis():
+    limiter = RateLimiter(FailingRedis(RedisConnectionError("down")))
+
+    async def scenario():
+        assert await limiter.check_rate_limit("k", limit=1, window=60)
+        assert not await limiter.check_rate_limit("k", limit=1, window=60)
+
+    asyncio.run(scenario())
+
+def test_rate_limiter_lets_deadline_and_cancellation_through():
+    async def scenario(error):
+        limiter = RateLimiter(FailingRedis(error))
+        with pytest.raises(type(error)):
+            await limiter.check_rate_limit("k", limit=1, window=60)
+        assert limiter.fallback_store == {}
+
+    asyncio.run(scenario(DeadlineExceeded("redis")))
+    asyncio.run(scenario(asyncio.CancelledError()))
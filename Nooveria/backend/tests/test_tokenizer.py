@@ -0,0 +1,22 @@
+from app.services.tokenizer import TokenCounter, TOKENS_PER_MESSAGE, TOKENS_PER_REPLY
+
+def test_batch_counts_match_single_counts():
+    counter = TokenCounter()
+    texts = ["Hello, world!", "Привет, мир!", "", "Hello, world!"]
+    
+    assert counter.count_batch(texts) == [TokenCounter().count(text) for text in texts]
+
+def test_counts_are_memoised():
+    counter = TokenCounter(cache_size=2)
+    counter.count("first")
+    counter.count("second")
+    counter.count("third")  # evicts "first"
+    
+    assert list(counter._cache) == ["second", "third"]
+
+def test_message_count_includes_chat_format_overhead():
+    counter = TokenCounter()
+    messages = [{"role": "user", "content": "Hi"}, {"role": "assistant", "content": "Hello"}]
+    
+    content_tokens = counter.count("Hi") + counter.count("Hello")
+    assert counter.count_messages(messages) == content_tokens + 2 * TOKENS_PER_MESSAGE + TOKENS_PER_REPLY
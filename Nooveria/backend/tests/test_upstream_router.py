@@ -0,0 +1,152 @@
+import json
+import time
+import asyncio
+import httpx
+from openai import AsyncOpenAI
+from app.config import Config
+from app.services.upstream_router import UpstreamRouter, UpstreamEndpoint
+
+# Local fake upstreams speaking just enough of the chat completions API.
+# behaviour(request_number) returns (status, delay, headers) for each request.
+
+COMPLETION = {
+    "id": "fake-1",
+    "object": "chat.completion",
+    "created": 0,
+    "model": "fake-model",
+    "choices": [{"index": 0, "message": {"role": "assistant", "content": "hi"}, "finish_reason": "stop"}],
+    "usage": {"prompt_tokens": 5, "completion_tokens": 1, "total_tokens": 6}
+}
+
+class FakeUpstream:
+    def __init__(self, behaviour):
+        self.behaviour = behaviour
+        self.requests = 0
+        self.server = None
+
+    async def __aenter__(self):
+        self.server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        return self
+
+    async def __aexit__(self, *exc):
+        self.server.close()
+        await self.server.wait_closed()
+
+    @property
+    def base_url(self) -> str:
+        return "http://127.0.0.1:%d/v1" % self.server.sockets[0].getsockname()[1]
+
+    async def _handle(self, reader, writer):
+        head = await reader.readuntil(b"\r\n\r\n")
+        length = 0
+        for line in head.decode().split("\r\n"):
+            if line.lower().startswith("content-length:"):
+                length = int(line.split(":", 1)[1])
+        await reader.readexactly(length)
+
+        self.requests += 1
+        status, delay, headers = self.behaviour(self.requests)
+        await asyncio.sleep(delay)
+        body = json.dumps(COMPLETION if status == 200 else {"error": {"message": "injected", "type": "fake"}}).encode()
+        extra = "".join(f"{name}: {value}\r\n" for name, value in headers.items())
+        writer.write(
+            f"HTTP/1.1 {status} X\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+            f"Connection: close\r\n{extra}\r\n".encode() + body
+        )
+        await writer.drain()
+        writer.close()
+
+def ok(delay=0.0):
+    return lambda n: (200, delay, {})
+
+def _router(http_client, *upstreams) -> UpstreamRouter:
+    return UpstreamRouter([
+        UpstreamEndpoint(f"fake-{i}", AsyncOpenAI(api_key="test", base_url=upstream.base_url, http_client=http_client, max_retries=0))
+        for i, upstream in enumerate(upstreams)
+    ])
+
+def _complete(client):
+    return client.chat.completions.create(model="fake-model", messages=[{"role": "user", "content": "hi"}])
+
+def test_failing_endpoint_opens_breaker_and_traffic_moves_on(monkeypatch):
+    monkeypatch.setattr(Config, "UPSTREAM_BREAKER_THRESHOLD", 2)
+
+    async def scenario():
+        async with FakeUpstream(lambda n: (500, 0.0, {})) as broken, FakeUpstream(ok(0.01)) as healthy:
+            async with httpx.AsyncClient() as http_client:
+                router = _router(http_client, broken, healthy)
+                for _ in range(8):
+                    response = await router.call(_complete)
+                    assert response.choices[0].message.content == "hi"
+                return broken.requests, router.stats()
+
+    broken_requests, stats = asyncio.run(scenario())
+    assert broken_requests == 2
+    assert stats[0]["state"] == "open"
+    assert stats[1]["state"] == "closed"
+
+def test_retry_after_is_obeyed():
+    async def scenario():
+        # Throttled once, then fine
+        behaviour = lambda n: (429, 0.0, {"Retry-After": "0.3"}) if n == 1 else (200, 0.0, {})
+        async with FakeUpstream(behaviour) as upstream:
+            async with httpx.AsyncClient() as http_client:
+                router = _router(http_client, upstream)
+                started = time.monotonic()
+                await router.call(_complete)
+                return time.monotonic() - started, upstream.requests
+
+    elapsed, requests = asyncio.run(scenario())
+    assert requests == 2
+    assert elapsed >= 0.3
+
+def test_client_errors_are_not_retried():
+    async def scenario():
+        async with FakeUpstream(lambda n: (400, 0.0, {})) as upstream, FakeUpstream(ok()) as other:
+            async with httpx.AsyncClient() as http_client:
+                router = _router(http_client, upstream, other)
+                router.endpoints[1].latency = 1.0  # the bad one is tried first
+                try:
+                    await router.call(_complete)
+                except Exception as e:
+                    return getattr(e, "status_code", None), other.requests
+
+    status, other_requests = asyncio.run(scenario())
+    assert status == 400
+    assert other_requests == 0
+
+def test_traffic_prefers_the_faster_endpoint():
+    async def scenario():
+        async with FakeUpstream(ok(0.15)) as slow, FakeUpstream(ok(0.0)) as fast:
+            async with httpx.AsyncClient() as http_client:
+                router = _router(http_client, slow, fast)
+                for _ in range(10):
+                    await router.call(_complete)
+                return slow.requests, fast.requests
+
+    slow_requests, fast_requests = asyncio.run(scenario())
+    assert fast_requests > slow_requests
+
+def test_slow_call_is_hedged_and_the_loser_cancelled(monkeypatch):
+    monkeypatch.setattr(Config, "UPSTREAM_HEDGING", True)
+    monkeypatch.setattr(Config, "UPSTREAM_HEDGE_MIN_SAMPLES", 3)
+    monkeypatch.setattr(Config, "UPSTREAM_HEDGE_MIN_DELAY", 0.05)
+
+    async def scenario():
+        async with FakeUpstream(ok(2.0)) as stalled, FakeUpstream(ok(0.0)) as fast:
+            async with httpx.AsyncClient() as http_client:
+                router = _router(http_client, stalled, fast)
+                router.endpoints[0].latency = 0.001  # first choice
+                router.endpoints[1].latency = 0.005
+                for _ in range(3):
+                    router._record_latency("completion", 0.05)
+                started = time.monotonic()
+                response = await router.hedged_call(_complete)
+                return time.monotonic() - started, response, router.hedge_stats(), [endpoint.inflight for endpoint in router.endpoints]
+
+    elapsed, response, stats, inflight = asyncio.run(scenario())
+    assert response.usage.total_tokens == 6  # one attempt's usage, billed once
+    assert elapsed < 1.0
+    assert stats["hedges"] == 1
+    assert stats["hedge_wins"] == 1
+    assert inflight == [0, 0]
@@ -1,17 +1,41 @@
+import os
+import uuid
 import pytest
 from decimal import Decimal
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker
-from app.models import Base, User, Role, Wallet, WalletType
-from app.services.wallet import charge_tokens, get_user_wallets
+from app.models import Base, User, Role, Wallet, WalletType, WalletHold, HoldStatus, LedgerCommit, Transaction, TransactionType, UsageRecord, WalletEvent
+from app.services.wallet import charge_tokens, get_user_wallets, reserve_tokens, settle_hold, release_hold, expire_holds, usage_record_values
+from app.services.wallet_events import chat_expense_event_values
+from app.services.ledger import LedgerWriter
+from app.services.communal_wallet import ensure_communal_stripes, rebalance_communal_stripes, stripe_for_user
 
-# Test database setup - use in-memory database
-SQLALCHEMY_DATABASE_URL = "sqlite:///:memory:"
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
-TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# The wallet runs on Postgres features (UUID columns, UPDATE ... RETURNING,
+# advisory locks), so these tests need a scratch database:
+# TEST_DATABASE_URL=postgresql://... (a throwaway schema is created and dropped in it).
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False)
+
+@pytest.fixture(scope="module")
+def engine():
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL is not set")
+
+    schema = f"wallet_test_{uuid.uuid4().hex[:8]}"
+    engine = create_engine(TEST_DATABASE_URL, connect_args={"options": f"-csearch_path={schema}"})
+    with engine.begin() as conn:
+        conn.execute(text(f"CREATE SCHEMA {schema}"))
+    TestingSessionLocal.configure(bind=engine)
+    try:
+        yield engine
+    finally:
+        with engine.begin() as conn:
+            conn.execute(text(f"DROP SCHEMA {schema} CASCADE"))
+        engine.dispose()
 
 @pytest.fixture
-def db_session():
+def db_session(engine):
     Base.metadata.create_all(bind=engine)
     db = TestingSessionLocal()
     try:
@@ -99,4 +123,282 @@ def test_atomic_transaction_rollback(db_session, test_user):
     
     # Balance should remain unchanged
     final_balance = get_user_wallets(db_session, str(test_user.id))["personal"]["balance"]
-    assert initial_balance == final_balance
\ No newline at end of file
+    assert initial_balance == final_balance
+
+def test_personal_charge_leaves_communal_wallet_untouched(db_session, test_user):
+    """Test that a personal charge never updates the communal wallet row"""
+    result = charge_tokens(db_session, str(test_user.id), 300, prefer_communal=True)
+    
+    assert result["charged_from"] == "personal"
+    assert result["balance"] == 700.0
+    
+    communal_wallet = db_session.query(Wallet).filter(Wallet.type == WalletType.communal).first()
+    assert communal_wallet.balance_tokens == Decimal("10000")
+
+
+def test_communal_stripes_preserve_total_balance(db_session, test_user):
+    """Test that splitting the communal wallet keeps one total balance"""
+    ensure_communal_stripes(db_session, stripe_count=4)
+    
+    stripes = db_session.query(Wallet).filter(Wallet.type == WalletType.communal).all()
+    assert len(stripes) == 4
+    assert sum(stripe.balance_tokens for stripe in stripes) == Decimal("10000")
+    assert get_user_wallets(db_session, str(test_user.id))["communal"]["balance"] == 10000.0
+
+def test_communal_charge_borrows_from_neighbour_stripe(db_session, test_user):
+    """Test that a dry home stripe falls back to the next stripe"""
+    ensure_communal_stripes(db_session, stripe_count=4)
+    stripes = db_session.query(Wallet).filter(Wallet.type == WalletType.communal).order_by(Wallet.id).all()
+    home = stripes[stripe_for_user(str(test_user.id), len(stripes))]
+    home.balance_tokens = Decimal("0")
+    db_session.commit()
+    
+    result = charge_tokens(db_session, str(test_user.id), 1500, prefer_communal=True)
+    db_session.commit()
+    
+    assert result["charged_from"] == "communal"
+    db_session.refresh(home)
+    assert home.balance_tokens == Decimal("0")
+    
+    # Rebalancer evens the dry stripe out again
+    assert rebalance_communal_stripes(db_session)
+    db_session.refresh(home)
+    assert home.balance_tokens > 0
+
+def test_communal_charge_larger_than_any_stripe_is_split(db_session, test_user):
+    """Test that a charge covered only by the pool's total is taken across stripes"""
+    ensure_communal_stripes(db_session, stripe_count=4)
+
+    result = charge_tokens(db_session, str(test_user.id), 4000, prefer_communal=True)
+    db_session.commit()
+
+    assert result["charged_from"] == "communal"
+    assert get_user_wallets(db_session, str(test_user.id))["communal"]["balance"] == 6000.0
+    with pytest.raises(Exception, match="Insufficient funds"):
+        charge_tokens(db_session, str(test_user.id), 7000, prefer_communal=True)
+
+    # One transaction per stripe, each for what was taken from it
+    stripes = {stripe.id: stripe.balance_tokens for stripe in db_session.query(Wallet).filter(Wallet.type == WalletType.communal)}
+    transactions = db_session.query(Transaction).filter(Transaction.type == TransactionType.communal_withdraw).all()
+    assert len(transactions) == 2
+    assert sum(t.amount_tokens for t in transactions) == Decimal("4000")
+    for t in transactions:
+        assert stripes[t.wallet_from_id] == Decimal("2500") - t.amount_tokens
+
+def test_split_communal_hold_goes_back_to_each_stripe(db_session, test_user):
+    """Test that releasing or settling a hold taken from several stripes refunds each of them"""
+    ensure_communal_stripes(db_session, stripe_count=4)
+    db_session.query(Wallet).filter(Wallet.type == WalletType.personal).update({"balance_tokens": 0})
+    db_session.commit()
+
+    def balances():
+        return {stripe.id: stripe.balance_tokens for stripe in db_session.query(Wallet).filter(Wallet.type == WalletType.communal)}
+
+    before = balances()
+    hold = reserve_tokens(db_session, str(test_user.id), 4000, prefer_communal=True)
+    db_session.commit()
+    assert hold["source"] == "communal"
+    assert len(db_session.query(WalletHold).one().parts) == 2
+
+    release_hold(db_session, hold["hold_id"])
+    db_session.commit()
+    db_session.expire_all()
+    assert balances() == before
+
+    hold = reserve_tokens(db_session, str(test_user.id), 4000, prefer_communal=True)
+    result = settle_hold(db_session, hold["hold_id"], 3000)
+    db_session.commit()
+    db_session.expire_all()
+    assert result["amount"] == 3000.0
+    assert sum(balances().values()) == Decimal("7000")
+    transactions = db_session.query(Transaction).filter(Transaction.type == TransactionType.communal_withdraw).all()
+    for t in transactions:
+        assert before[t.wallet_from_id] - balances()[t.wallet_from_id] == t.amount_tokens
+
+
+def test_reserve_then_settle_releases_surplus(db_session, test_user):
+    """Test that settling a hold charges actual usage and returns the rest"""
+    hold = reserve_tokens(db_session, str(test_user.id), 600)
+    db_session.commit()
+    assert get_user_wallets(db_session, str(test_user.id))["personal"]["balance"] == 400.0
+    
+    result = settle_hold(db_session, hold["hold_id"], 150)
+    db_session.commit()
+    
+    assert result["charged_from"] == "personal"
+    assert result["amount"] == 150.0
+    assert get_user_wallets(db_session, str(test_user.id))["personal"]["balance"] == 850.0
+
+def test_balance_version_increases_with_every_update(db_session, test_user):
+    first = charge_tokens(db_session, str(test_user.id), 100)
+    hold = reserve_tokens(db_session, str(test_user.id), 200)
+    settled = settle_hold(db_session, hold["hold_id"], 50)
+    db_session.commit()
+    
+    assert first["version"] < hold["version"] < settled["version"]
+    assert settled["balance"] == 850.0
+
+def test_reserve_is_capped_by_role_max_request_tokens(db_session, test_user):
+    """Test that a hold never exceeds the role's max_request_tokens"""
+    test_user.role.max_request_tokens = 200
+    db_session.commit()
+    
+    hold = reserve_tokens(db_session, str(test_user.id), 5000)
+    assert hold["amount"] == 200.0
+
+def test_oversized_request_is_rejected_before_reserving(db_session, test_user):
+    with pytest.raises(Exception, match="Request too large"):
+        reserve_tokens(db_session, str(test_user.id), 5000, reject_oversized=True)
+    
+    assert db_session.query(WalletHold).count() == 0
+    assert get_user_wallets(db_session, str(test_user.id))["personal"]["balance"] == 1000.0
+
+def test_expired_holds_are_released(db_session, test_user):
+    """Test that holds left behind by crashed requests give tokens back"""
+    reserve_tokens(db_session, str(test_user.id), 600, ttl=-1)
+    db_session.commit()
+    
+    assert expire_holds(db_session) == [str(test_user.id)]
+    assert db_session.query(WalletHold).first().status == HoldStatus.expired
+    assert get_user_wallets(db_session, str(test_user.id))["personal"]["balance"] == 1000.0
+
+def test_retried_settle_charges_once(db_session, test_user):
+    """Test that settling a closed hold again never charges a second time"""
+    settled = reserve_tokens(db_session, str(test_user.id), 200)
+    expired = reserve_tokens(db_session, str(test_user.id), 200, ttl=-1)
+    db_session.commit()
+    expire_holds(db_session)
+
+    settle_hold(db_session, settled["hold_id"], 100)
+    settle_hold(db_session, expired["hold_id"], 100)
+    db_session.commit()
+    assert get_user_wallets(db_session, str(test_user.id))["personal"]["balance"] == 800.0
+
+    for hold in (settled, expired):
+        with pytest.raises(Exception, match="Hold already closed"):
+            settle_hold(db_session, hold["hold_id"], 100)
+    assert get_user_wallets(db_session, str(test_user.id))["personal"]["balance"] == 800.0
+
+
+@pytest.fixture
+def ledger_writer(tmp_path, monkeypatch):
+    """A running write-behind ledger in tmp_path (its flush loop is not started)"""
+    from app.services import ledger
+
+    writer = LedgerWriter(wal_dir=str(tmp_path), session_factory=TestingSessionLocal)
+    writer.open_wal()
+    writer.running = True
+    monkeypatch.setattr(ledger, "ledger_writer", writer)
+    return writer
+
+def _charge_with_ledger(db_session, user, events=True):
+    from app.services.ledger import record_charge
+
+    result = charge_tokens(db_session, str(user.id), 100, defer_transaction=True)
+    record_charge(
+        db_session,
+        result["transaction"],
+        usage_record_values(str(user.id), {"prompt_tokens": 60, "completion_tokens": 40, "total_tokens": 100}),
+        [chat_expense_event_values(str(user.id), 100)] if events else []
+    )
+
+def test_ledger_replays_wal_after_crash(db_session, test_user, tmp_path, ledger_writer):
+    """Test that ledger rows queued before a crash are written exactly once on restart"""
+    _charge_with_ledger(db_session, test_user)
+    db_session.commit()
+    # Crash: the process dies before the flush loop runs
+    ledger_writer._wal.close()
+    assert db_session.query(Transaction).count() == 0
+    
+    restarted = LedgerWriter(wal_dir=str(tmp_path), session_factory=TestingSessionLocal)
+    restarted.open_wal()
+    assert restarted.flush() == 1
+    assert restarted.flush() == 0
+    
+    assert db_session.query(Transaction).count() == 1
+    assert db_session.query(UsageRecord).one().transaction_id == db_session.query(Transaction).one().id
+    assert db_session.query(WalletEvent).count() == 1
+    assert db_session.query(LedgerCommit).count() == 0
+
+
+def test_ledger_replay_skips_written_entries(db_session, test_user, tmp_path, ledger_writer):
+    """Test that an entry already written is not written again, events or not"""
+    import json
+    _charge_with_ledger(db_session, test_user, events=False)
+    db_session.commit()
+    entry = ledger_writer._buffer[0]
+    assert ledger_writer.flush() == 1
+    # Crash after the flush committed, before the WAL was rewritten
+    (tmp_path / "ledger-0-crashed.wal").write_text(json.dumps(entry) + "\n")
+
+    restarted = LedgerWriter(wal_dir=str(tmp_path), session_factory=TestingSessionLocal)
+    restarted.open_wal()
+    assert restarted.flush() == 1
+    assert db_session.query(Transaction).count() == 1
+
+
+def test_rolled_back_charge_is_never_written(db_session, test_user, tmp_path, ledger_writer):
+    """Test that a charge reaches the ledger only if its session commits, even across a crash"""
+    _charge_with_ledger(db_session, test_user)
+    db_session.rollback()
+    assert ledger_writer.flush() == 1  # dropped: no commit marker
+    assert db_session.query(Transaction).count() == 0
+
+    _charge_with_ledger(db_session, test_user)
+    assert ledger_writer.flush() == 0  # still in its transaction
+    db_session.rollback()
+    ledger_writer._wal.close()
+
+    restarted = LedgerWriter(wal_dir=str(tmp_path), session_factory=TestingSessionLocal)
+    restarted.open_wal()
+    assert restarted.flush() == 1
+    assert db_session.query(Transaction).count() == 0
+
+
+def test_near_cache_evicts_least_recently_used_and_expired():
+    from app.services.cache import NearCache
+    
+    cache = NearCache(max_size=2, ttl=60)
+    cache.set("a", "1")
+    cache.set("b", "2")
+    assert cache.get("a") == "1"
+    cache.set("c", "3")  # evicts "b", the least recently used
+    assert cache.get("b") is None
+    
+    cache.set("d", "4", ttl=-1)
+    assert cache.get("d") is None
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 2
+
+def test_push_hub_marks_full_subscribers_lagging():
+    from app.config import Config
+    from app.services.wallet_push import WalletPushHub
+    
+    hub = WalletPushHub()
+    subscriber = hub.subscribe("user-1")
+    for n in range(Config.WALLET_PUSH_QUEUE_SIZE + 1):
+        hub.dispatch({"user_id": "user-1", "id": f"{n}-0", "event": "balance_changed", "data": "{}"})
+    hub.dispatch({"user_id": "user-2", "id": "1-0", "event": "balance_changed", "data": "{}"})
+    
+    assert subscriber.lagging
+    assert subscriber.queue.qsize() == Config.WALLET_PUSH_QUEUE_SIZE
+    hub.unsubscribe("user-1", subscriber)
+    assert hub.stats() == {"users": 0, "connections": 0}
+
+def test_wallet_event_push_carries_the_event_id(monkeypatch):
+    """Test that a pushed wallet_event names the WalletEvent row the ledger writes"""
+    import asyncio
+    from app.services import wallet_push
+    from app.services.ledger import _serialize_entry
+    
+    published = []
+    async def publish(user_id, event, data):
+        published.append((event, data))
+    monkeypatch.setattr(wallet_push, "publish_wallet_update", publish)
+    
+    events = [chat_expense_event_values(str(uuid.uuid4()), 100)]
+    asyncio.run(wallet_push.publish_balance_change("user-1", {"charged_from": "personal", "balance": 900.0}, events))
+    entry = _serialize_entry({"wallet_from_id": 1, "amount_tokens": 100, "type": TransactionType.usage, "meta": None}, None, events)
+    
+    assert published[1][0] == "wallet_event"
+    assert published[1][1]["id"] == entry["events"][0]["id"] == str(events[0]["id"])
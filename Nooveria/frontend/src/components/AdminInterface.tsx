@@ -19,6 +19,7 @@ export function AdminInterface({ user }: AdminInterfaceProps) {
   const [loading, setLoading] = useState(true);
   const [error, setError] = useState<string | null>(null);
   const [worlds, setWorlds] = useState<any[]>([]);
+  const [purge, setPurge] = useState<any>(null);
   const [newWorld, setNewWorld] = useState({ name: '', description: '', assistant_id: '', image_url: '' });
   const [isCreatingWorld, setIsCreatingWorld] = useState(false);
 
@@ -41,6 +42,13 @@ export function AdminInterface({ user }: AdminInterfaceProps) {
           setWorlds([]);
         }
         
+        // Deleted chats and worlds still being removed in the background
+        try {
+          setPurge(await apiService.getPurgeProgress());
+        } catch (error) {
+          console.error('Failed to load purge progress:', error);
+        }
+        
         setStats(statsData);
         setUsers(usersData);
         setTransactions(transactionsData);
@@ -428,6 +436,15 @@ export function AdminInterface({ user }: AdminInterfaceProps) {
                       <Badge className="bg-green-500/20 text-green-400 border-green-500/30">Подключена</Badge>
                       <p className="text-sm text-secondary mt-2">PostgreSQL 15.0</p>
                     </div>
+                    <div className="p-4 border border-accent/30 rounded-lg">
+                      <h3 className="font-medium text-primary-heading mb-2">Очистка удалённых данных</h3>
+                      <p className="text-sm text-primary">
+                        Ожидают удаления: чатов {purge?.pending?.chats ?? 0}, чатов миров {purge?.pending?.world_chats ?? 0}, миров {purge?.pending?.worlds ?? 0}
+                      </p>
+                      <p className="text-sm text-secondary mt-2">
+                        Пакетов выполнено: {purge?.batches ?? 0}{purge?.last_batch_at ? `, последний: ${new Date(purge.last_batch_at + 'Z').toLocaleString()}` : ''}
+                      </p>
+                    </div>
                   </div>
                   <div className="flex gap-2">
                     <Button className="btn-outline">Перезапустить сервис</Button>
@@ -18,6 +18,9 @@ interface Chat {
   id: string;
   title: string;
   messages: Message[];
+  // History is loaded a page at a time; next_before fetches the page before the oldest loaded
+  has_more?: boolean;
+  next_before?: string | null;
 }
 
 interface ChatInterfaceProps {
@@ -35,6 +38,8 @@ export function ChatInterface({ user, selectedChatId, selectedWorldId, onChatCre
   const [currentWorld, setCurrentWorld] = useState<any>(null);
   const [isLoading, setIsLoading] = useState(false);
   const [isLoadingChat, setIsLoadingChat] = useState(false);
+  const [isLoadingEarlier, setIsLoadingEarlier] = useState(false);
+  const prependingRef = useRef(false);
   const messagesEndRef = useRef<HTMLDivElement>(null);
   const inputRef = useRef<HTMLInputElement>(null);
   const isMobile = useIsMobile();
@@ -116,7 +121,9 @@ export function ChatInterface({ user, selectedChatId, selectedWorldId, onChatCre
         setCurrentChat({
           id: chatData.id,
           title: chatData.title,
-          messages: chatData.messages
+          messages: chatData.messages,
+          has_more: chatData.has_more,
+          next_before: chatData.next_before
         });
         chatIdRef.current = chatData.id;
       } catch (error) {
@@ -162,7 +169,8 @@ export function ChatInterface({ user, selectedChatId, selectedWorldId, onChatCre
   const loadOrCreateChat = async () => {
     try {
       setIsLoadingChat(true);
-      const chats = await apiService.getChats();
+      // Only the most recently active chat is needed
+      const chats = await apiService.getChats(1);
       if (chats.length > 0 && !selectedChatId) {
         // Load the most recent chat if no specific chat is selected
         const latestChat = await apiService.getChat(chats[0].id);
@@ -199,12 +207,39 @@ export function ChatInterface({ user, selectedChatId, selectedWorldId, onChatCre
     }
   }, [selectedWorldId]);
 
-  // Safe scroll effect
+  // Safe scroll effect (not when older messages were prepended)
   useEffect(() => {
+    if (prependingRef.current) {
+      prependingRef.current = false;
+      return;
+    }
     const timer = setTimeout(scrollToBottom, 100);
     return () => clearTimeout(timer);
   }, [currentChat?.messages?.length]);
 
+  // Load the page of history before the oldest loaded message
+  const loadEarlierMessages = async () => {
+    if (!currentChat?.has_more || !currentChat.next_before || isLoadingEarlier) return;
+    const chatId = currentChat.id;
+    try {
+      setIsLoadingEarlier(true);
+      const page = currentWorld && selectedWorldId
+        ? await apiService.getWorldChat(selectedWorldId, currentChat.next_before)
+        : await apiService.getChat(chatId, currentChat.next_before);
+      prependingRef.current = true;
+      setCurrentChat(prev => prev && prev.id === chatId ? {
+        ...prev,
+        messages: [...page.messages, ...prev.messages],
+        has_more: page.has_more,
+        next_before: page.next_before
+      } : prev);
+    } catch (error) {
+      console.error('Failed to load earlier messages:', error);
+    } finally {
+      setIsLoadingEarlier(false);
+    }
+  };
+
   const sendMessage = async (userMessage: string) => {
     setIsLoading(true);
     
@@ -271,13 +306,40 @@ export function ChatInterface({ user, selectedChatId, selectedWorldId, onChatCre
           }
         }
         
-        // Send message to chat
-        const response = await apiService.sendChatMessageToChat(chatId, userMessage, useSharedTokens, selectedWorldId || undefined);
+        // Stream the reply into a placeholder message as tokens arrive
+        const assistantId = (Date.now() + 1).toString();
+        setCurrentChat(prev => prev ? {
+          ...prev,
+          messages: [...prev.messages, {
+            id: assistantId,
+            role: 'assistant',
+            content: '',
+            created_at: new Date().toISOString()
+          }]
+        } : null);
+        
+        const response = await apiService.streamChatMessageToChat(chatId, userMessage, (token) => {
+          setCurrentChat(prev => prev ? {
+            ...prev,
+            messages: prev.messages.map(msg =>
+              msg.id === assistantId ? { ...msg, content: msg.content + token } : msg
+            )
+          } : null);
+        }, useSharedTokens);
         console.log('API Response:', response);
         
-        // Reload the chat to get updated messages
+        // Reload the newest page to get the stored messages and title, keeping older pages already loaded
         const updatedChat = await apiService.getChat(chatId);
-        setCurrentChat(updatedChat);
+        setCurrentChat(prev => {
+          const overlap = prev ? prev.messages.findIndex(msg => msg.id === updatedChat.messages[0]?.id) : -1;
+          if (!prev || overlap <= 0) return updatedChat;
+          return {
+            ...updatedChat,
+            messages: [...prev.messages.slice(0, overlap), ...updatedChat.messages],
+            has_more: prev.has_more,
+            next_before: prev.next_before
+          };
+        });
         
         // Update wallet balance after spending tokens
         if (response.wallet_updated) {
@@ -519,6 +581,19 @@ export function ChatInterface({ user, selectedChatId, selectedWorldId, onChatCre
       <div className="flex-1 overflow-hidden">
         <ScrollArea className="h-full">
           <div className={`${isMobile ? 'max-w-full mx-auto p-4' : 'max-w-4xl mx-auto p-6'} space-y-6 pb-6`}>
+            {currentChat?.has_more && (
+              <div className="flex justify-center">
+                <button
+                  onClick={loadEarlierMessages}
+                  disabled={isLoadingEarlier}
+                  className="text-xs px-3 py-1 text-secondary rounded-full border border-accent/30 hover:border-accent hover:text-hover transition-all duration-200 disabled:opacity-50"
+                  style={{ backgroundColor: '#141414' }}
+                >
+                  {isLoadingEarlier ? 'Загрузка...' : 'Показать предыдущие сообщения'}
+                </button>
+              </div>
+            )}
+            
             {currentChat?.messages.map((msg) => (
               <div
                 key={msg.id}
@@ -42,6 +42,51 @@ export function WalletInterface({ user }: WalletInterfaceProps) {
     loadWalletData();
   }, [user.personal_wallet_balance]);
 
+  // Balance changes are pushed by the server; polling is only a fallback
+  // while the stream is disconnected
+  useEffect(() => {
+    let fallbackTimer: ReturnType<typeof setInterval> | null = null;
+
+    const refresh = async () => {
+      try {
+        const [walletData, communalData] = await Promise.all([
+          apiService.getWallets(),
+          apiService.getCommunalWallet()
+        ]);
+        setWalletData({ ...walletData, communal: communalData });
+      } catch {
+        // Keep showing the last known balances
+      }
+    };
+
+    const unsubscribe = apiService.subscribeWalletUpdates(
+      (event, payload) => {
+        if (event === 'balance_changed') {
+          if (payload.personal) {
+            setWalletData((current: any) => ({ ...current, personal: payload.personal }));
+          } else {
+            refresh();
+          }
+        } else if (event === 'wallet_event') {
+          setTransactions((current) => [payload, ...current]);
+        }
+      },
+      (connected) => {
+        if (connected && fallbackTimer) {
+          clearInterval(fallbackTimer);
+          fallbackTimer = null;
+        } else if (!connected && !fallbackTimer) {
+          fallbackTimer = setInterval(refresh, 60000);
+        }
+      }
+    );
+
+    return () => {
+      unsubscribe();
+      if (fallbackTimer) clearInterval(fallbackTimer);
+    };
+  }, []);
+
 
 
   return (
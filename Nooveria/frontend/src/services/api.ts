@@ -164,6 +164,76 @@ class ApiService {
     return this.request('/api/wallets/communal');
   }
 
+  // Subscribes to balance_changed / wallet_event pushes (SSE). Reconnects with
+  // Last-Event-ID so nothing is missed; onConnectionChange lets the caller fall
+  // back to polling while the stream is down. Returns an unsubscribe function.
+  subscribeWalletUpdates(
+    onEvent: (event: string, payload: any) => void,
+    onConnectionChange: (connected: boolean) => void = () => {}
+  ): () => void {
+    if (this.authToken?.startsWith('fallback-')) {
+      onConnectionChange(false);
+      return () => {};
+    }
+
+    const controller = new AbortController();
+    let lastEventId: string | null = null;
+    let retryMs = 3000;
+
+    const connect = async () => {
+      while (!controller.signal.aborted) {
+        try {
+          const response = await fetch(`${API_URL}/api/wallets/stream`, {
+            headers: {
+              Accept: 'text/event-stream',
+              ...(this.authToken ? { Authorization: `Bearer ${this.authToken}` } : {}),
+              ...(lastEventId ? { 'Last-Event-ID': lastEventId } : {}),
+            },
+            signal: controller.signal,
+          });
+          if (!response.ok || !response.body) {
+            throw new Error(`HTTP ${response.status}`);
+          }
+          onConnectionChange(true);
+
+          const reader = response.body.getReader();
+          const decoder = new TextDecoder();
+          let buffer = '';
+
+          while (true) {
+            const { done, value } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+
+            let boundary = buffer.indexOf('\n\n');
+            while (boundary !== -1) {
+              const frame = buffer.slice(0, boundary);
+              buffer = buffer.slice(boundary + 2);
+              boundary = buffer.indexOf('\n\n');
+
+              let event = 'message';
+              let data = '';
+              for (const line of frame.split('\n')) {
+                if (line.startsWith('id: ')) lastEventId = line.slice(4);
+                else if (line.startsWith('event: ')) event = line.slice(7);
+                else if (line.startsWith('data: ')) data += line.slice(6);
+                else if (line.startsWith('retry: ')) retryMs = Number(line.slice(7)) || retryMs;
+              }
+              if (data) onEvent(event, JSON.parse(data));
+            }
+          }
+        } catch {
+          if (controller.signal.aborted) return;
+        }
+        onConnectionChange(false);
+        await new Promise((resolve) => setTimeout(resolve, retryMs));
+      }
+    };
+
+    connect();
+    return () => controller.abort();
+  }
+
   async topUp(amount: number) {
     return this.request('/api/wallets/topup', {
       method: 'POST',
@@ -179,16 +249,33 @@ class ApiService {
   }
 
   // Chat history endpoints
-  async getChats() {
-    return this.request('/api/chats');
+  // Most recently active first; pass the last chat's id as `before` for the next page
+  async getChats(limit?: number, before?: string) {
+    const params = new URLSearchParams();
+    if (limit) params.set('limit', String(limit));
+    if (before) params.set('before', before);
+    const query = params.toString();
+    return this.request(`/api/chats${query ? `?${query}` : ''}`);
+  }
+
+  // Full-text search over chat and world chat messages, best matches first.
+  // Snippets are escaped HTML with the matched words in <mark>; pass the
+  // response's next_before as `before` for the next page
+  async searchMessages(q: string, before?: string, limit?: number) {
+    const params = new URLSearchParams({ q });
+    if (before) params.set('before', before);
+    if (limit) params.set('limit', String(limit));
+    return this.request(`/api/search?${params.toString()}`);
   }
 
   async createChat() {
     return this.request('/api/chats', { method: 'POST' });
   }
 
-  async getChat(chatId: string) {
-    return this.request(`/api/chats/${chatId}`);
+  // Newest page of messages, or the page older than message `before`
+  async getChat(chatId: string, before?: string) {
+    const query = before ? `?before=${encodeURIComponent(before)}` : '';
+    return this.request(`/api/chats/${chatId}${query}`);
   }
 
   async sendChatMessageToChat(chatId: string, message: string, preferCommunal: boolean = false, worldId?: string) {
@@ -202,6 +289,78 @@ class ApiService {
     });
   }
 
+  // Streams the assistant reply token by token (SSE). Resolves with the final
+  // "done" payload once the reply has been billed and saved.
+  async streamChatMessageToChat(
+    chatId: string,
+    message: string,
+    onToken: (content: string) => void,
+    preferCommunal: boolean = false
+  ): Promise<any> {
+    if (this.authToken?.startsWith('fallback-')) {
+      return this.sendChatMessageToChat(chatId, message, preferCommunal);
+    }
+
+    const response = await fetch(`${API_URL}/api/chats/${chatId}/messages`, {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/json',
+        Accept: 'text/event-stream',
+        ...(this.authToken ? { Authorization: `Bearer ${this.authToken}` } : {}),
+      },
+      body: JSON.stringify({
+        message,
+        prefer_communal: preferCommunal,
+        stream: true
+      }),
+    });
+
+    if (!response.ok || !response.body) {
+      const errorData = await response.json().catch(() => ({ detail: 'Network error' }));
+      throw new Error(errorData.detail || `HTTP ${response.status}`);
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let result: any = null;
+
+    while (true) {
+      const { done, value } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+
+      let boundary = buffer.indexOf('\n\n');
+      while (boundary !== -1) {
+        const frame = buffer.slice(0, boundary);
+        buffer = buffer.slice(boundary + 2);
+        boundary = buffer.indexOf('\n\n');
+
+        let event = 'message';
+        let data = '';
+        for (const line of frame.split('\n')) {
+          if (line.startsWith('event: ')) event = line.slice(7);
+          else if (line.startsWith('data: ')) data += line.slice(6);
+        }
+        if (!data) continue;
+
+        const payload = JSON.parse(data);
+        if (event === 'token') {
+          onToken(payload.content);
+        } else if (event === 'done') {
+          result = payload;
+        } else if (event === 'error') {
+          throw new Error(payload.detail || 'Stream error');
+        }
+      }
+    }
+
+    if (!result) {
+      throw new Error('Stream ended unexpectedly');
+    }
+    return result;
+  }
+
   async deleteChat(chatId: string) {
     return this.request(`/api/chats/${chatId}`, { method: 'DELETE' });
   }
@@ -219,6 +378,10 @@ class ApiService {
     return this.request('/api/admin/transactions');
   }
 
+  async getPurgeProgress() {
+    return this.request('/api/admin/purge');
+  }
+
   async getErrorLogs() {
     return this.request('/api/admin/logs');
   }
@@ -254,8 +417,9 @@ class ApiService {
   }
 
   // World chat endpoints
-  async getWorldChat(worldId: string) {
-    return this.request(`/api/world-chats/${worldId}`);
+  async getWorldChat(worldId: string, before?: string) {
+    const query = before ? `?before=${encodeURIComponent(before)}` : '';
+    return this.request(`/api/world-chats/${worldId}${query}`);
   }
 
   async sendWorldChatMessage(worldId: string, message: string, preferCommunal: boolean = false) {